@@ -0,0 +1,90 @@
+import json
+import time
+
+import numpy as np
+import torch
+from jsonargparse import CLI
+
+from crop_health_model.benchmarks.data_loading import environment
+from crop_health_model.models.backbones import BACKBONES, BackboneClassifier
+
+
+@torch.inference_mode()
+def measure_latency(
+    model: torch.nn.Module,
+    input_size: int = 224,
+    batch_size: int = 1,
+    warmup: int = 5,
+    iterations: int = 20,
+) -> float:
+    """Measure the median latency of the forward pass of a model in milliseconds."""
+    model.eval()
+    x = torch.randn(batch_size, 3, input_size, input_size)
+    for _ in range(warmup):
+        model(x)
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        model(x)
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies) * 1000)
+
+
+def benchmark_backbones(
+    architectures: list[str] | None = None,
+    num_classes: int = 2,
+    num_threads: int = 1,
+    input_size: int = 224,
+    batch_size: int = 1,
+    iterations: int = 20,
+    output: str | None = "benchmark_backbones.json",
+) -> dict:
+    """Measure the parameter count and CPU latency of the backbones of `BACKBONES`.
+
+    The measured values can be copied to the `num_params` and `cpu_latency_ms` of the
+    entries of `BACKBONES`.
+
+    Args:
+        architectures (list[str], optional): The backbones to measure, defaults to all.
+        num_classes (int): Number of classes of the classification head.
+        num_threads (int): Number of CPU threads used by PyTorch.
+        input_size (int): Height and width of the input images.
+        batch_size (int): Number of images per forward pass.
+        iterations (int): Number of measured forward passes.
+        output (str, optional): Path to save the results to as JSON.
+
+    Returns:
+        dict: The `num_params` and `cpu_latency_ms` of every backbone.
+    """
+    torch.set_num_threads(num_threads)
+    results = {}
+    for architecture in architectures or list(BACKBONES):
+        model = BackboneClassifier(architecture, num_classes)
+        results[architecture] = {
+            "num_params": sum(p.numel() for p in model.parameters()),
+            "cpu_latency_ms": round(
+                measure_latency(model, input_size, batch_size, iterations=iterations),
+                1,
+            ),
+        }
+        print(f"{architecture}: {results[architecture]}")
+
+    if output is not None:
+        report = {
+            "environment": environment(),
+            "settings": {
+                "num_classes": num_classes,
+                "num_threads": num_threads,
+                "input_size": input_size,
+                "batch_size": batch_size,
+            },
+            "results": results,
+        }
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Benchmark results saved to {output}")
+    return results
+
+
+if __name__ == "__main__":
+    CLI(benchmark_backbones)
@@ -0,0 +1,251 @@
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+from collections import defaultdict
+
+import numpy as np
+import PIL
+import torch
+import torchvision
+from jsonargparse import CLI
+from torch.utils.data import DataLoader, Subset, default_collate
+
+from crop_health_model.benchmarks.synthetic_corpus import (
+    IMAGE_SIZES,
+    make_synthetic_corpus,
+)
+from crop_health_model.datasets.dataset import TASKS, CropHealthDataset
+from crop_health_model.models.loading import load_datamodule
+
+
+def summarize(latencies: list[float]) -> dict:
+    """Summarize latencies in seconds as the mean, median and 95th percentile in milliseconds."""
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "mean_ms": round(float(latencies.mean()), 4),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 4),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 4),
+        "count": len(latencies),
+    }
+
+
+def environment() -> dict:
+    """Describe the code and machine the benchmark runs on."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "torchvision": torchvision.__version__,
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def profile_stages(
+    dataset: CropHealthDataset,
+    indices: list[int],
+    transform: torch.nn.Module | None,
+    batch_size: int,
+    batch_transform: torch.nn.Module | None = None,
+    train: bool = False,
+) -> dict[str, dict]:
+    """Measure the latency of every stage of loading the given samples.
+
+    The stages are reading the image file, decoding it (at the reduced size of
+    `decode_size`, if set), every transform of `transform` by class name, such as `Resize`
+    and `ToTensor`, collating the batches and, with `uint8_batches`, the batch transform.
+
+    Args:
+        dataset (CropHealthDataset): The dataset, without transforms.
+        indices (list[int]): Indices of the samples to load.
+        transform (torch.nn.Module, optional): The `Compose` of per-sample transforms.
+        batch_size (int): Number of samples collated at once.
+        batch_transform (torch.nn.Module, optional): The `BatchTransform` applied to the
+            collated batches.
+        train (bool): Apply the random flips of the batch transform.
+
+    Returns:
+        dict[str, dict]: The latency summary of every stage, see `summarize`. The collate and
+            batch transform latencies are per batch, the others per sample.
+    """
+    timings = defaultdict(list)
+    transforms_list = transform.transforms if transform is not None else []
+    for start in range(0, len(indices), batch_size):
+        batch = []
+        for idx in indices[start : start + batch_size]:
+            tic = time.perf_counter()
+            with open(
+                os.path.join(dataset.img_dir, dataset.index.path(idx)), "rb"
+            ) as f:
+                data = f.read()
+            toc = time.perf_counter()
+            timings["read"].append(toc - tic)
+
+            image = dataset.open_image(idx, io.BytesIO(data))
+            image.load()
+            tic = time.perf_counter()
+            timings["decode"].append(tic - toc)
+
+            for step in transforms_list:
+                image = step(image)
+                toc = time.perf_counter()
+                timings[type(step).__name__].append(toc - tic)
+                tic = toc
+            batch.append((image, int(dataset.labels[idx])))
+
+        tic = time.perf_counter()
+        images, _ = default_collate(batch)
+        toc = time.perf_counter()
+        timings["collate"].append(toc - tic)
+        if batch_transform is not None:
+            batch_transform(images, train=train)
+            timings["batch_transform"].append(time.perf_counter() - toc)
+    return {stage: summarize(latencies) for stage, latencies in timings.items()}
+
+
+def measure_throughput(
+    dataset: CropHealthDataset,
+    indices: list[int],
+    transform: torch.nn.Module | None,
+    batch_size: int,
+    num_workers: int,
+) -> float:
+    """Measure how many samples per second a DataLoader loads from the dataset.
+
+    Returns:
+        float: The number of samples per second, including the start of the workers.
+    """
+    dataset.transform = transform
+    try:
+        dataloader = DataLoader(
+            Subset(dataset, indices), batch_size=batch_size, num_workers=num_workers
+        )
+        num_samples = 0
+        start = time.perf_counter()
+        for images, _ in dataloader:
+            num_samples += len(images)
+        return num_samples / (time.perf_counter() - start)
+    finally:
+        dataset.transform = None
+
+
+def benchmark_data_loading(
+    configs: list[str] = ["crop_health_model/configs/config_binary.yaml"],
+    tasks: list[str] = list(TASKS),
+    pipelines: list[str] = ["train", "test"],
+    data_dir: str = ".benchmark_data",
+    scale: float = 0.002,
+    image_sizes: list[tuple[tuple[int, int], float]] = IMAGE_SIZES,
+    num_samples: int = 256,
+    batch_size: int = 32,
+    num_workers: int = 0,
+    seed: int = 0,
+    output: str = "benchmark_data_loading.json",
+) -> dict:
+    """Benchmark the data loading of `CropHealthDataset` on a synthetic corpus.
+
+    The corpus is generated by `make_synthetic_corpus`, so no data has to be downloaded.
+    For every config, task and pipeline, the latency of every stage of loading a sample is
+    measured on a single process, and the samples per second on a DataLoader with
+    `num_workers` workers. The transforms, `decode_size` and `uint8_batches` are taken from
+    the `fit.data` section of the config, the image cache and shards are not used. The
+    results are saved as JSON together with the git commit, to compare them across commits.
+
+    Args:
+        configs (list[str]): Paths to training configs with the transforms to benchmark.
+        tasks (list[str]): The tasks to benchmark.
+        pipelines (list[str]): The transforms to benchmark, `train` and/or `test`.
+        data_dir (str): Path to the directory of the synthetic corpus.
+        scale (float): Fraction of the images of every class in the synthetic corpus.
+        image_sizes (list[tuple[tuple[int, int], float]]): The (width, height) of the images
+            of the synthetic corpus with their weights.
+        num_samples (int): Number of randomly chosen samples loaded in every benchmark.
+        batch_size (int): Number of samples per batch.
+        num_workers (int): Number of DataLoader workers when measuring the throughput.
+        seed (int): Seed of the synthetic corpus and the chosen samples.
+        output (str): Path to save the results to.
+
+    Returns:
+        dict: The results, as saved to `output`.
+    """
+    annotations_file = make_synthetic_corpus(
+        data_dir, scale=scale, image_sizes=image_sizes, seed=seed
+    )
+
+    results = []
+    for config in configs:
+        datamodule = load_datamodule(config)
+        for task in tasks:
+            dataset = CropHealthDataset(
+                annotations_file,
+                data_dir,
+                task,
+                decode_size=datamodule.decode_size,
+            )
+            rng = np.random.default_rng(seed)
+            indices = rng.permutation(len(dataset))[:num_samples].tolist()
+            for pipeline in pipelines:
+                transform = getattr(datamodule, f"{pipeline}_transform")
+                stages = profile_stages(
+                    dataset,
+                    indices,
+                    transform,
+                    batch_size,
+                    datamodule.batch_transform,
+                    train=pipeline == "train",
+                )
+                samples_per_second = measure_throughput(
+                    dataset, indices, transform, batch_size, num_workers
+                )
+                results.append(
+                    {
+                        "config": config,
+                        "task": task,
+                        "pipeline": pipeline,
+                        "num_classes": len(dataset.class_map),
+                        "samples_per_second": round(samples_per_second, 2),
+                        "stages": stages,
+                    }
+                )
+                print(
+                    f"{config} {task} {pipeline}: {samples_per_second:.1f} samples/s, "
+                    + ", ".join(
+                        f"{stage} {summary['mean_ms']:.2f} ms"
+                        for stage, summary in stages.items()
+                    )
+                )
+
+    report = {
+        "environment": environment(),
+        "settings": {
+            "scale": scale,
+            "num_images": len(dataset),
+            "num_samples": len(indices),
+            "batch_size": batch_size,
+            "num_workers": num_workers,
+            "seed": seed,
+        },
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to {output}")
+    return report
+
+
+if __name__ == "__main__":
+    CLI(benchmark_data_loading)
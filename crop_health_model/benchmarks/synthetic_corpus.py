@@ -0,0 +1,150 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+from tqdm import tqdm
+
+from crop_health_model.data.metadata import all_datasets
+
+corpus_meta_filename = "corpus.json"
+
+# Approximate mix of the (width, height) of the photos in the datasets, with their weights
+IMAGE_SIZES = [
+    ((4000, 3000), 0.3),
+    ((3000, 4000), 0.1),
+    ((1600, 1200), 0.25),
+    ((1280, 720), 0.2),
+    ((640, 480), 0.15),
+]
+
+
+def class_counts(dataset: dict) -> dict[str, int]:
+    """Return the number of images of every class of a dataset, by raw class name.
+
+    The classes with an unknown count (-1) share the images of `total_image_count` that
+    aren't counted by the other classes.
+    """
+    known = {c["raw"]: c["count"] for c in dataset["classes"] if c["count"] >= 0}
+    unknown = [c["raw"] for c in dataset["classes"] if c["count"] < 0]
+    counts = dict(known)
+    if unknown:
+        remaining = max(0, dataset["total_image_count"] - sum(known.values()))
+        for i, name in enumerate(unknown):
+            counts[name] = remaining // len(unknown) + (i < remaining % len(unknown))
+    return counts
+
+
+def synthetic_image(path: str, width: int, height: int, seed: int) -> None:
+    """Write a synthetic JPEG photo of the given size.
+
+    The image is a smooth random color field with fine noise on top, so that it compresses
+    and decodes roughly like a photo of a leaf rather than like a flat or pure noise image.
+    """
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, size=(6, 8, 3), dtype=np.uint8)
+    image = Image.fromarray(coarse).resize((width, height), Image.BICUBIC)
+    pixels = np.asarray(image, dtype=np.int16)
+    pixels += rng.integers(-12, 13, size=pixels.shape, dtype=np.int16)
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(path, quality=90)
+
+
+def make_synthetic_corpus(
+    output_dir: str = ".benchmark_data",
+    scale: float = 0.002,
+    datasets: list[dict] = all_datasets,
+    image_sizes: list[tuple[tuple[int, int], float]] = IMAGE_SIZES,
+    annotations_file: str = "annotations.csv",
+    seed: int = 0,
+    max_workers: int | None = None,
+) -> str:
+    """Generate a synthetic corpus with the structure of the downloaded datasets.
+
+    Every dataset of `datasets` gets a folder with a directory per class, holding `scale`
+    times the number of images of that class (at least one), so the classes and their
+    proportions are those of metadata.py. The sizes of the images are drawn from
+    `image_sizes`. The annotations file is written like `make_annotations_file.py` does,
+    so the corpus can be loaded by `CropHealthDataset` for any task.
+
+    An existing corpus generated with the same arguments is reused.
+
+    Args:
+        output_dir (str): Path to the directory to write the corpus to.
+        scale (float): Fraction of the images of every class to generate.
+        datasets (list[dict]): The datasets to imitate, as defined in metadata.py.
+        image_sizes (list[tuple[tuple[int, int], float]]): The (width, height) of the images
+            with their weights.
+        annotations_file (str): Filename of the annotations file inside `output_dir`.
+        seed (int): Seed of the image sizes and contents.
+        max_workers (int, optional): Number of processes, defaults to the number of CPUs.
+
+    Returns:
+        str: The path to the annotations file.
+    """
+    annotations_file_path = os.path.join(output_dir, annotations_file)
+    meta = {
+        "scale": scale,
+        "datasets": [dataset["folder"] for dataset in datasets],
+        "image_sizes": [[list(size), weight] for size, weight in image_sizes],
+        "seed": seed,
+    }
+    meta_path = os.path.join(output_dir, corpus_meta_filename)
+    if os.path.exists(meta_path) and os.path.exists(annotations_file_path):
+        with open(meta_path, "r") as f:
+            if json.load(f) == meta:
+                print(f"Reusing the synthetic corpus in {output_dir}")
+                return annotations_file_path
+
+    rng = np.random.default_rng(seed)
+    sizes = np.array([size for size, _ in image_sizes])
+    weights = np.array([weight for _, weight in image_sizes], dtype=float)
+    rows = []
+    jobs = []
+    for dataset in datasets:
+        labels = {c["raw"]: c["clean"] for c in dataset["classes"]}
+        for raw, count in class_counts(dataset).items():
+            class_dir = os.path.join(dataset["folder"], raw)
+            os.makedirs(os.path.join(output_dir, class_dir), exist_ok=True)
+            num_images = max(1, round(count * scale))
+            choices = rng.choice(len(sizes), size=num_images, p=weights / weights.sum())
+            for i, (width, height) in enumerate(sizes[choices]):
+                image = os.path.join(class_dir, f"{i:05d}.jpg")
+                jobs.append(
+                    (
+                        os.path.join(output_dir, image),
+                        int(width),
+                        int(height),
+                        int(rng.integers(2**31)),
+                    )
+                )
+                rows.append(
+                    {
+                        "image": image,
+                        "width": int(width),
+                        "height": int(height),
+                        "label": labels[raw],
+                        "crop_type": dataset["crop_type"],
+                        "dataset": dataset["folder"],
+                    }
+                )
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for _ in tqdm(
+            executor.map(synthetic_image, *zip(*jobs), chunksize=8),
+            total=len(jobs),
+            desc="Generating",
+            unit="image",
+        ):
+            pass
+
+    pd.DataFrame(rows).to_csv(annotations_file_path, index=False)
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    print(f"Wrote {len(rows)} synthetic images to {output_dir}")
+    return annotations_file_path
+
+
+if __name__ == "__main__":
+    make_synthetic_corpus()
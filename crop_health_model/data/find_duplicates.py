@@ -0,0 +1,292 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+from tqdm import tqdm
+
+from crop_health_model.datasets.annotations import read_annotations
+from crop_health_model.datasets.split import annotations_split, load_split
+
+duplicates_filename = "duplicates.csv"
+
+# Number of set bits of every byte value
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def image_hash(img_path: str, hash_size: int = 8) -> int | None:
+    """Compute the difference hash (dHash) of an image.
+
+    The image is decoded at a low resolution, converted to grayscale and resized to
+    `hash_size + 1` by `hash_size` pixels. Every bit of the hash tells whether a pixel is
+    brighter than its left neighbour, which is robust to rescaling and re-encoding.
+
+    Args:
+        img_path (str): Path to the image.
+        hash_size (int): Size of the hash, which has `hash_size ** 2` bits (at most 64).
+
+    Returns:
+        int | None: The hash, or None if the image can't be decoded.
+    """
+    try:
+        with Image.open(img_path) as image:
+            # let the JPEG decoder downscale the image, the hash only needs a few pixels
+            image.draft("L", (4 * hash_size, 4 * hash_size))
+            image = image.convert("L").resize(
+                (hash_size + 1, hash_size), Image.BILINEAR
+            )
+            pixels = np.asarray(image, dtype=np.int16)
+    except OSError as e:
+        print(f"Error hashing image: {img_path}, {e}")
+        return None
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+def compute_hashes(
+    img_paths: list[str],
+    executor: ProcessPoolExecutor | None = None,
+    chunksize: int = 64,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Compute the hashes of the images in parallel on a process pool.
+
+    Args:
+        img_paths (list[str]): Paths to the images.
+        executor (ProcessPoolExecutor, optional): The process pool hashing the images, a new
+            one is created if not given.
+        chunksize (int): Number of images sent to a process at once.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The uint64 hash of every image, and whether the image
+            could be hashed.
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor()
+    try:
+        results = list(
+            tqdm(
+                executor.map(image_hash, img_paths, chunksize=chunksize),
+                total=len(img_paths),
+                desc="Hashing",
+                unit="image",
+            )
+        )
+    finally:
+        if own_executor:
+            executor.shutdown()
+    valid = np.array([result is not None for result in results], dtype=bool)
+    hashes = np.array([result or 0 for result in results], dtype=np.uint64)
+    return hashes, valid
+
+
+def hamming_distance(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Return the number of different bits between two arrays of uint64 hashes."""
+    xor = np.bitwise_xor(a, b).astype(np.uint64)
+    return POPCOUNT[xor.view(np.uint8).reshape(-1, 8)].sum(axis=1, dtype=np.int64)
+
+
+def _band_candidates(keys: np.ndarray) -> np.ndarray:
+    """Return all pairs (i, j) with i < j of the indices having the same key."""
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    # only the indices whose key is shared by at least one other index can form pairs
+    shared = np.zeros(len(keys), dtype=bool)
+    same = sorted_keys[1:] == sorted_keys[:-1]
+    shared[1:] |= same
+    shared[:-1] |= same
+    order, sorted_keys = order[shared], sorted_keys[shared]
+
+    # pair every index with the next indices of its group, one offset at a time
+    pairs = []
+    offset = 1
+    while offset < len(order):
+        same = sorted_keys[offset:] == sorted_keys[:-offset]
+        if not same.any():
+            break
+        pairs.append(np.stack([order[:-offset][same], order[offset:][same]], axis=1))
+        offset += 1
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.concatenate(pairs)
+    return np.sort(pairs, axis=1)
+
+
+def find_duplicates(
+    hashes: np.ndarray, max_distance: int = 4, valid: np.ndarray | None = None
+) -> np.ndarray:
+    """Find the pairs of hashes within a Hamming distance of `max_distance`.
+
+    This uses multi-index hashing: the 64 bits are split into `max_distance + 1` bands, and
+    two hashes within the distance are identical in at least one of the bands. Only the
+    pairs sharing a band are compared, instead of all pairs.
+
+    Args:
+        hashes (np.ndarray): The uint64 hashes.
+        max_distance (int): The maximum number of different bits of near duplicates.
+        valid (np.ndarray, optional): Only consider the hashes where this is True.
+
+    Returns:
+        np.ndarray: The pairs (i, j, distance) with i < j, sorted by i and j.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    indices = np.arange(len(hashes))
+    if valid is not None:
+        indices = indices[valid]
+
+    num_bands = max_distance + 1
+    bounds = np.linspace(0, 64, num_bands + 1).astype(int)
+    candidates = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        mask = np.uint64((1 << int(end - start)) - 1)
+        keys = (hashes[indices] >> np.uint64(start)) & mask
+        candidates.append(indices[_band_candidates(keys)].T)
+    candidates = np.concatenate(candidates, axis=1)
+
+    distances = hamming_distance(hashes[candidates[0]], hashes[candidates[1]])
+    near = distances <= max_distance
+    # remove the pairs found in several bands
+    num_images = np.int64(len(hashes))
+    codes, first = np.unique(
+        candidates[0, near] * num_images + candidates[1, near], return_index=True
+    )
+    return np.column_stack(
+        [codes // num_images, codes % num_images, distances[near][first]]
+    )
+
+
+def duplicate_groups(num_images: int, pairs: np.ndarray) -> np.ndarray:
+    """Group the images connected by duplicate pairs.
+
+    Returns:
+        np.ndarray: The group of every image, which is the smallest index in its group.
+    """
+    parent = np.arange(num_images)
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs[:, :2]:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    return np.array([find(i) for i in range(num_images)])
+
+
+def leakage_report(groups: np.ndarray, splits: dict[str, np.ndarray]) -> dict:
+    """Count the images that have a duplicate in an earlier split.
+
+    Args:
+        groups (np.ndarray): The duplicate group of every image, see `duplicate_groups`.
+        splits (dict[str, np.ndarray]): The indices of every split, in order, such as `train`,
+            `val` and `test`.
+
+    Returns:
+        dict: For every later split, the number of its images with a duplicate in each of the
+            earlier splits, such as `{"test": {"train": 12, "val": 3}}`.
+    """
+    report = {}
+    names = list(splits)
+    for i, split in enumerate(names[1:], start=1):
+        report[split] = {}
+        for earlier in names[:i]:
+            earlier_groups = np.unique(groups[splits[earlier]])
+            report[split][earlier] = int(
+                np.isin(groups[splits[split]], earlier_groups).sum()
+            )
+    return report
+
+
+def deduplicate(
+    df: pd.DataFrame,
+    data_dir: str = ".data",
+    max_distance: int = 4,
+    executor: ProcessPoolExecutor | None = None,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Remove the exact and near duplicate images from the annotations.
+
+    The first image of every group of duplicates, in the order of the annotations, is kept.
+
+    Args:
+        df (pd.DataFrame): The annotations.
+        data_dir (str): Path to the directory the image paths are relative to.
+        max_distance (int): The maximum number of different bits of near duplicates.
+        executor (ProcessPoolExecutor, optional): The process pool hashing the images.
+
+    Returns:
+        tuple[pd.DataFrame, pd.DataFrame]: The deduplicated annotations, and the removed
+            `image`s with the image they duplicate (`duplicate_of`) and both labels.
+    """
+    df = df.reset_index(drop=True)
+    hashes, valid = compute_hashes(
+        [os.path.join(data_dir, image) for image in df["image"]], executor
+    )
+    pairs = find_duplicates(hashes, max_distance, valid)
+    groups = duplicate_groups(len(df), pairs)
+    removed = np.flatnonzero(groups != np.arange(len(df)))
+
+    duplicates = pd.DataFrame(
+        {
+            "image": df["image"].to_numpy()[removed],
+            "label": df["label"].to_numpy()[removed],
+            "duplicate_of": df["image"].to_numpy()[groups[removed]],
+            "duplicate_label": df["label"].to_numpy()[groups[removed]],
+        }
+    )
+    conflicts = (duplicates["label"] != duplicates["duplicate_label"]).sum()
+    print(
+        f"Found {len(pairs)} duplicate pairs, removing {len(removed)} of {len(df)} images "
+        f"({conflicts} of them with a different label)"
+    )
+    return df.drop(index=removed).reset_index(drop=True), duplicates
+
+
+def report_leakage(
+    data_dir: str = ".data",
+    annotations_file: str = "annotations.csv",
+    data_split: tuple = (0.8, 0.2),
+    seed: int = 42,
+    max_distance: int = 4,
+    split_file: str | None = None,
+) -> dict:
+    """Report the duplicates shared between the train, validation and test splits.
+
+    The splits are the ones saved in `split_file`, or else the stratified split that
+    `CropHealthDataModule` makes with the same `data_split` and seed.
+
+    Args:
+        data_dir (str): Path to the directory containing the images and annotations file.
+        annotations_file (str): Filename of the annotations file inside `data_dir`.
+        data_split (tuple): The data split, as in `CropHealthDataModule`.
+        seed (int): Seed of the data split.
+        max_distance (int): The maximum number of different bits of near duplicates.
+        split_file (str, optional): Directory of a saved data split, such as the `split`
+            directory of a training run.
+
+    Returns:
+        dict: The leakage report, see `leakage_report`.
+    """
+    df = read_annotations(os.path.join(data_dir, annotations_file))
+    hashes, valid = compute_hashes(
+        [os.path.join(data_dir, image) for image in df["image"]]
+    )
+    groups = duplicate_groups(len(df), find_duplicates(hashes, max_distance, valid))
+    if split_file is not None:
+        splits = load_split(split_file, num_samples=len(df))
+    else:
+        splits = annotations_split(df["label"], df["crop_type"], data_split, seed)
+    report = leakage_report(groups, splits)
+    for split, counts in report.items():
+        for earlier, count in counts.items():
+            print(
+                f"{count} of the {split} images have a duplicate in the {earlier} split"
+            )
+    return report
+
+
+if __name__ == "__main__":
+    report_leakage()
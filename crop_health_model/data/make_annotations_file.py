@@ -1,4 +1,8 @@
 import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Callable
 
 import pandas as pd
 import PIL
@@ -6,7 +10,14 @@ from PIL import Image
 from torchvision import transforms
 from tqdm import tqdm
 
+from crop_health_model.data.find_duplicates import deduplicate, duplicates_filename
+from crop_health_model.data.make_dataset import load_manifest, save_manifest
 from crop_health_model.data.metadata import all_datasets
+from crop_health_model.datasets.annotations import (
+    arrow_path,
+    pa,
+    write_annotations_arrow,
+)
 
 # Define the transformation to apply to the images
 # This transformation is similar to the one used in the training script
@@ -21,6 +32,241 @@ transform = transforms.Compose(
 )
 
 
+def identify_classes(path: str, classes: list[dict]) -> list[str]:
+    """Return the clean names of the classes whose raw name appears in a directory path.
+
+    Args:
+        path (str): Path of the directory containing the image.
+        classes (list[dict]): List of classes with raw and clean names.
+    """
+    return [class_["clean"] for class_ in classes if class_["raw"] in path]
+
+
+VALIDATION_LEVELS = ("header", "sample", "full")
+
+annotations_cache_filename = ".annotations_cache.json"
+
+
+def has_end_of_image(img_path: str, tail_size: int = 1024) -> bool:
+    """Check that a JPEG file ends with the end of image (EOI) marker.
+
+    Truncated JPEG files don't end with this marker, but neither do the photos of some
+    phones, which append data after it, so a missing marker only means that the image has to
+    be decoded to tell. Some encoders pad the file after the marker, so the padding is ignored.
+    """
+    with open(img_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - tail_size))
+        tail = f.read()
+    return tail.rstrip(b"\x00").endswith(b"\xff\xd9")
+
+
+def sampled(img_path: str, sample_rate: float) -> bool:
+    """Deterministically decide whether an image belongs to the sample to decode."""
+    return zlib.crc32(img_path.encode("utf-8")) % 10_000 < sample_rate * 10_000
+
+
+def validate_image(
+    img_path: str, validation: str = "header", sample_rate: float = 0.05
+) -> tuple[int, int] | None:
+    """Check that an image is valid.
+
+    There are three levels of validation:
+    - `header`: read only the header of the image for its size, check its structure with
+      `verify()` and check that JPEG files are not truncated, decoding only the JPEG files
+      that don't end with the end of image marker.
+    - `sample`: in addition, decode and transform a deterministic sample of `sample_rate`
+      of the images.
+    - `full`: in addition, decode and transform every image.
+
+    Args:
+        img_path (str): Path to the image.
+        validation (str): One of `header`, `sample` or `full`.
+        sample_rate (float): The fraction of images decoded with `sample` validation.
+
+    Returns:
+        tuple[int, int] | None: The width and height of the image, or None if it is invalid.
+    """
+    if validation not in VALIDATION_LEVELS:
+        raise ValueError(f"Invalid validation: {validation}")
+
+    # Try to open the image, if it fails, skip it
+    try:
+        with Image.open(img_path) as img:
+            # dimension
+            width, height = img.size
+            img_format = img.format
+            img.verify()
+    except PIL.UnidentifiedImageError as e:
+        print(f"Error opening image: {img_path}, {e}")
+        return None
+    except (OSError, SyntaxError) as e:
+        print(f"Error transforming image: {img_path}, {e}")
+        return None
+
+    # A truncated JPEG file fails in the transformation. Files ending with the end of image
+    # marker are not truncated, the others are decoded to find out whether they are
+    complete = img_format != "JPEG" or has_end_of_image(img_path)
+    if complete and (
+        validation == "header"
+        or (validation == "sample" and not sampled(img_path, sample_rate))
+    ):
+        return width, height
+
+    # Try to apply the transformation, if it fails, skip it
+    try:
+        img = transform(Image.open(img_path))
+    except OSError as e:
+        print(f"Error transforming image: {img_path}, {e}")
+        return None
+
+    return width, height
+
+
+def submit_annotations(
+    img_dir: str,
+    keywords_to_avoid: list[str],
+    annotations_file_path: str,
+    classes: list[dict],
+    total_image_count: int,
+    crop_type: str,
+    executor: ProcessPoolExecutor,
+    data_dir: str = ".data",
+    chunksize: int = 64,
+    validation: str = "header",
+    sample_rate: float = 0.05,
+    cache_path: str | None = None,
+) -> Callable[[], pd.DataFrame]:
+    """Find the images of a dataset and submit their validation to the process pool.
+
+    All chunks of images are submitted at once, so the images of several datasets are
+    validated concurrently when the validation of all of them is submitted before waiting
+    for any. See `generate_annotations` for the arguments.
+
+    Returns:
+        Callable[[], pd.DataFrame]: Waits for the validation to finish, then saves and
+            returns the annotations of the dataset.
+    """
+    print(f"Generating annotations for {img_dir}")
+
+    # Load the images validated by a previous run, if validated in the same way
+    cache = {}
+    if cache_path is not None:
+        cache = load_manifest(cache_path)
+        if (cache.get("validation"), cache.get("sample_rate")) != (
+            validation,
+            sample_rate,
+        ):
+            cache = {}
+    cached_entries = cache.get("entries", {})
+
+    # Loop through all the subdirectories in the img_dir, in sorted order
+    # But make sure to only add images to the candidates list
+    # The classes are identified once per directory from the directory name
+    candidates = []
+    for root, dirs, files in os.walk(img_dir):
+        dirs.sort()
+        if any(keyword in root for keyword in keywords_to_avoid):
+            continue
+        identified_classes = identify_classes(root, classes)
+        for file in sorted(files):
+            if file.endswith((".jpg", ".jpeg")):
+                path = os.path.relpath(os.path.join(root, file), data_dir)
+                stat = os.stat(os.path.join(data_dir, path))
+                candidates.append(
+                    (path, stat.st_size, stat.st_mtime_ns, identified_classes)
+                )
+
+    # Only validate the images that are new or changed since the previous run
+    entries = {}
+    to_validate = []
+    for path, size, mtime, _ in candidates:
+        entry = cached_entries.get(path)
+        if entry is not None and entry[:2] == [size, mtime]:
+            entries[path] = entry
+        else:
+            to_validate.append((path, size, mtime))
+    print(f"Validating {len(to_validate)} new or changed images in {img_dir}")
+
+    # map submits every chunk right away, and returns the results in the order of the images
+    sizes = []
+    if to_validate:
+        sizes = executor.map(
+            partial(validate_image, validation=validation, sample_rate=sample_rate),
+            [os.path.join(data_dir, path) for path, _, _ in to_validate],
+            chunksize=chunksize,
+        )
+
+    def collect() -> pd.DataFrame:
+        for (path, size, mtime), image_size in zip(
+            to_validate,
+            tqdm(sizes, total=len(to_validate), unit="image", desc=img_dir),
+        ):
+            # invalid images are cached as well, with an unknown width and height
+            entries[path] = [size, mtime, *(image_size or (None, None))]
+
+        img_paths = []
+        labels = []
+        heights = []
+        widths = []
+        for path, _, _, identified_classes in candidates:
+            _, _, width, height = entries[path]
+            if width is None:
+                continue
+
+            img_paths.append(path)
+            heights.append(height)
+            widths.append(width)
+
+            # Get the label from the directory name
+            labels.extend(identified_classes)
+            if len(identified_classes) == 0:
+                print(f"Could not identify class for {path}")
+            if len(identified_classes) > 1:
+                print(f"Multiple classes identified for {path}")
+
+        # Deleted images are dropped from the cache
+        if cache_path is not None:
+            save_manifest(
+                {
+                    "validation": validation,
+                    "sample_rate": sample_rate,
+                    "entries": entries,
+                },
+                cache_path,
+            )
+
+        # Verify that the number of labels matches the number of images
+        print(
+            f"Expected {total_image_count} images, found {len(img_paths)} images and {len(labels)} labels in {img_dir}"
+        )
+
+        # Verify that the number of class labels is correct
+        for class_ in classes:
+            # Skip classes with count -1 as defined in the metadata
+            if class_["count"] == -1:
+                continue
+            print(
+                f"Expected {class_['count']} images for class {class_['clean']}, found {labels.count(class_['clean'])}"
+            )
+
+        # Create a list of crop types
+        crop_types = [crop_type] * len(img_paths)
+
+        # Create a DataFrame from the img_paths and labels lists
+        df = pd.DataFrame(
+            list(zip(img_paths, widths, heights, labels, crop_types)),
+            columns=["image", "width", "height", "label", "crop_type"],
+        )
+
+        # Save the DataFrame to a CSV file
+        df.to_csv(annotations_file_path, index=False)
+
+        return df
+
+    return collect
+
+
 def generate_annotations(
     img_dir: str,
     keywords_to_avoid: list[str],
@@ -28,9 +274,21 @@ def generate_annotations(
     classes: list[dict],
     total_image_count: int,
     crop_type: str,
+    data_dir: str = ".data",
+    executor: ProcessPoolExecutor | None = None,
+    chunksize: int = 64,
+    validation: str = "header",
+    sample_rate: float = 0.05,
+    cache_path: str | None = None,
 ) -> pd.DataFrame:
     """Generate annotations for a dataset.
 
+    The images are validated in parallel on a process pool, in chunks of `chunksize` images.
+    The annotations keep the order in which the images are found. With a `cache_path`, the
+    validated images are cached by path, file size and modification time, so that a rerun
+    only validates the images that are new or changed. The cache is discarded when the
+    `validation` or the `sample_rate` changes.
+
     Args:
         img_dir (str): Path to the directory containing the images.
         keywords_to_avoid (list[str]): List of keywords to avoid in the image paths.
@@ -38,108 +296,108 @@ def generate_annotations(
         classes (list[dict]): List of classes with raw and clean names.
         total_image_count (int): Total number of images expected in the dataset.
         crop_type (str): Crop type for the dataset.
+        data_dir (str): Path to the directory the image paths are relative to.
+        executor (ProcessPoolExecutor, optional): The process pool validating the images,
+            a new one is created if not given.
+        chunksize (int): Number of images sent to a process at once.
+        validation (str): How thoroughly the images are validated, see `validate_image`.
+        sample_rate (float): The fraction of images decoded with `sample` validation.
+        cache_path (str, optional): Path to the cache of validated images.
 
     Returns:
         pd.DataFrame: DataFrame containing the annotations.
     """
-    img_paths = []
-    labels = []
-    heights = []
-    widths = []
-
-    print(f"Generating annotations for {img_dir}")
-
-    # Loop through all the subdirectories in the img_dir
-    # But make sure to only add images to the img_paths list
-    for root, dirs, files in os.walk(img_dir):
-        for file in tqdm(files):
-            if file.endswith((".jpg", ".jpeg")) and not any(
-                keyword in root for keyword in keywords_to_avoid
-            ):
-                path = os.path.join(root.lstrip(".data/"), file)
-
-                # Try to open the image, if it fails, skip it
-                try:
-                    img = Image.open(os.path.join(".data", path))
-                    # dimension
-                    width, height = img.size
-                except PIL.UnidentifiedImageError as e:
-                    print(f"Error opening image: {path}, {e}")
-                    continue
-
-                # Try to apply the transformation, if it fails, skip it
-                try:
-                    img = transform(img)
-                except OSError as e:
-                    print(f"Error transforming image: {path}, {e}")
-                    continue
-
-                img_paths.append(path)
-                heights.append(height)
-                widths.append(width)
-
-                # Get the label from the directory name
-                identified_class_count = 0
-                for class_ in classes:
-                    if class_["raw"] in root:
-                        identified_class_count += 1
-                        labels.append(class_["clean"])
-                if identified_class_count == 0:
-                    print(f"Could not identify class for {path}")
-                if identified_class_count > 1:
-                    print(f"Multiple classes identified for {path}")
-
-    # Verify that the number of labels matches the number of images
-    print(
-        f"Expected {total_image_count} images, found {len(img_paths)} images and {len(labels)} labels"
-    )
-
-    # Verify that the number of class labels is correct
-    for class_ in classes:
-        # Skip classes with count -1 as defined in the metadata
-        if class_["count"] == -1:
-            continue
-        print(
-            f"Expected {class_['count']} images for class {class_['clean']}, found {labels.count(class_['clean'])}"
-        )
+    # the pool only starts its processes once images are submitted
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor()
+    try:
+        return submit_annotations(
+            img_dir=img_dir,
+            keywords_to_avoid=keywords_to_avoid,
+            annotations_file_path=annotations_file_path,
+            classes=classes,
+            total_image_count=total_image_count,
+            crop_type=crop_type,
+            executor=executor,
+            data_dir=data_dir,
+            chunksize=chunksize,
+            validation=validation,
+            sample_rate=sample_rate,
+            cache_path=cache_path,
+        )()
+    finally:
+        if own_executor:
+            executor.shutdown()
 
-    # Create a list of crop types
-    crop_types = [crop_type] * len(img_paths)
 
-    # Create a DataFrame from the img_paths and labels lists
-    df = pd.DataFrame(
-        list(zip(img_paths, widths, heights, labels, crop_types)),
-        columns=["image", "width", "height", "label", "crop_type"],
-    )
+def generate_all_annotations(
+    data_dir: str = ".data",
+    max_workers: int | None = None,
+    validation: str = "header",
+    deduplicate_images: bool = False,
+    max_distance: int = 4,
+) -> None:
+    """Generate annotations for all datasets.
 
-    # Save the DataFrame to a CSV file
-    df.to_csv(annotations_file_path, index=False)
+    Args:
+        data_dir (str): Path to the directory containing the datasets.
+        max_workers (int, optional): Number of processes, defaults to the number of CPUs.
+        validation (str): How thoroughly the images are validated, see `validate_image`.
+        deduplicate_images (bool): Remove the exact and near duplicate images from the
+            combined annotations, the removed images are listed in `duplicates.csv`.
+        max_distance (int): The maximum Hamming distance between the perceptual hashes of
+            near duplicates.
+    """
+    # all datasets share the same process pool, and the images of all of them are submitted
+    # before waiting for any, so the pool never idles at the end of a dataset
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        collectors = []
+        for dataset in all_datasets:
+            img_dir = os.path.join(data_dir, dataset["folder"])
+            keywords_to_avoid = ["MACOSX"]
+            annotations_file_path = os.path.join(
+                data_dir, dataset["folder"], "annotations.csv"
+            )
+            collectors.append(
+                submit_annotations(
+                    img_dir=img_dir,
+                    keywords_to_avoid=keywords_to_avoid,
+                    annotations_file_path=annotations_file_path,
+                    classes=dataset["classes"],
+                    total_image_count=dataset["total_image_count"],
+                    crop_type=dataset["crop_type"],
+                    executor=executor,
+                    data_dir=data_dir,
+                    validation=validation,
+                    cache_path=os.path.join(img_dir, annotations_cache_filename),
+                )
+            )
+        print()
 
-    return df
+        # the annotations are collected in the order of the datasets
+        all_dfs = []
+        for dataset, collect in zip(all_datasets, collectors):
+            all_dfs.append(collect().assign(dataset=dataset["folder"]))
+            print()
+        all_df = pd.concat(all_dfs)
 
+        if deduplicate_images:
+            all_df, duplicates = deduplicate(all_df, data_dir, max_distance, executor)
+            duplicates.to_csv(os.path.join(data_dir, duplicates_filename), index=False)
+    all_annotations_file_path = os.path.join(data_dir, "annotations.csv")
+    all_df.to_csv(all_annotations_file_path, index=False)
+    print(f"All annotations saved to {all_annotations_file_path}")
 
-def generate_all_annotations() -> None:
-    """Generate annotations for all datasets."""
-    all_dfs = []
-    for dataset in all_datasets:
-        img_dir = os.path.join(".data", dataset["folder"])
-        keywords_to_avoid = ["MACOSX"]
-        annotations_file_path = os.path.join(
-            ".data", dataset["folder"], "annotations.csv"
-        )
-        df = generate_annotations(
-            img_dir=img_dir,
-            keywords_to_avoid=keywords_to_avoid,
-            annotations_file_path=annotations_file_path,
-            classes=dataset["classes"],
-            total_image_count=dataset["total_image_count"],
-            crop_type=dataset["crop_type"],
+    # The Arrow file is written after the CSV file, so it is loaded instead of it
+    if pa is None:
+        print(
+            "pyarrow is not installed, skipping the Arrow annotations file (install the "
+            "`arrow` extra with `pip install crop-health-model[arrow]`)"
         )
-        print()
-        all_dfs.append(df)
-    all_df = pd.concat(all_dfs)
-    all_df.to_csv(os.path.join(".data", "annotations.csv"), index=False)
-    print("All annotations saved to .data/annotations.csv")
+        return
+    write_annotations_arrow(all_df, arrow_path(all_annotations_file_path))
+    print(f"All annotations saved to {arrow_path(all_annotations_file_path)}")
 
 
 if __name__ == "__main__":
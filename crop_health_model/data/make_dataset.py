@@ -1,6 +1,10 @@
 import asyncio
+import hashlib
+import json
 import os
+import re
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import httpx
 import rarfile
@@ -11,114 +15,370 @@ from crop_health_model.data.metadata import all_datasets
 
 harvard_dataverse_base_url = "https://dataverse.harvard.edu/api/access/datafile/"
 
+# Manifest with the expected size and checksum of every downloaded file
+manifest_filename = "manifest.json"
 
-async def download(url: str, file_path: str) -> None:
+chunk_size = 1024 * 1024
+
+
+def load_manifest(manifest_path: str) -> dict:
+    """Load the download manifest, or return an empty one if it doesn't exist yet."""
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict, manifest_path: str) -> None:
+    """Save the download manifest, replacing the previous one atomically."""
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def file_sha256(file_path: str) -> str:
+    """Compute the SHA-256 checksum of a file."""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _total_size(response: httpx.Response, offset: int) -> int | None:
+    """Return the size of the complete file from the headers of a (partial) response."""
+    content_range = response.headers.get("Content-Range")
+    if content_range is not None and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        return int(total) if total != "*" else None
+    content_length = response.headers.get("Content-Length")
+    if content_length is not None:
+        return offset + int(content_length)
+    return None
+
+
+async def remote_size(client: httpx.AsyncClient, url: str) -> int | None:
+    """Ask the server for the size of a file by requesting its first byte."""
+    async with client.stream("GET", url, headers={"Range": "bytes=0-0"}) as response:
+        if response.status_code not in (200, 206):
+            return None
+        return _total_size(response, 0)
+
+
+async def download(
+    client: httpx.AsyncClient,
+    url: str,
+    file_path: str,
+    expected: dict | None = None,
+    retries: int = 3,
+) -> dict | None:
     """Download a file from a URL and save it to the specified path.
 
+    The file is first downloaded to `<file_path>.part`, which is resumed with an HTTP Range
+    request if it already exists, and only moved to `file_path` once it is complete.
+
     Args:
+        client (httpx.AsyncClient): The client to download the file with.
         url (str): URL to download the file from.
         file_path (str): Path to save the downloaded file.
-    """
+        expected (dict, optional): The manifest entry with the expected `size` and `sha256`.
+        retries (int): Number of times to resume the download after a network error.
 
+    Returns:
+        dict | None: The manifest entry of the downloaded file, or None if the download failed.
+    """
     folder, filename = os.path.split(file_path)
+    part_path = file_path + ".part"
 
     # Create folder if it doesn't exist
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+    os.makedirs(folder, exist_ok=True)
 
-    # Check if file already exists
+    # Check if file already exists, files downloaded without a manifest entry may be partial
     if os.path.exists(file_path):
-        print(f"File already exists: {file_path}")
-        return
-
-    async with httpx.AsyncClient() as client:
-        print(f"Downloading {url}")
-        async with client.stream("GET", url, follow_redirects=True) as response:
-            if response.status_code == 200:
-                total_size = int(response.headers.get("Content-Length", 0))
-                with open(file_path, "wb") as f:
-                    with async_tqdm(
-                        total=total_size,
-                        unit="B",
-                        unit_scale=True,
-                        unit_divisor=1024,
-                        desc=filename,
-                    ) as pbar:
-                        async for chunk in response.aiter_bytes(chunk_size=1024):
-                            f.write(chunk)
-                            pbar.update(len(chunk))
-            else:
-                print(f"Failed to download: {response.status_code}")
-                return
-
-
-async def download_all() -> None:
-    """Download all files from each dataset."""
+        size = os.path.getsize(file_path)
+        if expected is not None and expected.get("size") == size:
+            if expected.get("sha256") in (None, file_sha256(file_path)):
+                print(f"File already exists: {file_path}")
+                return expected
+            # a corrupt file can't be resumed, download it again from the start
+            print(f"Checksum mismatch for existing file: {file_path}")
+            os.remove(file_path)
+        elif expected is None and size == await remote_size(client, url):
+            print(f"File already exists: {file_path}")
+            return {"size": size, "sha256": file_sha256(file_path)}
+        else:
+            print(f"Resuming incomplete file: {file_path}")
+            os.replace(file_path, part_path)
+
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+        try:
+            print(f"Downloading {url}" + (f" from byte {offset}" if offset else ""))
+            async with client.stream("GET", url, headers=headers) as response:
+                if response.status_code == 416:
+                    # the range starts at the end of the remote file, so the partial file is
+                    # complete, unless it's a stale leftover of another size
+                    total_size = _total_size(response, offset)
+                    if total_size != offset:
+                        print(
+                            f"Partial file {part_path} has {offset} bytes, but the remote "
+                            f"file has {total_size}, restarting the download"
+                        )
+                        os.remove(part_path)
+                        continue
+                elif response.status_code in (200, 206):
+                    if response.status_code == 200:
+                        # the server ignored the Range header and sends the whole file
+                        offset = 0
+                    total_size = _total_size(response, offset)
+                    with open(part_path, "ab" if offset else "wb") as f:
+                        with async_tqdm(
+                            total=total_size,
+                            initial=offset,
+                            unit="B",
+                            unit_scale=True,
+                            unit_divisor=1024,
+                            desc=filename,
+                        ) as pbar:
+                            async for chunk in response.aiter_bytes(
+                                chunk_size=chunk_size
+                            ):
+                                f.write(chunk)
+                                pbar.update(len(chunk))
+                else:
+                    print(f"Failed to download: {response.status_code}")
+                    return None
+            break
+        except httpx.TransportError as e:
+            if attempt == retries:
+                print(f"Failed to download {url}: {e}")
+                return None
+            print(f"Error downloading {url}, retrying: {e}")
+    else:
+        print(f"Failed to download {url}: the partial file kept being rejected")
+        return None
+
+    size = os.path.getsize(part_path)
+    expected_size = expected["size"] if expected is not None else total_size
+    if expected_size is not None and size != expected_size:
+        print(
+            f"Incomplete download of {url}: expected {expected_size} bytes, got {size}"
+        )
+        return None
+
+    sha256 = file_sha256(part_path)
+    if expected is not None and expected.get("sha256") not in (None, sha256):
+        print(f"Checksum mismatch for {file_path}, removing the downloaded file")
+        os.remove(part_path)
+        return None
+
+    os.replace(part_path, file_path)
+    return {"size": size, "sha256": sha256}
+
+
+async def download_all(
+    datasets: list[dict] = all_datasets,
+    data_dir: str = ".data",
+    base_url: str = harvard_dataverse_base_url,
+    max_concurrency: int = 4,
+) -> None:
+    """Download all files from each dataset.
+
+    The downloads share a single connection pool, and at most `max_concurrency` files are
+    downloaded at the same time. The size and checksum of every completed file are recorded
+    in the manifest inside `data_dir`, and used to verify the files on the next run.
+
+    Args:
+        datasets (list[dict]): The datasets to download, as defined in metadata.py.
+        data_dir (str): Path to the directory to download the datasets to.
+        base_url (str): URL to which the id of each file is appended.
+        max_concurrency (int): Maximum number of files to download concurrently.
+    """
     download_info = [
         (
-            harvard_dataverse_base_url + id,
-            os.path.join(".data", dataset["folder"], fname),
+            base_url + id,
+            os.path.join(data_dir, dataset["folder"], fname),
+            f"{dataset['folder']}/{fname}",
         )
-        for dataset in all_datasets
+        for dataset in datasets
         for id, fname in dataset["ids"]
     ]
-    print(download_info)
-    # Download and extract files concurrently
-    tasks = [download(url, file_path) for url, file_path in download_info]
-    await asyncio.gather(*tasks)
+    os.makedirs(data_dir, exist_ok=True)
+    manifest_path = os.path.join(data_dir, manifest_filename)
+    manifest = load_manifest(manifest_path)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def download_and_record(client, url, file_path, key):
+        async with semaphore:
+            entry = await download(client, url, file_path, manifest.get(key))
+        if entry is not None:
+            manifest[key] = entry
+            save_manifest(manifest, manifest_path)
+        return entry
+
+    limits = httpx.Limits(
+        max_connections=max_concurrency, max_keepalive_connections=max_concurrency
+    )
+    timeout = httpx.Timeout(60.0, connect=30.0)
+    async with httpx.AsyncClient(
+        follow_redirects=True, limits=limits, timeout=timeout
+    ) as client:
+        tasks = [
+            download_and_record(client, url, file_path, key)
+            for url, file_path, key in download_info
+        ]
+        results = await asyncio.gather(*tasks)
+
+    failed = [
+        key for (_, _, key), entry in zip(download_info, results) if entry is None
+    ]
+    if failed:
+        print(f"Failed to download {len(failed)} files: {failed}")
+
+
+# Record of the extracted archives, kept in the folder of each dataset
+extraction_record_filename = ".extracted.json"
+
+# Matches the volumes of a multi-part RAR archive, e.g. "Field Experiment.part2.rar"
+multi_part_pattern = re.compile(r"^(?P<name>.*)\.part(?P<part>\d+)\.rar$")
+
+
+def archive_volumes(file_path: str) -> list[str]:
+    """Return all files belonging to an archive, i.e. every volume of a multi-part RAR archive."""
+    folder, filename = os.path.split(file_path)
+    match = multi_part_pattern.match(filename)
+    if match is None:
+        return [file_path]
+    return sorted(
+        os.path.join(folder, other)
+        for other in os.listdir(folder)
+        if (other_match := multi_part_pattern.match(other))
+        and other_match["name"] == match["name"]
+    )
+
+
+def archive_signature(file_path: str) -> list:
+    """Return the name, size and modification time of every volume of an archive."""
+    return [
+        [os.path.basename(volume), os.path.getsize(volume), os.stat(volume).st_mtime_ns]
+        for volume in archive_volumes(file_path)
+    ]
+
+
+def list_archives(folder: str) -> list[str]:
+    """Return the archives to extract in a folder.
+
+    Some of the archives are multi-part RAR archives. Only the first part (".part1.") is
+    returned, as extracting it extracts the other parts as well.
+    """
+    archives = []
+    for file_name in sorted(os.listdir(folder)):
+        file_path = os.path.join(folder, file_name)
+        if not os.path.isfile(file_path) or not file_name.endswith((".zip", ".rar")):
+            continue
+        match = multi_part_pattern.match(file_name)
+        if match is not None and int(match["part"]) != 1:
+            continue
+        archives.append(file_path)
+    return archives
+
+
+def open_archive(file_path: str) -> zipfile.ZipFile | rarfile.RarFile:
+    """Open a zip or rar archive for reading."""
+    if file_path.endswith(".zip"):
+        return zipfile.ZipFile(file_path, "r")
+    if file_path.endswith(".rar"):
+        return rarfile.RarFile(file_path, "r")
+    raise ValueError(f"Unsupported file format for {file_path}")
+
 
+def extract(file_path: str) -> dict:
+    """Extract the images from a zip or rar archive.
 
-def extract(file_path: str) -> None:
-    """Extract files from a zip or rar archive.
+    Images that already exist with the right size are skipped, and all other images are
+    extracted at once.
 
     Args:
         file_path (str): Path to the archive file.
+
+    Returns:
+        dict: The number of `extracted` and `skipped` images.
     """
-    folder, filename = os.path.split(file_path)
-    # folder = os.path.dirname(file_path)
-    if file_path.endswith(".zip"):
-        with zipfile.ZipFile(file_path, "r") as zip_ref:
-            all_files = zip_ref.namelist()
-            # remove files that are not images
-            images = [
-                file for file in all_files if file.lower().endswith((".jpg", ".jpeg"))
-            ]
-            # Use tqdm to create a progress bar
-            for file in sync_tqdm(images, desc=f"Extracting {filename}", unit="file"):
-                zip_ref.extract(member=file, path=folder)
-    elif file_path.endswith(".rar"):
-        with rarfile.RarFile(file_path, "r") as rar_ref:
-            all_files = rar_ref.namelist()
-            # remove files that are not images
-            images = [
-                file for file in all_files if file.lower().endswith((".jpg", ".jpeg"))
-            ]
-            # Use tqdm to create a progress bar
-            for file in sync_tqdm(images, desc=f"Extracting {filename}", unit="file"):
-                rar_ref.extract(member=file, path=folder)
-    else:
-        print(f"Unsupported file format for {file_path}")
+    folder = os.path.dirname(file_path)
+    with open_archive(file_path) as archive:
+        # only keep the images
+        images = [
+            info
+            for info in archive.infolist()
+            if info.filename.lower().endswith((".jpg", ".jpeg"))
+        ]
+        to_extract = []
+        for info in images:
+            target = os.path.join(folder, info.filename)
+            if os.path.isfile(target) and os.path.getsize(target) == info.file_size:
+                continue
+            to_extract.append(info)
+        if to_extract:
+            archive.extractall(path=folder, members=to_extract)
 
+    return {"extracted": len(to_extract), "skipped": len(images) - len(to_extract)}
 
-def extract_all() -> None:
-    """Extract all files from each dataset."""
-    for dataset in all_datasets:
-        if dataset["folder"] != "bananas-dataset-tanzania":
-            continue
-        folder = os.path.join(".data", dataset["folder"])
-        for file_name in os.listdir(folder):
-            # check that file is a file:
-            file_path = os.path.join(folder, file_name)
-            if not os.path.isfile(file_path):
+
+def extract_all(
+    datasets: list[dict] = all_datasets,
+    data_dir: str = ".data",
+    max_workers: int | None = None,
+) -> None:
+    """Extract all archives from each dataset in parallel.
+
+    Every archive is extracted in its own process. The archives that were extracted are
+    recorded with their size and modification time, so they are skipped on the next run.
+
+    Args:
+        datasets (list[dict]): The datasets to extract, as defined in metadata.py.
+        data_dir (str): Path to the directory containing the datasets.
+        max_workers (int, optional): Number of processes, defaults to the number of CPUs.
+    """
+    records = {}
+    jobs = []
+    for dataset in datasets:
+        folder = os.path.join(data_dir, dataset["folder"])
+        record_path = os.path.join(folder, extraction_record_filename)
+        records[folder] = load_manifest(record_path)
+        for file_path in list_archives(folder):
+            file_name = os.path.basename(file_path)
+            signature = archive_signature(file_path)
+            if records[folder].get(file_name, {}).get("signature") == signature:
+                print(f"Already extracted: {file_path}")
                 continue
-            # Some of the archives are multi-part RAR archives. So if the
-            # file contains the substring ".part2.", ".part3.", etc. skip it.
-            # But don't skip ".part1.", unarchiving it will unarchive the
-            # other parts as well.
-            if ".part" in file_name and not ".part1." in file_name:
-                print(f"Skipping {file_name}")
+            jobs.append((folder, file_path, signature))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(extract, file_path): (folder, file_path, signature)
+            for folder, file_path, signature in jobs
+        }
+        for future in sync_tqdm(
+            as_completed(futures), total=len(futures), desc="Extracting", unit="archive"
+        ):
+            folder, file_path, signature = futures[future]
+            try:
+                counts = future.result()
+            except Exception as e:
+                print(f"Error extracting {file_path}: {e}")
                 continue
-            extract(file_path)
+            print(
+                f"Extracted {counts['extracted']} images from {file_path}, skipped {counts['skipped']}"
+            )
+            records[folder][os.path.basename(file_path)] = {
+                "signature": signature,
+                **counts,
+            }
+            save_manifest(
+                records[folder], os.path.join(folder, extraction_record_filename)
+            )
 
 
 def delete_archives() -> None:
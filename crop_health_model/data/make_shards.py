@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from crop_health_model.datasets.shards import ShardWriter, write_shard_index
+from crop_health_model.datasets.split import annotations_split, load_split
+
+
+def make_shards(
+    data_dir: str = ".data",
+    annotations_file: str = "annotations.csv",
+    output_dir: str = os.path.join(".data", "shards"),
+    data_split: tuple = (0.8, 0.2),
+    samples_per_shard: int = 1000,
+    seed: int = 42,
+    limit: int | None = None,
+    split_file: str | None = None,
+) -> None:
+    """Pack the annotated images into tar shards for each of the train, val and test splits.
+
+    The split is the stratified split of `CropHealthDataModule`. The samples of every split
+    are written in the order of a random permutation, so that every shard contains a mix of
+    all datasets and classes.
+
+    Args:
+        data_dir (str): Path to the directory containing the images and annotations file.
+        annotations_file (str): Filename of the annotations file inside `data_dir`.
+        output_dir (str): Path to the directory to write the shards to.
+        data_split (tuple): The data split, as in `CropHealthDataModule`.
+        samples_per_shard (int): The maximum number of samples in a shard.
+        seed (int): Seed of the data split and of the order of the samples.
+        limit (int, optional): Use only the first `limit` rows of the annotations file.
+        split_file (str, optional): Pack the data split saved in this directory, such as the
+            `split` directory of a training run, instead of making a new split.
+    """
+    df = pd.read_csv(os.path.join(data_dir, annotations_file))
+    if limit:
+        df = df[:limit]
+
+    splits = {}
+    if split_file is not None:
+        split_by_name = load_split(split_file, num_samples=len(df))
+    else:
+        split_by_name = annotations_split(
+            df["label"], df["crop_type"], data_split, seed
+        )
+    rng = np.random.default_rng(seed)
+    for split, indices in split_by_name.items():
+        indices = rng.permutation(indices)
+        writer = ShardWriter(output_dir, split, len(indices), samples_per_shard)
+        rows = df.iloc[indices].itertuples(index=False)
+        for position, row in enumerate(
+            tqdm(rows, total=len(indices), desc=f"Packing {split} shards")
+        ):
+            with open(os.path.join(data_dir, row.image), "rb") as f:
+                image = f.read()
+            annotations = {
+                "image": row.image,
+                "width": int(row.width),
+                "height": int(row.height),
+                "label": row.label,
+                "crop_type": row.crop_type,
+            }
+            writer.write(position, image, annotations)
+        splits[split] = writer.close()
+        print(f"Wrote {len(indices)} {split} samples to {writer.num_shards} shards")
+
+    write_shard_index(
+        output_dir, splits, df["label"].tolist(), df["crop_type"].tolist()
+    )
+
+
+if __name__ == "__main__":
+    make_shards()
@@ -0,0 +1,222 @@
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+from tqdm import tqdm
+
+from crop_health_model.data.make_annotations_file import identify_classes
+from crop_health_model.data.make_dataset import list_archives, open_archive
+from crop_health_model.data.metadata import all_datasets
+from crop_health_model.datasets.dataset import draft_scale
+from crop_health_model.datasets.shards import ShardWriter, write_shard_index
+from crop_health_model.datasets.split import annotations_split
+
+keywords_to_avoid = ["MACOSX"]
+
+
+def list_samples(datasets: list[dict], data_dir: str) -> list[dict]:
+    """List the labelled images of all archives, without extracting them.
+
+    The label of an image is identified from the directory it has inside the archive, as in
+    make_annotations_file.py. Images without a single identified class are skipped.
+
+    Args:
+        datasets (list[dict]): The datasets to list, as defined in metadata.py.
+        data_dir (str): Path to the directory containing the downloaded archives.
+
+    Returns:
+        list[dict]: The `archive`, `member`, `image`, `label` and `crop_type` of every image.
+    """
+    samples = []
+    for dataset in datasets:
+        folder = os.path.join(data_dir, dataset["folder"])
+        for file_path in list_archives(folder):
+            with open_archive(file_path) as archive:
+                members = [
+                    info.filename
+                    for info in archive.infolist()
+                    if info.filename.lower().endswith((".jpg", ".jpeg"))
+                ]
+            for member in members:
+                # the path the image would have after extracting the archive
+                image = os.path.join(dataset["folder"], member)
+                root = os.path.dirname(image)
+                if any(keyword in root for keyword in keywords_to_avoid):
+                    continue
+                classes = identify_classes(root, dataset["classes"])
+                if len(classes) != 1:
+                    print(f"Could not identify a single class for {image}: {classes}")
+                    continue
+                samples.append(
+                    {
+                        "archive": file_path,
+                        "member": member,
+                        "image": image,
+                        "label": classes[0],
+                        "crop_type": dataset["crop_type"],
+                    }
+                )
+    return samples
+
+
+def preprocess_image(
+    data: bytes, size: int, quality: int = 90
+) -> tuple[bytes, int, int]:
+    """Decode an image, resize its short side to `size` pixels and encode it as JPEG.
+
+    Images smaller than `size` are not upscaled. Raises an `OSError` if the image can't be
+    decoded, including truncated images.
+
+    Returns:
+        tuple[bytes, int, int]: The encoded image, its width and its height.
+    """
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    scale = draft_scale(width, height, size)
+    if scale > 1:
+        # let the JPEG decoder downscale in the DCT domain first
+        image.draft("RGB", (width // scale, height // scale))
+    image = image.convert("RGB")
+    width, height = image.size
+    if min(width, height) > size:
+        if width < height:
+            width, height = size, round(height * size / width)
+        else:
+            width, height = round(width * size / height), size
+        image = image.resize((width, height), Image.BILINEAR)
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality)
+    return output.getvalue(), width, height
+
+
+def preprocess_archive(
+    file_path: str, members: dict[str, int], size: int
+) -> list[tuple[int, bytes | None, int, int]]:
+    """Read and preprocess the given image members of an archive.
+
+    Args:
+        file_path (str): Path to the archive file.
+        members (dict[str, int]): Maps the member names to their sample index.
+        size (int): Size of the short side of the preprocessed images.
+
+    Returns:
+        list[tuple[int, bytes | None, int, int]]: The sample index, encoded image, width and
+            height of every member. The image is None if it is invalid.
+    """
+    results = []
+    with open_archive(file_path) as archive:
+        # read the members in archive order, which is fast for solid archives as well
+        for info in archive.infolist():
+            if info.filename not in members:
+                continue
+            idx = members[info.filename]
+            try:
+                image, width, height = preprocess_image(archive.read(info), size)
+            except OSError as e:
+                print(f"Error preprocessing image: {info.filename} in {file_path}, {e}")
+                results.append((idx, None, 0, 0))
+                continue
+            results.append((idx, image, width, height))
+    return results
+
+
+def make_shards_from_archives(
+    datasets: list[dict] = all_datasets,
+    data_dir: str = ".data",
+    output_dir: str = os.path.join(".data", "shards"),
+    size: int = 256,
+    data_split: tuple = (0.8, 0.2),
+    samples_per_shard: int = 1000,
+    seed: int = 42,
+    max_workers: int | None = None,
+) -> None:
+    """Preprocess the images straight from the downloaded archives into tar shards.
+
+    This replaces extracting the archives, generating the annotations file and running
+    make_shards.py: the images are read from the archives, validated, resized to a short
+    side of `size` pixels and written to the shards of their split, without writing the
+    original images to disk. Every archive is preprocessed in its own process.
+
+    Args:
+        datasets (list[dict]): The datasets to preprocess, as defined in metadata.py.
+        data_dir (str): Path to the directory containing the downloaded archives.
+        output_dir (str): Path to the directory to write the shards to.
+        size (int): Size of the short side of the preprocessed images.
+        data_split (tuple): The data split, as in `CropHealthDataModule`.
+        samples_per_shard (int): The maximum number of samples in a shard.
+        seed (int): Seed of the data split.
+        max_workers (int, optional): Number of processes, defaults to the number of CPUs.
+    """
+    samples = list_samples(datasets, data_dir)
+    print(f"Found {len(samples)} images in the archives")
+
+    # The split and position of every sample are fixed before reading the images, so the
+    # samples can be written to the shards in the order the archives are read. The split is
+    # stratified like the one of `CropHealthDataModule`, and the samples of every split are
+    # placed in the order of a random permutation, so that every shard mixes all classes
+    writers = {}
+    positions = {}
+    split_by_name = annotations_split(
+        pd.Series([sample["label"] for sample in samples]),
+        pd.Series([sample["crop_type"] for sample in samples]),
+        data_split,
+        seed,
+    )
+    rng = np.random.default_rng(seed)
+    for split, indices in split_by_name.items():
+        indices = rng.permutation(indices)
+        writers[split] = ShardWriter(output_dir, split, len(indices), samples_per_shard)
+        for position, idx in enumerate(indices):
+            positions[int(idx)] = (split, position)
+
+    jobs = {}
+    for idx, sample in enumerate(samples):
+        jobs.setdefault(sample["archive"], {})[sample["member"]] = idx
+
+    valid = [False] * len(samples)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(preprocess_archive, file_path, members, size): file_path
+            for file_path, members in jobs.items()
+        }
+        for future in tqdm(
+            as_completed(futures),
+            total=len(futures),
+            desc="Preprocessing",
+            unit="archive",
+        ):
+            for idx, image, width, height in future.result():
+                if image is None:
+                    continue
+                sample = samples[idx]
+                split, position = positions[idx]
+                annotations = {
+                    "image": sample["image"],
+                    "width": width,
+                    "height": height,
+                    "label": sample["label"],
+                    "crop_type": sample["crop_type"],
+                }
+                writers[split].write(position, image, annotations)
+                valid[idx] = True
+
+    splits = {}
+    for split, writer in writers.items():
+        splits[split] = writer.close()
+        count = sum(shard["count"] for shard in splits[split]["shards"])
+        print(f"Wrote {count} {split} samples to {len(splits[split]['shards'])} shards")
+    print(f"Skipped {valid.count(False)} invalid images")
+
+    write_shard_index(
+        output_dir,
+        splits,
+        [sample["label"] for sample, ok in zip(samples, valid) if ok],
+        [sample["crop_type"] for sample, ok in zip(samples, valid) if ok],
+    )
+
+
+if __name__ == "__main__":
+    make_shards_from_archives()
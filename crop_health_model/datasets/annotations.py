@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+# Columns stored dictionary-encoded in the Arrow annotations file
+CATEGORICAL_COLUMNS = ("label", "crop_type", "dataset")
+
+
+def arrow_path(annotations_file: str) -> str:
+    """Return the path of the Arrow annotations file next to a CSV annotations file."""
+    return os.path.splitext(annotations_file)[0] + ".arrow"
+
+
+def write_annotations_arrow(df: pd.DataFrame, path: str) -> None:
+    """Write the annotations to an uncompressed Arrow (Feather) file.
+
+    The `label`, `crop_type` and `dataset` columns are dictionary-encoded, so they are
+    loaded as integer codes with a small list of categories.
+
+    Args:
+        df (pd.DataFrame): The annotations.
+        path (str): Path of the Arrow file.
+    """
+    if pa is None:
+        raise ImportError(
+            "Writing Arrow annotations files requires pyarrow, install the `arrow` extra "
+            "with `pip install crop-health-model[arrow]`"
+        )
+    df = df.astype(
+        {column: "category" for column in CATEGORICAL_COLUMNS if column in df.columns}
+    )
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # without compression, the file can be memory-mapped when reading it
+    feather.write_feather(table, path, compression="uncompressed")
+
+
+def read_annotations(annotations_file: str) -> pd.DataFrame:
+    """Read the annotations, preferring the Arrow file next to the CSV annotations file.
+
+    The Arrow file is memory-mapped, its dictionary-encoded columns are returned as
+    categorical columns and its string columns remain backed by Arrow. The CSV file is read
+    instead if pyarrow is not installed, or if the Arrow file doesn't exist or is older than
+    the CSV file.
+
+    Args:
+        annotations_file (str): Path to the CSV annotations file.
+    """
+    path = arrow_path(annotations_file)
+    if (
+        pa is not None
+        and os.path.exists(path)
+        and (
+            not os.path.exists(annotations_file)
+            or os.path.getmtime(path) >= os.path.getmtime(annotations_file)
+        )
+    ):
+        table = feather.read_table(path, memory_map=True)
+        return table.to_pandas(
+            types_mapper={pa.string(): pd.ArrowDtype(pa.string())}.get
+        )
+    return pd.read_csv(annotations_file)
+
+
+def encode_strings(values: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    """Encode a column of strings as UTF-8 into a single byte buffer.
+
+    Columns backed by Arrow already store their strings this way, so they are converted
+    without creating any Python strings.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The int64 offsets of the strings in the buffer, with one
+            more offset for the end of the last string, and the uint8 buffer.
+    """
+    if pa is not None and isinstance(values.dtype, pd.ArrowDtype):
+        array = pa.chunked_array(values.array.__arrow_array__()).combine_chunks()
+        array = array.cast(pa.large_string())
+        _, offsets, data = array.buffers()
+        offsets = np.frombuffer(offsets, dtype=np.int64)
+        offsets = offsets[array.offset : array.offset + len(array) + 1]
+        data = np.frombuffer(data, dtype=np.uint8)[offsets[0] : offsets[-1]]
+        return offsets - offsets[0], data
+
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
@@ -0,0 +1,229 @@
+import json
+import os
+from typing import Callable, Iterable
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+
+
+class MemmapCache:
+    """A cache of a fixed-shape record per image, backed by a memory-mapped array.
+
+    Every record is stored inside a single `.npy` file. A JSON index next to it maps the
+    `image` column of the annotations file to the record number, and stores the transform
+    that was used to build the cache, the shape of the records and the metadata of the
+    subclasses. The cache is rebuilt by `load_or_build` when any of them changes.
+    """
+
+    description = "Cache"
+
+    def __init__(self, path: str) -> None:
+        """
+        Args:
+            path (str): Path to the `.npy` file of the cache.
+        """
+        self.path = path
+        with open(self.index_path(path), "r") as f:
+            index = json.load(f)
+        self.images = index.pop("images")
+        self.transform = index.pop("transform")
+        self.shape = tuple(index.pop("shape"))
+        self.metadata = index
+        self.row_map = {image: row for row, image in enumerate(self.images)}
+        self._array = None
+
+    @staticmethod
+    def index_path(path: str) -> str:
+        """Return the path of the index file belonging to the cache at `path`."""
+        return os.path.splitext(path)[0] + ".json"
+
+    @property
+    def array(self) -> np.ndarray:
+        """The memory-mapped array, opened lazily so that each process maps it itself."""
+        if self._array is None:
+            self._array = np.load(self.path, mmap_mode="r")
+        return self._array
+
+    def __getstate__(self) -> dict:
+        # Never pickle the mapped array, DataLoader workers re-open the file instead
+        state = self.__dict__.copy()
+        state["_array"] = None
+        return state
+
+    def __len__(self) -> int:
+        """Return the number of images in the cache."""
+        return len(self.images)
+
+    def __contains__(self, image: str) -> bool:
+        return image in self.row_map
+
+    def matches(self, images: list[str], transform: Callable) -> bool:
+        """Check whether the cache was built for the given images and transform."""
+        return self.images == images and self.transform == repr(transform)
+
+    @classmethod
+    def _load_fresh(cls, path: str, *args) -> "MemmapCache | None":
+        """Open the cache at `path` if it exists and `matches(*args)`, else return None."""
+        if os.path.exists(path) and os.path.exists(cls.index_path(path)):
+            cache = cls(path)
+            if cache.matches(*args):
+                return cache
+            print(f"{cls.description} at {path} is stale, rebuilding it")
+        return None
+
+    @classmethod
+    def _write(
+        cls,
+        path: str,
+        batches: Iterable[np.ndarray],
+        dtype: np.dtype,
+        images: list[str],
+        transform: Callable,
+        **metadata,
+    ) -> "MemmapCache":
+        """Write the batches of records of every image to the cache, then open it.
+
+        Args:
+            path (str): Path to the `.npy` file of the cache.
+            batches (Iterable[np.ndarray]): The records of the images, in batches.
+            dtype (np.dtype): The data type of the records.
+            images (list[str]): The `image` column entry of each record.
+            transform (Callable): The transform of the images, saved in the index.
+            **metadata: The other entries of the index.
+
+        Returns:
+            MemmapCache: The newly built cache.
+        """
+        # Write to a temporary file first so that an interrupted build is never picked up
+        tmp_path = path + ".tmp"
+        array = None
+        row = 0
+        for batch in tqdm(
+            batches, desc=f"Building {cls.description.lower()} {path}", unit="batch"
+        ):
+            if array is None:
+                array = open_memmap(
+                    tmp_path,
+                    mode="w+",
+                    dtype=dtype,
+                    shape=(len(images),) + batch.shape[1:],
+                )
+            array[row : row + len(batch)] = batch
+            row += len(batch)
+        shape = array.shape[1:]
+        array.flush()
+        del array
+        os.replace(tmp_path, path)
+
+        with open(cls.index_path(path), "w") as f:
+            json.dump(
+                {
+                    "images": images,
+                    "transform": repr(transform),
+                    "shape": shape,
+                    **metadata,
+                },
+                f,
+            )
+        print(f"{cls.description} with {len(images)} images saved to {path}")
+
+        return cls(path)
+
+
+class ImageCache(MemmapCache):
+    """A cache of pre-decoded, pre-resized images backed by a memory-mapped array.
+
+    Every image is stored as a fixed-shape uint8 (height, width, 3) record, see
+    `MemmapCache`.
+    """
+
+    description = "Image cache"
+
+    def __getitem__(self, image: str) -> Image.Image:
+        """Return the cached image for an entry of the `image` column."""
+        return self.load(self.row_map[image])
+
+    def load(self, row: int) -> Image.Image:
+        """Return the cached image stored in the given record."""
+        return Image.fromarray(self.array[row])
+
+    @classmethod
+    def load_or_build(
+        cls,
+        path: str,
+        dataset: Dataset,
+        images: list[str],
+        transform: Callable,
+        batch_size: int = 64,
+        num_workers: int = 0,
+    ) -> "ImageCache":
+        """Open the cache at `path`, or (re)build it if it is missing or stale."""
+        cache = cls._load_fresh(path, images, transform)
+        if cache is None:
+            cache = cls.build(path, dataset, images, transform, batch_size, num_workers)
+        return cache
+
+    @classmethod
+    def build(
+        cls,
+        path: str,
+        dataset: Dataset,
+        images: list[str],
+        transform: Callable,
+        batch_size: int = 64,
+        num_workers: int = 0,
+    ) -> "ImageCache":
+        """Decode and transform every image of `dataset` once and store it in the cache.
+
+        Args:
+            path (str): Path to the `.npy` file of the cache.
+            dataset (Dataset): Dataset returning untransformed (PIL image, label) pairs.
+            images (list[str]): The `image` column entry of each item of `dataset`.
+            transform (Callable): Deterministic transform producing images of a fixed size.
+            batch_size (int): Number of images written to the cache at once.
+            num_workers (int): Number of DataLoader workers used to decode the images.
+
+        Returns:
+            ImageCache: The newly built cache.
+        """
+        if len(images) != len(dataset):
+            raise ValueError(
+                f"Got {len(images)} image names for a dataset of length {len(dataset)}"
+            )
+
+        builder = _CacheBuilderDataset(dataset, images, transform)
+        # the first image sets the shape that the workers check the other images against
+        builder[0]
+        loader = DataLoader(builder, batch_size=batch_size, num_workers=num_workers)
+        batches = (batch.numpy() for batch in loader)
+        return cls._write(path, batches, np.uint8, images, transform)
+
+
+class _CacheBuilderDataset(Dataset):
+    """Dataset returning the transformed images of another dataset as uint8 arrays."""
+
+    def __init__(
+        self, dataset: Dataset, images: list[str], transform: Callable
+    ) -> None:
+        self.dataset = dataset
+        self.images = images
+        self.transform = transform
+        self.shape = None
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, idx) -> np.ndarray:
+        image, _ = self.dataset[idx]
+        array = np.array(self.transform(image.convert("RGB")), dtype=np.uint8)
+        if self.shape is None:
+            self.shape = array.shape
+        elif array.shape != self.shape:
+            raise ValueError(
+                f"Cached images need a fixed shape, got {array.shape} instead of "
+                f"{self.shape} for {self.images[idx]}"
+            )
+        return array
@@ -1,14 +1,39 @@
 import os
 
 import lightning.pytorch as pl
+import numpy as np
+import pandas as pd
 import torch
-from torch.utils.data import DataLoader, random_split
+from torch.utils.data import DataLoader, Subset
 from torchvision import transforms
 
+from crop_health_model.datasets.annotations import read_annotations
+from crop_health_model.datasets.cache import ImageCache
 from crop_health_model.datasets.dataset import (
+    MULTI_TASK,
     CropHealthDataset,
     TransformWrapperDataset,
 )
+from crop_health_model.datasets.embeddings import EmbeddingCache, EmbeddingDataset
+from crop_health_model.datasets.shards import ShardDataLoader, ShardedCropHealthDataset
+from crop_health_model.datasets.split import (
+    annotations_split,
+    load_split,
+    save_split,
+    split_exists,
+)
+from crop_health_model.datasets.transforms import (
+    BatchTransform,
+    split_batch_transforms,
+)
+
+# The splits every stage evaluates on
+STAGE_SPLITS = {
+    "fit": ("train", "val"),
+    "validate": ("val",),
+    "test": ("test",),
+    "predict": ("test",),
+}
 
 
 class CropHealthDataModule(pl.LightningDataModule):
@@ -23,9 +48,20 @@ class CropHealthDataModule(pl.LightningDataModule):
         data_split: tuple = (0.8, 0.2),
         limit: int | None = None,
         num_workers: int = 8,
+        pin_memory: bool = False,
+        persistent_workers: bool = False,
+        prefetch_factor: int | None = None,
         train_transforms: list[torch.nn.Module] | None = None,
         test_transforms: list[torch.nn.Module] | None = None,
         normalization: transforms.Normalize | None = None,
+        cache_file: str | None = None,
+        shards_dir: str | None = None,
+        shuffle_buffer: int = 1000,
+        decode_size: int | None = None,
+        num_threads: int = 0,
+        uint8_batches: bool = False,
+        split_file: str | None = None,
+        split_seed: int = 42,
     ) -> None:
         super(CropHealthDataModule, self).__init__()
         self.task = task
@@ -35,9 +71,61 @@ class CropHealthDataModule(pl.LightningDataModule):
         self.annotations_file = annotations_file
         self.data_split = data_split
         self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.cache_file = cache_file
+        self.cache_transform = None
+        self.shards_dir = shards_dir
+        self.shuffle_buffer = shuffle_buffer
+        self.decode_size = decode_size
+        self.num_threads = num_threads
+        self.uint8_batches = uint8_batches
+        self.batch_transform = None
+        self.split_file = split_file
+        self.split_seed = split_seed
+        self.split = None
+        self.split_positions = None
+        self.num_samples = None
+
+        if cache_file is not None and shards_dir is not None:
+            raise ValueError("The image cache cannot be used together with shards")
+
+        if shards_dir is not None and persistent_workers:
+            # the shard order of every epoch is set before the workers are started
+            raise ValueError("Persistent workers cannot be used together with shards")
+
+        if cache_file is not None:
+            # The deterministic transforms at the start of both the train and the test
+            # pipelines are applied once when building the image cache, so they are
+            # removed from the per-sample pipelines
+            cache_transforms = self._common_prefix(train_transforms, test_transforms)
+            if not cache_transforms:
+                raise ValueError(
+                    "The image cache requires train and test transforms starting with the same deterministic transforms"
+                )
+            self.cache_transform = transforms.Compose(cache_transforms)
+            train_transforms = train_transforms[len(cache_transforms) :]
+            test_transforms = test_transforms[len(cache_transforms) :]
+
+        to_tensor = transforms.ToTensor()
+        if uint8_batches:
+            # The workers only produce uint8 tensors. The conversion to floats, the
+            # normalization and the random flips at the end of the train transforms are
+            # applied to whole batches by the LitModel instead
+            flips = {}
+            if train_transforms is not None:
+                train_transforms, flips = split_batch_transforms(train_transforms)
+            self.batch_transform = BatchTransform(
+                **flips,
+                mean=normalization.mean if normalization is not None else None,
+                std=normalization.std if normalization is not None else None,
+            )
+            to_tensor = transforms.PILToTensor()
+            normalization = None
 
         if train_transforms is not None:
-            transformations = train_transforms + [transforms.ToTensor()]
+            transformations = train_transforms + [to_tensor]
             if normalization is not None:
                 transformations += [normalization]
             self.train_transform = transforms.Compose(transformations)
@@ -45,7 +133,7 @@ class CropHealthDataModule(pl.LightningDataModule):
             self.train_transform = None
 
         if test_transforms is not None:
-            transformations = test_transforms + [transforms.ToTensor()]
+            transformations = test_transforms + [to_tensor]
             if normalization is not None:
                 transformations += [normalization]
             self.test_transform = transforms.Compose(transformations)
@@ -54,70 +142,259 @@ class CropHealthDataModule(pl.LightningDataModule):
             self.test_transform = None
             self.val_transform = None
 
-    def prepare_data(self) -> None:
-        # assumes data has been downloaded using make_dataset.py
-        # and prepared using make_annotations_file.py
-        pass
+    @staticmethod
+    def _common_prefix(
+        train_transforms: list[torch.nn.Module] | None,
+        test_transforms: list[torch.nn.Module] | None,
+    ) -> list[torch.nn.Module]:
+        """Return the transforms that both pipelines start with."""
+        prefix = []
+        for train_transform, test_transform in zip(
+            train_transforms or [], test_transforms or []
+        ):
+            if repr(train_transform) != repr(test_transform):
+                break
+            prefix.append(test_transform)
+        return prefix
 
-    def setup(self, stage: str | None = None) -> None:
-        self.data = CropHealthDataset(
-            annotations_file=os.path.join(self.data_dir, self.annotations_file),
+    def _read_annotations(self) -> pd.DataFrame:
+        """Read the annotations file, or only its first `limit` rows."""
+        annotations = read_annotations(
+            os.path.join(self.data_dir, self.annotations_file)
+        )
+        return annotations[: self.limit] if self.limit else annotations
+
+    def load_dataset(
+        self,
+        cache: ImageCache | None = None,
+        indices: np.ndarray | None = None,
+        annotations: pd.DataFrame | None = None,
+    ) -> CropHealthDataset:
+        """Load the dataset of all the annotated images, or of the rows at `indices` only.
+
+        Args:
+            cache (ImageCache, optional): Read the images from this image cache instead.
+            indices (np.ndarray, optional): The rows of the annotations to load.
+            annotations (pd.DataFrame, optional): The annotations, if they were already read.
+        """
+        return CropHealthDataset(
+            annotations_file=(
+                annotations
+                if annotations is not None
+                else os.path.join(self.data_dir, self.annotations_file)
+            ),
             img_dir=self.data_dir,
             task=self.task,
             transform=None,  # apply transforms later
             limit=self.limit,
+            cache=cache,
+            decode_size=self.decode_size,
+            indices=indices,
         )
 
-        # Split dataset into train and test sets
-        train_data, test_data = random_split(self.data, self.data_split)
+    def prepare_data(self) -> None:
+        # assumes data has been downloaded using make_dataset.py
+        # and prepared using make_annotations_file.py
+        if self.cache_file is not None:
+            # decode every image once into the image cache (skipped if it is up to date)
+            data = self.load_dataset()
+            ImageCache.load_or_build(
+                path=os.path.join(self.data_dir, self.cache_file),
+                dataset=data,
+                images=data.data_df["image"].tolist(),
+                transform=self.cache_transform,
+                batch_size=self.batch_size,
+                num_workers=self.num_workers,
+            )
+
+    def setup(self, stage: str | None = None) -> None:
+        if self.shards_dir is not None:
+            self._setup_shards(stage)
+            return
 
-        # Split train dataset into train and validation sets
-        train_data, val_data = random_split(train_data, self.data_split)
+        annotations = self._read_annotations()
+        self.num_samples = len(annotations)
+        self.split = self._data_split(annotations)
 
-        # Wrap datasets with transforms
-        train_data = TransformWrapperDataset(train_data, transform=self.train_transform)
-        val_data = TransformWrapperDataset(val_data, transform=self.val_transform)
-        test_data = TransformWrapperDataset(test_data, transform=self.test_transform)
+        # Only the rows of the splits of the stage are loaded and indexed, one split after
+        # the other, and every split is a range of positions in the dataset
+        splits = STAGE_SPLITS[stage or "fit"]
+        self.split_positions = {}
+        offset = 0
+        for split in splits:
+            num_split_samples = len(self.split[split])
+            self.split_positions[split] = np.arange(offset, offset + num_split_samples)
+            offset += num_split_samples
+
+        cache = None
+        if self.cache_file is not None:
+            cache = ImageCache(os.path.join(self.data_dir, self.cache_file))
+        self.data = self.load_dataset(
+            cache=cache,
+            indices=np.concatenate([self.split[split] for split in splits]),
+            annotations=annotations,
+        )
+
+        def subset(split, transform):
+            return TransformWrapperDataset(
+                Subset(self.data, self.split_positions[split]),
+                transform=transform,
+                num_threads=self.num_threads,
+            )
 
         # Assign train/val datasets
         if stage == "fit" or stage is None:
-            self.train_data = train_data
-            self.val_data = val_data
+            self.train_data = subset("train", self.train_transform)
+            self.val_data = subset("val", self.val_transform)
 
         # Assign validation dataset
         if stage == "validate":
-            self.val_data = val_data
+            self.val_data = subset("val", self.val_transform)
 
         # Assign test dataset
         if stage == "test":
-            self.test_data = test_data
+            self.test_data = subset("test", self.test_transform)
 
         if stage == "predict":
-            self.predict_data = self.test_data
+            self.predict_data = subset("test", self.test_transform)
 
-    def train_dataloader(self) -> DataLoader:
-        return DataLoader(
-            self.train_data, batch_size=self.batch_size, num_workers=self.num_workers
+    def use_embeddings(self, cache: EmbeddingCache) -> None:
+        """Load the cached backbone features of the images instead of the images.
+
+        The datasets of the stage that was set up last are replaced by the same splits of an
+        `EmbeddingDataset`, without any transforms.
+        """
+        if self.shards_dir is not None:
+            raise ValueError("The embedding cache cannot be used together with shards")
+        embeddings = EmbeddingDataset(cache, self.data)
+        for name, split in [
+            ("train_data", "train"),
+            ("val_data", "val"),
+            ("test_data", "test"),
+            ("predict_data", "test"),
+        ]:
+            if hasattr(self, name) and split in self.split_positions:
+                setattr(
+                    self,
+                    name,
+                    TransformWrapperDataset(
+                        Subset(embeddings, self.split_positions[split])
+                    ),
+                )
+
+    def _data_split(self, annotations: pd.DataFrame) -> dict:
+        """Load the split from `split_file`, or make a new stratified split.
+
+        A new split is stratified by label and crop type, and saved to `split_file` if set.
+
+        Args:
+            annotations (pd.DataFrame): The annotations to split.
+        """
+        if self.split_file is not None and split_exists(self.split_file):
+            return load_split(self.split_file, num_samples=len(annotations))
+
+        split = annotations_split(
+            annotations["label"],
+            annotations["crop_type"],
+            self.data_split,
+            self.split_seed,
         )
+        if self.split_file is not None and (
+            self.trainer is None or self.trainer.is_global_zero
+        ):
+            save_split(split, self.split_file, self.split_meta())
+        return split
 
-    def val_dataloader(self) -> DataLoader:
-        return DataLoader(
-            self.val_data, batch_size=self.batch_size, num_workers=self.num_workers
+    def split_meta(self) -> dict:
+        """Return how the data split is made, saved together with the split."""
+        return {
+            "annotations_file": self.annotations_file,
+            "num_samples": self.num_samples,
+            "data_split": list(self.data_split),
+            "seed": self.split_seed,
+            "stratified_by": ["label", "crop_type"],
+        }
+
+    def _setup_shards(self, stage: str | None = None) -> None:
+        """Stream the splits from the shards written by make_shards.py."""
+        data_dir = os.path.join(self.data_dir, self.shards_dir)
+
+        def sharded_dataset(split, transform, shuffle=False):
+            return ShardedCropHealthDataset(
+                shards_dir=data_dir,
+                split=split,
+                task=self.task,
+                transform=transform,
+                shuffle=shuffle,
+                shuffle_buffer=self.shuffle_buffer,
+                decode_size=self.decode_size,
+            )
+
+        # the training split provides the class map
+        self.data = sharded_dataset("train", self.train_transform, shuffle=True)
+
+        if stage == "fit" or stage is None:
+            self.train_data = self.data
+            self.val_data = sharded_dataset("val", self.val_transform)
+
+        if stage == "validate":
+            self.val_data = sharded_dataset("val", self.val_transform)
+
+        if stage == "test":
+            self.test_data = sharded_dataset("test", self.test_transform)
+
+        if stage == "predict":
+            self.predict_data = sharded_dataset("test", self.test_transform)
+
+    def _dataloader(self, dataset, shuffle: bool = False) -> DataLoader:
+        # the sharded datasets shuffle their samples themselves
+        loader_kwargs = {}
+        if isinstance(dataset, ShardedCropHealthDataset):
+            loader_class = ShardDataLoader
+        else:
+            loader_class = DataLoader
+            # the indices of a split are sorted, and the annotations are grouped by dataset
+            # and class, so the training samples have to be shuffled
+            loader_kwargs["shuffle"] = shuffle
+        # the worker options are only valid with worker processes
+        if self.num_workers > 0:
+            loader_kwargs["persistent_workers"] = self.persistent_workers
+            loader_kwargs["prefetch_factor"] = self.prefetch_factor
+        return loader_class(
+            dataset,
+            batch_size=self.batch_size,
+            num_workers=self.num_workers,
+            pin_memory=self.pin_memory,
+            **loader_kwargs,
         )
 
+    def train_dataloader(self) -> DataLoader:
+        return self._dataloader(self.train_data, shuffle=True)
+
+    def val_dataloader(self) -> DataLoader:
+        return self._dataloader(self.val_data)
+
     def test_dataloader(self) -> DataLoader:
-        return DataLoader(
-            self.test_data, batch_size=self.batch_size, num_workers=self.num_workers
-        )
+        return self._dataloader(self.test_data)
 
     def predict_dataloader(self) -> DataLoader:
-        return DataLoader(
-            self.predict_data, batch_size=self.batch_size, num_workers=self.num_workers
-        )
+        return self._dataloader(self.predict_data)
+
+    def compute_class_weights(self) -> torch.Tensor | dict[str, torch.Tensor]:
+        """Compute class weights for imbalanced datasets.
 
-    def compute_class_weights(self) -> torch.Tensor:
-        """Compute class weights for imbalanced datasets."""
+        With the `multi-task` task, the class weights of every task are returned in a dict.
+        """
         class_counts = self.train_data.get_class_counts()
+        if self.task == MULTI_TASK:
+            return {
+                task: self._class_weights(counts)
+                for task, counts in class_counts.items()
+            }
+        return self._class_weights(class_counts)
+
+    @staticmethod
+    def _class_weights(class_counts: dict) -> torch.Tensor:
         n_samples = sum(class_counts.values())
         n_classes = len(class_counts)
 
@@ -1,92 +1,378 @@
 import os
-from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Callable, Sequence
 
+import numpy as np
 import pandas as pd
+import torch
 from PIL import Image
 from torch.utils.data import Dataset, Subset
 
+from crop_health_model.datasets.annotations import encode_strings, read_annotations
+from crop_health_model.datasets.cache import ImageCache
 
-class CropHealthDataset(Dataset):
+TASKS = ("binary", "single-HLT", "multi-HLT")
+# Task providing the labels of all TASKS at once, for models with one head per task
+MULTI_TASK = "multi-task"
+
+
+def task_labels(labels: pd.Series, crop_types: pd.Series, task: str) -> pd.Series:
+    """Map the labels of the annotations file to the labels of the given task.
+
+    Args:
+        labels (pd.Series): The `label` column of the annotations file.
+        crop_types (pd.Series): The `crop_type` column of the annotations file.
+        task (str): One of `binary`, `single-HLT` or `multi-HLT`.
+
+    Returns:
+        pd.Series: The labels for the task.
+    """
+    match task:
+        case "binary":
+            # binary classification with one healthy (HLT) class and one sick (NOT_HLT) class
+            # map all non "HLT" classes to "NOT_HLT"
+            return labels.where(labels == "HLT", "NOT_HLT")
+        case "single-HLT":
+            # keep everything as is, i.e., several sick classes and one healthy class
+            return labels
+        case "multi-HLT":
+            # multiple healthy classes (one for each crop type) and multiple sick classes
+            # combine "label" with "crop_type" to create a new label
+            return labels + "_" + crop_types
+        case _:
+            raise ValueError(f"Invalid task: {task}")
+
+
+def draft_scale(width: int, height: int, decode_size: int) -> int:
+    """Return the largest JPEG DCT scale (1, 2, 4 or 8) keeping the short side at least `decode_size`."""
+    scale = 1
+    while scale < 8 and min(width, height) // (scale * 2) >= decode_size:
+        scale *= 2
+    return scale
+
+
+def task_codes(
+    label_codes: np.ndarray,
+    label_names: Sequence[str],
+    crop_type_codes: np.ndarray,
+    crop_type_names: Sequence[str],
+    task: str,
+) -> tuple[np.ndarray, list[str]]:
+    """Compute the labels of the given task from the integer codes of the annotations.
+
+    This is the equivalent of `task_labels` followed by `task_class_map`, without any string
+    operations on the individual samples.
+
+    Args:
+        label_codes (np.ndarray): Codes of the `label` column in order of first appearance,
+            as returned by `pd.factorize`.
+        label_names (Sequence[str]): The label of each label code.
+        crop_type_codes (np.ndarray): Codes of the `crop_type` column in order of first
+            appearance.
+        crop_type_names (Sequence[str]): The crop type of each crop type code.
+        task (str): One of `binary`, `single-HLT` or `multi-HLT`.
+
+    Returns:
+        tuple[np.ndarray, list[str]]: The class index of every sample, and the class names in
+            order of first appearance.
+    """
+    match task:
+        case "binary":
+            names = np.where(np.asarray(label_names) == "HLT", "HLT", "NOT_HLT")
+            name_codes, classes = pd.factorize(names)
+            return name_codes[label_codes], list(classes)
+        case "single-HLT":
+            return np.asarray(label_codes), list(label_names)
+        case "multi-HLT":
+            num_crop_types = len(crop_type_names)
+            combined = np.asarray(label_codes, dtype=np.int64) * num_crop_types
+            codes, uniques = pd.factorize(combined + crop_type_codes)
+            classes = [
+                f"{label_names[unique // num_crop_types]}_{crop_type_names[unique % num_crop_types]}"
+                for unique in uniques
+            ]
+            return codes, classes
+        case _:
+            raise ValueError(f"Invalid task: {task}")
+
+
+def task_class_map(labels: pd.Series) -> dict:
+    """Map each distinct label to an integer, in order of first appearance."""
+    return {label: idx for idx, label in enumerate(labels.unique())}
+
+
+class SampleIndex:
+    """A compact, read-only index of the image paths, sizes and labels of the dataset.
+
+    The image paths are stored in a single contiguous byte buffer with offsets, and the labels
+    of every task as int16 arrays. Looking up a sample therefore doesn't touch any Python objects,
+    so the memory pages of the index stay shared between forked DataLoader workers.
+    """
+
+    def __init__(
+        self,
+        images: Sequence[str],
+        widths: Sequence[int],
+        heights: Sequence[int],
+        labels: pd.Series,
+        crop_types: pd.Series,
+        indices: Sequence[int] | None = None,
+    ) -> None:
+        """
+        Args:
+            images (Sequence[str]): The `image` column of the annotations file.
+            widths (Sequence[int]): The `width` column of the annotations file.
+            heights (Sequence[int]): The `height` column of the annotations file.
+            labels (pd.Series): The `label` column of the annotations file, possibly categorical.
+            crop_types (pd.Series): The `crop_type` column of the annotations file, possibly
+                categorical.
+            indices (Sequence[int], optional): Index only the rows at these positions. The
+                class maps are still those of all the rows, so they are the same for every
+                subset of the annotations.
+        """
+        images = pd.Series(images)
+        widths = np.asarray(widths, dtype=np.int32)
+        heights = np.asarray(heights, dtype=np.int32)
+        if indices is not None:
+            indices = np.asarray(indices, dtype=np.int64)
+            images, widths, heights = (
+                images.iloc[indices],
+                widths[indices],
+                heights[indices],
+            )
+        self.offsets, self.paths = encode_strings(images)
+        self.widths = widths
+        self.heights = heights
+
+        # The labels of every task are computed from the integer codes of the labels and crop
+        # types, which are cheap to get from categorical columns
+        label_codes, label_names = pd.factorize(labels)
+        crop_type_codes, crop_type_names = pd.factorize(crop_types)
+        self.class_maps = {}
+        self.labels = {}
+        for task in TASKS:
+            codes, classes = task_codes(
+                label_codes, label_names, crop_type_codes, crop_type_names, task
+            )
+            self.class_maps[task] = {name: idx for idx, name in enumerate(classes)}
+            if indices is not None:
+                codes = codes[indices]
+            self.labels[task] = codes.astype(np.int16)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def path(self, idx: int) -> str:
+        """Return the image path of the sample at the given index."""
+        return self.paths[self.offsets[idx] : self.offsets[idx + 1]].tobytes().decode()
+
+    def class_counts(self, task: str, indices: Sequence[int] | None = None) -> dict:
+        """Return the counts of each class as a mapping from class index to count.
+
+        Args:
+            task (str): The task determining the classes.
+            indices (Sequence[int], optional): Count only the samples at these indices.
+        """
+        labels = self.labels[task]
+        if indices is not None:
+            labels = labels[np.asarray(indices, dtype=np.int64)]
+        counts = np.bincount(labels, minlength=len(self.class_maps[task]))
+        return {idx: int(count) for idx, count in enumerate(counts) if count > 0}
+
+
+class ThreadedBatchMixin:
+    """Mixin adding a `__getitems__` that loads the samples of a batch on a thread pool.
+
+    The DataLoader calls `__getitems__` with all indices of a batch. Since PIL releases the GIL
+    while decoding and resizing, the samples are then loaded concurrently by `num_threads`
+    threads. Each process creates its own pool, as threads don't survive forking a worker.
+    """
+
+    num_threads: int = 0
+    _pool: ThreadPoolExecutor | None = None
+    _pool_pid: int | None = None
+
+    def _thread_pool(self) -> ThreadPoolExecutor:
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.num_threads)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def __getitems__(self, indices: list[int]) -> list[tuple]:
+        """Return the samples at the given indices, ready to be collated."""
+        if self.num_threads <= 1:
+            return [self[idx] for idx in indices]
+        return list(self._thread_pool().map(self.__getitem__, indices))
+
+    def __getstate__(self) -> dict:
+        # thread pools can't be pickled, each DataLoader worker creates its own
+        state = self.__dict__.copy()
+        state.pop("_pool", None)
+        state.pop("_pool_pid", None)
+        return state
+
+
+class CropHealthDataset(ThreadedBatchMixin, Dataset):
     """A dataset for the Crop Health dataset."""
 
     def __init__(
         self,
-        annotations_file: str,
+        annotations_file: str | pd.DataFrame,
         img_dir: str,
         task: str,
         transform: Callable | None = None,
         target_transform: Callable | None = None,
         limit: int | None = None,
+        cache: ImageCache | None = None,
+        decode_size: int | None = None,
+        num_threads: int = 0,
+        indices: Sequence[int] | None = None,
     ) -> None:
-        self.data_df = pd.read_csv(annotations_file)
+        """
+        Args:
+            annotations_file (str | pd.DataFrame): Path to the annotations file, or the
+                annotations already read from it. The Arrow annotations file next to it is
+                loaded instead if it is up to date.
+            img_dir (str): Path to the directory containing the images.
+            task (str): One of `binary`, `single-HLT`, `multi-HLT` or `multi-task`. With
+                `multi-task`, the label of a sample is a tensor with its label for each of
+                the other tasks, in the order of `TASKS`.
+            transform (Callable, optional): Transform to apply to the images.
+            target_transform (Callable, optional): Transform to apply to the labels.
+            limit (int, optional): Use only the first `limit` rows of the annotations file.
+            cache (ImageCache, optional): Read the images from this image cache instead.
+            decode_size (int, optional): Decode JPEG images at a reduced resolution, as long
+                as their short side stays at least `decode_size` pixels.
+            num_threads (int): Number of threads loading the samples of a batch concurrently.
+            indices (Sequence[int], optional): Use only the rows at these positions, after
+                `limit`, such as the indices of a split. The class maps remain those of all
+                the rows.
+        """
+        if isinstance(annotations_file, pd.DataFrame):
+            self.data_df = annotations_file
+        else:
+            self.data_df = read_annotations(annotations_file)
         self.img_dir = img_dir
         self.transform = transform
         self.target_transform = target_transform
+        self.task = task
+        self.cache = cache
+        self.decode_size = decode_size
+        self.num_threads = num_threads
+
+        if task not in TASKS + (MULTI_TASK,):
+            raise ValueError(f"Invalid task: {task}")
 
         # if limit is not None, use only the first `limit` rows
         if limit:
             self.data_df = self.data_df[:limit]
             print(f"Using only {limit} rows")
 
-        match task:
-            case "binary":
-                # binary classification with one healthy (HLT) class and one sick (NOT_HLT) class
-                # map all non "HLT" classes to "NOT_HLT"
-                mask = self.data_df["label"] != "HLT"
-                self.data_df.loc[mask, "label"] = "NOT_HLT"
-            case "single-HLT":
-                # keep everything as is, i.e., several sick classes and one healthy class
-                pass
-            case "multi-HLT":
-                # multiple healthy classes (one for each crop type) and multiple sick classes
-                # combine "label" with "crop_type" to create a new label
-                self.data_df["label"] = (
-                    self.data_df["label"] + "_" + self.data_df["crop_type"]
-                )
-            case _:
-                raise ValueError(f"Invalid task: {task}")
-
-        # print number of distinct classes
-        print(f"Number of distinct classes: {len(self.data_df['label'].unique())}")
-
-        # Define a mapping from the class labels to integers using the unique method from pandas
-        self.class_map = {
-            label: idx for idx, label in enumerate(self.data_df["label"].unique())
-        }
+        # Build the index used to look up samples, with the labels of every task
+        self.index = SampleIndex(
+            images=self.data_df["image"],
+            widths=self.data_df["width"],
+            heights=self.data_df["height"],
+            labels=self.data_df["label"],
+            crop_types=self.data_df["crop_type"],
+            indices=indices,
+        )
+        if indices is not None:
+            self.data_df = self.data_df.iloc[np.asarray(indices, dtype=np.int64)]
+            self.data_df = self.data_df.reset_index(drop=True)
+        if task == MULTI_TASK:
+            # one column of labels and one class map per task
+            self.labels = np.stack([self.index.labels[t] for t in TASKS], axis=1)
+            self.class_map = {t: self.index.class_maps[t] for t in TASKS}
+            for t in TASKS:
+                print(f"Number of distinct {t} classes: {len(self.class_map[t])}")
+        else:
+            self.labels = self.index.labels[task]
+
+            # Define a mapping from the class labels to integers in order of first appearance
+            self.class_map = self.index.class_maps[task]
+
+            # print number of distinct classes
+            print(f"Number of distinct classes: {len(self.class_map)}")
+
+        # Map each sample to its record in the image cache
+        if cache is not None:
+            self.cache_rows = np.asarray(
+                [cache.row_map[image] for image in self.data_df["image"]],
+                dtype=np.int64,
+            )
 
     def __len__(self) -> int:
         """Return the number of images in the dataset."""
-        return len(self.data_df)
+        return len(self.index)
 
     def __getitem__(self, idx) -> tuple:
         """Return the image and its label at the given index."""
-        row = self.data_df.iloc[idx]
-        img_path = os.path.join(self.img_dir, row["image"])
-        # open image with PIL
-        image = Image.open(img_path)
-        label_name = row["label"]
-        label = self.class_map[label_name]
+        if self.cache is not None:
+            # read the pre-decoded image from the memory-mapped cache
+            image = self.cache.load(self.cache_rows[idx])
+        else:
+            image = self.open_image(idx)
+        label = self.label(idx)
         if self.transform:
             image = self.transform(image)
         if self.target_transform:
             label = self.target_transform(label)
         return image, label
 
-    def get_class_counts(self) -> dict:
-        """Return the counts of each class in the dataset as a mapping from class index to count."""
-        return self.data_df["label"].map(self.class_map).value_counts().to_dict()
+    def label(self, idx: int) -> int | torch.Tensor:
+        """Return the label of the sample at the given index, a tensor with `multi-task`."""
+        if self.task == MULTI_TASK:
+            return torch.from_numpy(self.labels[idx].astype(np.int64))
+        return int(self.labels[idx])
+
+    def open_image(self, idx: int, fp: IO[bytes] | None = None) -> Image.Image:
+        """Open the image at the given index with PIL, which decodes it lazily.
+
+        Args:
+            idx (int): Index of the sample.
+            fp (IO[bytes], optional): A file object with the content of the image file, which
+                is opened instead of the image path.
+        """
+        if fp is None:
+            fp = os.path.join(self.img_dir, self.index.path(idx))
+        image = Image.open(fp)
+        if self.decode_size is not None:
+            # let the JPEG decoder downscale in the DCT domain, the size of the image
+            # is known from the annotations file
+            width, height = int(self.index.widths[idx]), int(self.index.heights[idx])
+            scale = draft_scale(width, height, self.decode_size)
+            if scale > 1:
+                image.draft(image.mode, (width // scale, height // scale))
+        return image
+
+    def get_class_counts(self, indices: Sequence[int] | None = None) -> dict:
+        """Return the counts of each class in the dataset as a mapping from class index to count.
 
+        With `multi-task`, the counts of every task are returned in a dict by task.
 
-class TransformWrapperDataset(Dataset):
+        Args:
+            indices (Sequence[int], optional): Count only the samples at these indices.
+        """
+        if self.task == MULTI_TASK:
+            return {task: self.index.class_counts(task, indices) for task in TASKS}
+        return self.index.class_counts(self.task, indices)
+
+
+class TransformWrapperDataset(ThreadedBatchMixin, Dataset):
     """A dataset that wraps another dataset and applies a transform to the data.
 
     Useful when performing data splitting on original dataset and then applying transforms
-    on the split datasets.
+    on the split datasets. With `num_threads` set, both the loading and the transform of the
+    samples of a batch run on a thread pool.
     """
 
-    def __init__(self, dataset: Dataset, transform: Callable | None = None) -> None:
+    def __init__(
+        self, dataset: Dataset, transform: Callable | None = None, num_threads: int = 0
+    ) -> None:
         self.dataset = dataset
         self.transform = transform
+        self.num_threads = num_threads
 
     def __len__(self) -> int:
         """Return the number of images in the dataset."""
@@ -102,22 +388,13 @@ class TransformWrapperDataset(Dataset):
     def get_class_counts(self) -> dict:
         """Return the counts of each class in the dataset as a mapping from class index to count."""
         # We need to handle the case where the underlying dataset is a subset of another dataset
-        # or a subset of a subset (of a dataset)
-        if isinstance(self.dataset, Subset):
-            original_dataset = self.dataset.dataset
-            if isinstance(original_dataset, Subset):
-                original_dataset = original_dataset.dataset
-            indices = self.dataset.indices
-
-            # Filter the labels using the subset indices
-            filtered_labels = original_dataset.data_df.iloc[indices]["label"]
-
-            # Compute counts for the filtered labels
-            class_counts = (
-                filtered_labels.map(original_dataset.class_map).value_counts().to_dict()
-            )
-
-        else:
-            class_counts = self.dataset.get_class_counts()
+        # or a subset of a subset (of a dataset), so resolve the indices into the original dataset
+        dataset, indices = self.dataset, None
+        while isinstance(dataset, Subset):
+            subset_indices = np.asarray(dataset.indices, dtype=np.int64)
+            indices = subset_indices if indices is None else subset_indices[indices]
+            dataset = dataset.dataset
 
-        return class_counts
+        if indices is None:
+            return dataset.get_class_counts()
+        return dataset.get_class_counts(indices)
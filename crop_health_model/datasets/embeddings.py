@@ -0,0 +1,153 @@
+import hashlib
+from typing import Callable, Sequence
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from crop_health_model.datasets.cache import MemmapCache
+
+
+def backbone_fingerprint(model: torch.nn.Module, head: torch.nn.Module) -> str:
+    """Return a hash of the weights and buffers of a model, except those of its head.
+
+    Args:
+        model (torch.nn.Module): The model, such as a `ResNet`.
+        head (torch.nn.Module): The classification head of the model, which is excluded.
+    """
+    head_tensors = {id(tensor) for tensor in head.state_dict(keep_vars=True).values()}
+    digest = hashlib.sha256()
+    for name, tensor in model.state_dict(keep_vars=True).items():
+        if id(tensor) in head_tensors:
+            continue
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+class EmbeddingCache(MemmapCache):
+    """A cache of the pooled backbone features of every image, backed by a memory-mapped array.
+
+    The features of every image are stored as a float16 record, see `MemmapCache`. The index
+    also stores the fingerprint of the backbone weights that were used to build the cache.
+    """
+
+    description = "Embedding cache"
+
+    def __init__(self, path: str) -> None:
+        """
+        Args:
+            path (str): Path to the `.npy` file of the cache.
+        """
+        super().__init__(path)
+        self.backbone = self.metadata["backbone"]
+        self.num_features = self.shape[0]
+
+    def load(self, row: int) -> torch.Tensor:
+        """Return the float16 features stored in the given record."""
+        return torch.from_numpy(np.array(self.array[row]))
+
+    def matches(self, images: list[str], transform: Callable, backbone: str) -> bool:
+        """Check whether the cache was built for the given images, transform and backbone."""
+        return super().matches(images, transform) and self.backbone == backbone
+
+    @classmethod
+    def load_or_build(
+        cls,
+        path: str,
+        dataset: Dataset,
+        images: list[str],
+        transform: Callable,
+        encoder: Callable[[torch.Tensor], torch.Tensor],
+        backbone: str,
+        batch_size: int = 64,
+        num_workers: int = 0,
+    ) -> "EmbeddingCache":
+        """Open the cache at `path`, or (re)build it if it is missing or stale."""
+        cache = cls._load_fresh(path, images, transform, backbone)
+        if cache is None:
+            cache = cls.build(
+                path,
+                dataset,
+                images,
+                transform,
+                encoder,
+                backbone,
+                batch_size,
+                num_workers,
+            )
+        return cache
+
+    @classmethod
+    def build(
+        cls,
+        path: str,
+        dataset: Dataset,
+        images: list[str],
+        transform: Callable,
+        encoder: Callable[[torch.Tensor], torch.Tensor],
+        backbone: str,
+        batch_size: int = 64,
+        num_workers: int = 0,
+    ) -> "EmbeddingCache":
+        """Compute the features of every image of `dataset` once and store them in the cache.
+
+        Args:
+            path (str): Path to the `.npy` file of the cache.
+            dataset (Dataset): Dataset returning (image tensor, label) pairs, transformed by
+                `transform`.
+            images (list[str]): The `image` column entry of each item of `dataset`.
+            transform (Callable): The deterministic transform applied by `dataset`.
+            encoder (Callable[[torch.Tensor], torch.Tensor]): Computes the pooled features of
+                a batch of images.
+            backbone (str): Fingerprint of the backbone weights, see `backbone_fingerprint`.
+            batch_size (int): Number of images encoded at once.
+            num_workers (int): Number of DataLoader workers used to load the images.
+
+        Returns:
+            EmbeddingCache: The newly built cache.
+        """
+        if len(images) != len(dataset):
+            raise ValueError(
+                f"Got {len(images)} image names for a dataset of length {len(dataset)}"
+            )
+
+        def batches():
+            for x, _ in DataLoader(
+                dataset, batch_size=batch_size, num_workers=num_workers
+            ):
+                with torch.no_grad():
+                    yield encoder(x).float().cpu().numpy()
+
+        return cls._write(
+            path, batches(), np.float16, images, transform, backbone=backbone
+        )
+
+
+class EmbeddingDataset(Dataset):
+    """A dataset returning the cached features of the images of a `CropHealthDataset`."""
+
+    def __init__(self, cache: EmbeddingCache, dataset: Dataset) -> None:
+        """
+        Args:
+            cache (EmbeddingCache): The cache with the features of every image.
+            dataset (CropHealthDataset): The dataset providing the images and labels.
+        """
+        self.cache = cache
+        self.dataset = dataset
+        self.class_map = dataset.class_map
+        self.rows = np.asarray(
+            [cache.row_map[image] for image in dataset.data_df["image"]],
+            dtype=np.int64,
+        )
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, idx) -> tuple:
+        """Return the features and the label of the image at the given index."""
+        return self.cache.load(self.rows[idx]), self.dataset.label(idx)
+
+    def get_class_counts(self, indices: Sequence[int] | None = None) -> dict:
+        """Return the counts of each class as a mapping from class index to count."""
+        return self.dataset.get_class_counts(indices)
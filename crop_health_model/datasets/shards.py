@@ -0,0 +1,351 @@
+import io
+import itertools
+import json
+import math
+import os
+import tarfile
+from collections import Counter
+from typing import Callable, Iterator
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.distributed as dist
+from PIL import Image
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+from crop_health_model.datasets.dataset import (
+    MULTI_TASK,
+    TASKS,
+    draft_scale,
+    task_class_map,
+    task_labels,
+)
+
+SHARD_INDEX_FILE = "shards.json"
+
+
+class ShardWriter:
+    """Writes the samples of one split into tar shards of a fixed number of samples.
+
+    Each sample is stored as two members sharing the same key: `<key>.jpg` with the encoded
+    image and `<key>.json` with its annotations. The position of a sample within the split
+    determines its shard, so samples may be written in any order.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        split: str,
+        num_samples: int,
+        samples_per_shard: int = 1000,
+    ) -> None:
+        """
+        Args:
+            output_dir (str): Directory to write the shards to.
+            split (str): Name of the split, used as prefix of the shard filenames.
+            num_samples (int): The number of samples of the split.
+            samples_per_shard (int): The maximum number of samples in a shard.
+        """
+        self.output_dir = output_dir
+        self.split = split
+        self.num_samples = num_samples
+        self.samples_per_shard = samples_per_shard
+        self.num_shards = max(1, math.ceil(num_samples / samples_per_shard))
+        self.counts = [0] * self.num_shards
+        self.label_counts = Counter()
+        self._tars = {}
+        os.makedirs(output_dir, exist_ok=True)
+
+    def shard_name(self, shard: int) -> str:
+        return f"{self.split}-{shard:06d}.tar"
+
+    def write(self, position: int, image: bytes, annotations: dict) -> None:
+        """Write a sample to its shard.
+
+        Args:
+            position (int): Position of the sample within the split.
+            image (bytes): The encoded JPEG image.
+            annotations (dict): The annotations of the sample, at least `label` and `crop_type`.
+        """
+        shard = position // self.samples_per_shard
+        if shard not in self._tars:
+            path = os.path.join(self.output_dir, self.shard_name(shard))
+            self._tars[shard] = tarfile.open(path, "w")
+        tar = self._tars[shard]
+
+        key = f"{position:09d}"
+        for name, data in (
+            (f"{key}.jpg", image),
+            (f"{key}.json", json.dumps(annotations).encode("utf-8")),
+        ):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+        self.counts[shard] += 1
+        self.label_counts[(annotations["label"], annotations["crop_type"])] += 1
+
+        # close the shard as soon as it is complete
+        if self.counts[shard] == self._shard_size(shard):
+            self._tars.pop(shard).close()
+
+    def _shard_size(self, shard: int) -> int:
+        return min(
+            self.samples_per_shard, self.num_samples - shard * self.samples_per_shard
+        )
+
+    def close(self) -> dict:
+        """Close all shards and return the index entry of the split."""
+        for tar in self._tars.values():
+            tar.close()
+        self._tars = {}
+        return {
+            "shards": [
+                {"file": self.shard_name(shard), "count": count}
+                for shard, count in enumerate(self.counts)
+                if count > 0
+            ],
+            "label_counts": [
+                [label, crop_type, count]
+                for (label, crop_type), count in self.label_counts.items()
+            ],
+        }
+
+
+def write_shard_index(
+    output_dir: str, splits: dict[str, dict], labels: list[str], crop_types: list[str]
+) -> None:
+    """Write the index of the shards, including the class map of every task.
+
+    Args:
+        output_dir (str): Directory containing the shards.
+        splits (dict[str, dict]): Index entry of each split, as returned by `ShardWriter.close`.
+        labels (list[str]): The labels of all samples, in the order of the annotations file.
+        crop_types (list[str]): The crop types of all samples, in the same order.
+    """
+    labels, crop_types = pd.Series(labels), pd.Series(crop_types)
+    class_maps = {
+        task: task_class_map(task_labels(labels, crop_types, task)) for task in TASKS
+    }
+    with open(os.path.join(output_dir, SHARD_INDEX_FILE), "w") as f:
+        json.dump({"class_maps": class_maps, "splits": splits}, f, indent=2)
+    print(f"Shard index saved to {os.path.join(output_dir, SHARD_INDEX_FILE)}")
+
+
+class ShardedCropHealthDataset(IterableDataset):
+    """A dataset streaming the Crop Health images sequentially from tar shards.
+
+    The samples of the split are divided over all DDP ranks and DataLoader workers. When
+    shuffling, for training, the shards are dealt to the workers in an order that changes
+    every epoch and the samples pass through a shuffle buffer. To keep the ranks in lockstep,
+    every worker then yields the same number of samples on every rank, which drops a few
+    samples every epoch. Otherwise, for evaluation, every worker reads a contiguous range of
+    the samples, so every sample is yielded exactly once and the ranks differ by at most one
+    sample.
+
+    With the `multi-task` task, the label of a sample is a tensor with its label for each of
+    the other tasks, in the order of `TASKS`, like in `CropHealthDataset`.
+    """
+
+    def __init__(
+        self,
+        shards_dir: str,
+        split: str,
+        task: str,
+        transform: Callable | None = None,
+        target_transform: Callable | None = None,
+        shuffle: bool = False,
+        shuffle_buffer: int = 1000,
+        seed: int = 42,
+        decode_size: int | None = None,
+    ) -> None:
+        with open(os.path.join(shards_dir, SHARD_INDEX_FILE), "r") as f:
+            index = json.load(f)
+        if task not in tuple(index["class_maps"]) + (MULTI_TASK,):
+            raise ValueError(f"Invalid task: {task}")
+
+        self.shards_dir = shards_dir
+        self.split = split
+        self.task = task
+        self.transform = transform
+        self.target_transform = target_transform
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.decode_size = decode_size
+        self.epoch = 0
+        if task == MULTI_TASK:
+            self.class_map = {t: index["class_maps"][t] for t in TASKS}
+        else:
+            self.class_map = index["class_maps"][task]
+        self.shards = [shard["file"] for shard in index["splits"][split]["shards"]]
+        self.shard_counts = [
+            shard["count"] for shard in index["splits"][split]["shards"]
+        ]
+        self.label_counts = index["splits"][split]["label_counts"]
+
+        # Map each (label, crop_type) pair of the split to its class index for every task
+        labels = pd.Series([entry[0] for entry in self.label_counts], dtype=str)
+        crop_types = pd.Series([entry[1] for entry in self.label_counts], dtype=str)
+        tasks = TASKS if task == MULTI_TASK else (task,)
+        class_maps = {t: index["class_maps"][t] for t in tasks}
+        self.task_targets = {
+            t: {
+                (label, crop_type): class_maps[t][task_label]
+                for label, crop_type, task_label in zip(
+                    labels, crop_types, task_labels(labels, crop_types, t)
+                )
+            }
+            for t in tasks
+        }
+        if task == MULTI_TASK:
+            self.targets = {
+                key: torch.tensor([self.task_targets[t][key] for t in TASKS])
+                for key in self.task_targets[TASKS[0]]
+            }
+        else:
+            self.targets = self.task_targets[task]
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch, which determines the shard order when shuffling."""
+        self.epoch = epoch
+
+    def get_class_counts(self) -> dict:
+        """Return the counts of each class in the dataset as a mapping from class index to count.
+
+        With `multi-task`, the counts of every task are returned in a dict by task.
+        """
+        task_counts = {}
+        for task, targets in self.task_targets.items():
+            class_counts = Counter()
+            for label, crop_type, count in self.label_counts:
+                class_counts[targets[(label, crop_type)]] += count
+            task_counts[task] = dict(class_counts)
+        if self.task == MULTI_TASK:
+            return task_counts
+        return task_counts[self.task]
+
+    def _worker_shards(self) -> tuple[list[tuple[str, int, int]], int]:
+        """Return the shards of the current worker and the number of samples to yield.
+
+        Returns:
+            tuple: The file, and the positions of the first and after the last sample to
+                read within it, of every shard of the worker, and the number of samples.
+        """
+        rank, world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        worker_info = get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        num_slots = world_size * num_workers
+        slot = rank * num_workers + worker_id
+
+        if not self.shuffle:
+            # Every (rank, worker) slot reads a contiguous range of the samples of the split
+            total = sum(self.shard_counts)
+            start, stop = slot * total // num_slots, (slot + 1) * total // num_slots
+            shards = []
+            offset = 0
+            for shard, count in zip(self.shards, self.shard_counts):
+                if offset < stop and start < offset + count:
+                    shards.append(
+                        (shard, max(start - offset, 0), min(stop - offset, count))
+                    )
+                offset += count
+            return shards, stop - start
+
+        order = np.random.default_rng((self.seed, self.epoch)).permutation(
+            len(self.shards)
+        )
+        # Shards are dealt to the (rank, worker) slots in turn
+        slot_shards = [order[i::num_slots] for i in range(num_slots)]
+        slot_counts = [
+            sum(self.shard_counts[shard] for shard in shards) for shards in slot_shards
+        ]
+        # Worker `worker_id` of every rank yields as many samples as the smallest of them
+        count = min(slot_counts[r * num_workers + worker_id] for r in range(world_size))
+        shards = [
+            (self.shards[shard], 0, self.shard_counts[shard])
+            for shard in slot_shards[slot]
+        ]
+        return shards, count
+
+    def _read_shard(self, shard: str) -> Iterator[tuple[bytes, dict]]:
+        """Yield the encoded image and annotations of every sample of a shard."""
+        sample = {}
+        with tarfile.open(os.path.join(self.shards_dir, shard), "r|") as tar:
+            for member in tar:
+                key, extension = member.name.split(".", 1)
+                if sample and sample["key"] != key:
+                    yield sample["jpg"], json.loads(sample["json"])
+                    sample = {}
+                sample["key"] = key
+                sample[extension] = tar.extractfile(member).read()
+        if sample:
+            yield sample["jpg"], json.loads(sample["json"])
+
+    def _shuffled(
+        self, samples: Iterator, rng: np.random.Generator
+    ) -> Iterator[tuple[bytes, dict]]:
+        """Shuffle a stream of samples using a buffer of `shuffle_buffer` samples."""
+        buffer = []
+        for sample in samples:
+            buffer.append(sample)
+            if len(buffer) >= self.shuffle_buffer:
+                idx = rng.integers(len(buffer))
+                buffer[idx], buffer[-1] = buffer[-1], buffer[idx]
+                yield buffer.pop()
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self) -> Iterator[tuple]:
+        shards, count = self._worker_shards()
+        samples = (
+            sample
+            for shard, start, stop in shards
+            for sample in itertools.islice(self._read_shard(shard), start, stop)
+        )
+        if self.shuffle:
+            worker_info = get_worker_info()
+            worker_id = worker_info.id if worker_info is not None else 0
+            rank = (
+                dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+            )
+            rng = np.random.default_rng((self.seed, self.epoch, rank, worker_id))
+            samples = self._shuffled(samples, rng)
+
+        for _, (image, annotations) in zip(range(count), samples):
+            image = Image.open(io.BytesIO(image))
+            if self.decode_size is not None:
+                width, height = annotations["width"], annotations["height"]
+                scale = draft_scale(width, height, self.decode_size)
+                if scale > 1:
+                    image.draft(image.mode, (width // scale, height // scale))
+            label = self.targets[(annotations["label"], annotations["crop_type"])]
+            if self.transform:
+                image = self.transform(image)
+            if self.target_transform:
+                label = self.target_transform(label)
+            yield image, label
+
+
+class ShardDataLoader(DataLoader):
+    """DataLoader for a `ShardedCropHealthDataset` that advances its epoch on every pass.
+
+    The epoch is set on the dataset before the workers are started, so persistent workers
+    are not supported.
+    """
+
+    def __init__(self, dataset: ShardedCropHealthDataset, **kwargs) -> None:
+        if kwargs.get("persistent_workers", False):
+            raise ValueError("ShardDataLoader does not support persistent workers")
+        super().__init__(dataset, **kwargs)
+        self._epoch = 0
+
+    def __iter__(self):
+        self.dataset.set_epoch(self._epoch)
+        self._epoch += 1
+        return super().__iter__()
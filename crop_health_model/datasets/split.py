@@ -0,0 +1,118 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from crop_health_model.datasets.dataset import task_codes
+
+SPLITS = ("train", "val", "test")
+SPLIT_META_FILE = "meta.json"
+
+
+def stratified_split_indices(
+    strata: np.ndarray, data_split: tuple = (0.8, 0.2), seed: int = 42
+) -> dict[str, np.ndarray]:
+    """Split the sample indices into train, validation and test indices per stratum.
+
+    Like `CropHealthDataModule`, the samples are first split into a train and a test set,
+    and the train set is split a second time into the final train and validation sets, both
+    times with the proportions of `data_split`. This is done separately for the samples of
+    every stratum, so that every split has the same proportions of each stratum.
+
+    Args:
+        strata (np.ndarray): The stratum of every sample, such as its multi-HLT class.
+        data_split (tuple): The proportions of the two parts of each split.
+        seed (int): Seed of the random permutations.
+
+    Returns:
+        dict[str, np.ndarray]: The sorted indices of the `train`, `val` and `test` sets.
+    """
+    rng = np.random.default_rng(seed)
+    strata = np.asarray(strata)
+    order = np.argsort(strata, kind="stable")
+    boundaries = np.flatnonzero(np.diff(strata[order])) + 1
+    splits = {split: [] for split in SPLITS}
+    for indices in np.split(order, boundaries):
+        indices = rng.permutation(indices)
+        num_train_val = round(len(indices) * data_split[0])
+        num_train = round(num_train_val * data_split[0])
+        splits["train"].append(indices[:num_train])
+        splits["val"].append(indices[num_train:num_train_val])
+        splits["test"].append(indices[num_train_val:])
+    return {
+        split: np.sort(np.concatenate(indices)).astype(np.int64)
+        for split, indices in splits.items()
+    }
+
+
+def annotations_split(
+    labels: pd.Series,
+    crop_types: pd.Series,
+    data_split: tuple = (0.8, 0.2),
+    seed: int = 42,
+) -> dict[str, np.ndarray]:
+    """Make the stratified split of `CropHealthDataModule` from the annotations.
+
+    The samples are stratified by their multi-HLT class, which combines the label and the
+    crop type, so that the split is the same as the one of the datamodule for the same
+    annotations, `data_split` and seed.
+
+    Args:
+        labels (pd.Series): The `label` column of the annotations.
+        crop_types (pd.Series): The `crop_type` column of the annotations.
+        data_split (tuple): The proportions of the two parts of each split.
+        seed (int): Seed of the random permutations.
+
+    Returns:
+        dict[str, np.ndarray]: The sorted indices of the `train`, `val` and `test` sets.
+    """
+    label_codes, label_names = pd.factorize(labels)
+    crop_type_codes, crop_type_names = pd.factorize(crop_types)
+    strata, _ = task_codes(
+        label_codes, label_names, crop_type_codes, crop_type_names, "multi-HLT"
+    )
+    return stratified_split_indices(strata, data_split, seed)
+
+
+def save_split(split: dict[str, np.ndarray], split_dir: str, meta: dict) -> None:
+    """Save the indices of every split to `<split>.npy` files in `split_dir`.
+
+    Args:
+        split (dict[str, np.ndarray]): The indices of the `train`, `val` and `test` sets.
+        split_dir (str): The directory to save the split to.
+        meta (dict): Information on how the split was made, saved to `meta.json`.
+    """
+    os.makedirs(split_dir, exist_ok=True)
+    for name, indices in split.items():
+        np.save(os.path.join(split_dir, f"{name}.npy"), indices)
+    meta = {**meta, "counts": {name: len(indices) for name, indices in split.items()}}
+    with open(os.path.join(split_dir, SPLIT_META_FILE), "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+def load_split(split_dir: str, num_samples: int | None = None) -> dict[str, np.ndarray]:
+    """Load the memory-mapped indices of every split saved by `save_split`.
+
+    Args:
+        split_dir (str): The directory the split was saved to.
+        num_samples (int, optional): Check that the split was made for this many samples.
+
+    Returns:
+        dict[str, np.ndarray]: The indices of the `train`, `val` and `test` sets.
+    """
+    with open(os.path.join(split_dir, SPLIT_META_FILE), "r") as f:
+        meta = json.load(f)
+    if num_samples is not None and meta["num_samples"] != num_samples:
+        raise ValueError(
+            f"The split in {split_dir} was made for {meta['num_samples']} samples, not {num_samples}"
+        )
+    return {
+        split: np.load(os.path.join(split_dir, f"{split}.npy"), mmap_mode="r")
+        for split in SPLITS
+    }
+
+
+def split_exists(split_dir: str) -> bool:
+    """Return whether a split was saved to `split_dir`."""
+    return os.path.isfile(os.path.join(split_dir, SPLIT_META_FILE))
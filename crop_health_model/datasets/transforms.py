@@ -0,0 +1,81 @@
+import torch
+import torch.nn as nn
+from torchvision import transforms
+
+
+class BatchTransform(nn.Module):
+    """Converts a uint8 batch of images to normalized floats and applies random flips.
+
+    This is the batched equivalent of ending a per-sample pipeline with random flips,
+    `ToTensor()` and `Normalize`. The random flips are only applied when training, with an
+    independent draw for every image in the batch.
+    """
+
+    def __init__(
+        self,
+        horizontal_flip_p: float = 0.0,
+        vertical_flip_p: float = 0.0,
+        mean: list[float] | None = None,
+        std: list[float] | None = None,
+    ) -> None:
+        """
+        Args:
+            horizontal_flip_p (float): Probability of flipping an image horizontally.
+            vertical_flip_p (float): Probability of flipping an image vertically.
+            mean (list[float], optional): Mean of each channel used for normalization.
+            std (list[float], optional): Standard deviation of each channel used for normalization.
+        """
+        super(BatchTransform, self).__init__()
+        self.horizontal_flip_p = horizontal_flip_p
+        self.vertical_flip_p = vertical_flip_p
+        self.normalize = mean is not None and std is not None
+        # the statistics are not part of the model weights, so don't save them
+        if self.normalize:
+            self.register_buffer(
+                "mean", torch.tensor(mean).view(1, -1, 1, 1), persistent=False
+            )
+            self.register_buffer(
+                "std", torch.tensor(std).view(1, -1, 1, 1), persistent=False
+            )
+
+    def _random_flip(self, x: torch.Tensor, p: float, dim: int) -> torch.Tensor:
+        flip = torch.rand(x.shape[0], device=x.device) < p
+        return torch.where(flip.view(-1, 1, 1, 1), x.flip(dim), x)
+
+    def forward(self, x: torch.Tensor, train: bool = False) -> torch.Tensor:
+        """Transform a uint8 batch of shape (N, C, H, W)."""
+        x = x.float().div_(255)
+        if train:
+            if self.horizontal_flip_p > 0:
+                x = self._random_flip(x, self.horizontal_flip_p, dim=-1)
+            if self.vertical_flip_p > 0:
+                x = self._random_flip(x, self.vertical_flip_p, dim=-2)
+        if self.normalize:
+            x = (x - self.mean) / self.std
+        return x
+
+
+def split_batch_transforms(
+    train_transforms: list[nn.Module],
+) -> tuple[list[nn.Module], dict]:
+    """Split off the random flips at the end of the train transforms.
+
+    Returns:
+        tuple[list[nn.Module], dict]: The remaining per-sample transforms, and the flip
+            probabilities to pass to `BatchTransform`.
+    """
+    flips = {}
+    transforms_list = list(train_transforms)
+    while transforms_list:
+        transform = transforms_list[-1]
+        if isinstance(transform, transforms.RandomHorizontalFlip):
+            key = "horizontal_flip_p"
+        elif isinstance(transform, transforms.RandomVerticalFlip):
+            key = "vertical_flip_p"
+        else:
+            break
+        if key in flips:
+            break
+        flips[key] = transform.p
+        transforms_list.pop()
+    return transforms_list, flips
@@ -1,3 +1,4 @@
+import copy
 import json
 import math
 import os
@@ -8,6 +9,13 @@ import numpy as np
 import torch
 import yaml
 from lightning.pytorch.callbacks import Callback
+from lightning.pytorch.cli import SaveConfigCallback
+from torchvision import transforms
+
+from crop_health_model.datasets.dataset import TransformWrapperDataset
+from crop_health_model.datasets.embeddings import EmbeddingCache, backbone_fingerprint
+from crop_health_model.datasets.split import save_split
+from crop_health_model.models.onnx_export import check_onnx_parity, export_onnx
 
 
 class ImagePredictionLogger(Callback):
@@ -23,12 +31,21 @@ class ImagePredictionLogger(Callback):
         """Called when the validation loop begins."""
         # Get the first batch of validation data
         val_samples = next(iter(trainer.datamodule.val_dataloader()))
-        val_imgs = val_samples[0].to(device=pl_module.device)
+        if val_samples[0].dim() != 4:
+            # the inputs are not images, such as the features of the embedding cache
+            return
+        val_imgs = pl_module.preprocess(val_samples[0].to(device=pl_module.device))
         val_labels = val_samples[1].to(device=pl_module.device)
 
         # Get model prediction
         log_probs = pl_module(val_imgs)
-        preds = torch.argmax(log_probs, dim=-1)
+        if isinstance(log_probs, dict):
+            # the predictions of every head of a multi-head model, one column per task
+            preds = torch.stack(
+                [torch.argmax(p, dim=-1) for p in log_probs.values()], 1
+            )
+        else:
+            preds = torch.argmax(log_probs, dim=-1)
 
         # Determine grid size
         num_images = min(self.num_samples, len(val_imgs))
@@ -46,10 +63,9 @@ class ImagePredictionLogger(Callback):
                 img = np.transpose(img, (1, 2, 0))
                 img = (img - img.min()) / (img.max() - img.min())  # Normalize to [0, 1]
                 ax.imshow(img)
-                ax.set_title(
-                    f"Pred: {preds[i].item()}, Label: {val_labels[i].item()}",
-                    fontsize=10,
-                )
+                pred = "/".join(str(p) for p in preds[i].flatten().tolist())
+                label = "/".join(str(l) for l in val_labels[i].flatten().tolist())
+                ax.set_title(f"Pred: {pred}, Label: {label}", fontsize=10)
                 ax.axis("off")
             else:
                 ax.axis("off")  # Hide unused subplots
@@ -71,13 +87,23 @@ class ClassWeightsCallback(Callback):
         self, trainer: pl.Trainer, pl_module: pl.LightningModule
     ) -> None:
         """Called when the training starts."""
-        weights = trainer.datamodule.compute_class_weights().to(pl_module.device)
+        weights = trainer.datamodule.compute_class_weights()
+        if isinstance(weights, dict):
+            # the class weights of every task of a multi-head model
+            weights = {task: w.to(pl_module.device) for task, w in weights.items()}
+        else:
+            weights = weights.to(pl_module.device)
         pl_module.set_class_weights(weights)
         print("Class weights set in the model.")
 
 
 class SaveDataDictionaryCallback(Callback):
-    """Callback to save a dictionary from the LightningDataModule as a JSON file."""
+    """Callback to save a dictionary from the LightningDataModule as a JSON file.
+
+    A dictionary by task, such as the class maps of the `multi-task` task, is saved to
+    `task_<filename>.json` instead. TorchServe loads `index_to_name.json` itself, and only
+    accepts a flat mapping of class indices to names in it.
+    """
 
     def __init__(self, dict_name: str, filename: str) -> None:
         """
@@ -98,10 +124,18 @@ class SaveDataDictionaryCallback(Callback):
         dict_to_save = getattr(dataset, self.dict_name, None)
 
         if dict_to_save is not None:
-            # Invert the dictionary
-            dict_to_save = {value: key for key, value in dict_to_save.items()}
+            # Invert the dictionary, or every dictionary of a dictionary by task
+            filename = self.filename
+            if all(isinstance(value, dict) for value in dict_to_save.values()):
+                dict_to_save = {
+                    task: {value: key for key, value in task_dict.items()}
+                    for task, task_dict in dict_to_save.items()
+                }
+                filename = f"task_{filename}"
+            else:
+                dict_to_save = {value: key for key, value in dict_to_save.items()}
             # Build the path using trainer's log_dir
-            filepath = os.path.join(trainer.log_dir, self.filename)
+            filepath = os.path.join(trainer.log_dir, filename)
             # save as JSON file
             with open(filepath + ".json", "w") as f:
                 json.dump(dict_to_save, f)
@@ -143,7 +177,7 @@ class SaveModelScriptCallback(Callback):
             # This assumes `key` directly matches the string in the template.
             content = content.replace(
                 f"{key}: {type(value).__name__}",
-                f"{key}: {type(value).__name__} = {value}",
+                f"{key}: {type(value).__name__} = {value!r}",
                 1,  # Replace only the first occurrence
             )
 
@@ -154,6 +188,37 @@ class SaveModelScriptCallback(Callback):
         print(f"Updated model script saved to {filepath}")
 
 
+def handler_transforms(data_config: dict) -> list[dict]:
+    """Return the image transforms of the generated handler script.
+
+    The handler applies the test transforms, converts the image to a float tensor and
+    normalizes it. Every transform is given like in the `data` section of a config, with the
+    `class_path` and `init_args` of a `torchvision.transforms` class.
+
+    Args:
+        data_config (dict): The `data` section of a config.
+    """
+    specs = list(data_config.get("test_transforms") or [])
+    specs.append({"class_path": "torchvision.transforms.ToTensor", "init_args": {}})
+    normalization = data_config.get("normalization", None)
+    if normalization is not None:
+        specs.append(normalization)
+    return specs
+
+
+def handler_image_processing(data_config: dict) -> transforms.Compose:
+    """Return the image transform pipeline of the generated handler script, see
+    `handler_transforms`, for serving the model without TorchServe."""
+    return transforms.Compose(
+        [
+            getattr(transforms, spec["class_path"].split(".")[-1])(
+                **spec.get("init_args", {})
+            )
+            for spec in handler_transforms(data_config)
+        ]
+    )
+
+
 class SaveModelHandlerCallback(Callback):
     """Callback to generate a handler script when training starts.
 
@@ -184,23 +249,21 @@ class SaveModelHandlerCallback(Callback):
         with open(self.config_path, "r") as file:
             config = yaml.safe_load(file)
 
-        test_transforms = config["fit"]["data"].get("test_transforms", [])
-        normalization = config["fit"]["data"].get("normalization", None)
-        num_classes = config["fit"]["model"]["model"]["init_args"]["num_classes"]
-
-        topk = self.compute_top_k(num_classes)
+        model_args = config["fit"]["model"]["model"]["init_args"]
 
+        # The handler always converts to floats and normalizes per image. With
+        # `uint8_batches`, training applies the same conversion and normalization to whole
+        # batches instead, so the model receives the same input in both cases.
         transform_lines = [
             f"        {self.get_transform_code(transform)},"
-            for transform in test_transforms
+            for transform in handler_transforms(config["fit"]["data"])
         ]
-        transform_lines.append("        transforms.ToTensor(),")
-        if normalization is not None:
-            transform_lines.append(f"        {self.get_transform_code(normalization)},")
 
         transform_pipeline_code = "\n".join(transform_lines)
 
-        handler_script = f"""
+        if "num_classes" in model_args:
+            topk = self.compute_top_k(model_args["num_classes"])
+            handler_script = f"""
 from torchvision import transforms
 from ts.torch_handler.image_classifier import ImageClassifier
 
@@ -209,6 +272,50 @@ class CustomHandler(ImageClassifier):
     image_processing = transforms.Compose([
 {transform_pipeline_code}
     ])
+"""
+        else:
+            # A multi-head model returns the logits of every task, and its
+            # task_index_to_name.json maps the class indices of every task to their names
+            handler_script = f"""
+import json
+import os
+
+import torch
+from torchvision import transforms
+from ts.torch_handler.image_classifier import ImageClassifier
+
+class CustomHandler(ImageClassifier):
+    image_processing = transforms.Compose([
+{transform_pipeline_code}
+    ])
+
+    def initialize(self, context):
+        super().initialize(context)
+        model_dir = context.system_properties.get("model_dir")
+        with open(os.path.join(model_dir, "task_index_to_name.json")) as f:
+            self.mapping = json.load(f)
+
+    def postprocess(self, data):
+        probabilities = {{
+            task: torch.softmax(logits, dim=1).tolist() for task, logits in data.items()
+        }}
+        num_images = len(next(iter(probabilities.values())))
+        return [
+            {{
+                task: dict(
+                    sorted(
+                        (
+                            (self.mapping[task][str(idx)], prob)
+                            for idx, prob in enumerate(probs[i])
+                        ),
+                        key=lambda item: item[1],
+                        reverse=True,
+                    )
+                )
+                for task, probs in probabilities.items()
+            }}
+            for i in range(num_images)
+        ]
 """
         with open(filepath, "w") as f:
             f.write(handler_script)
@@ -257,3 +364,159 @@ class SaveSimplifiedCheckpoint(Callback):
         torch.save(state_dict, file_path)
 
         print(f"Simplified checkpoint saved to: {file_path}")
+
+
+class SaveOnnxModelCallback(Callback):
+    """Callback to export the model to ONNX whenever a checkpoint is saved.
+
+    Like `SaveSimplifiedCheckpoint`, the model is saved to the `checkpoints` directory of the
+    run, so with `save_top_k: 1` the ONNX file always holds the best model. The outputs of
+    the ONNX model are compared with those of the PyTorch model on a sample of the validation
+    split, and an error is raised if they differ.
+    """
+
+    def __init__(
+        self,
+        filename: str = "best_model",
+        num_samples: int = 8,
+        tolerance: float = 1e-3,
+    ) -> None:
+        """
+        Args:
+            filename (str): Filename of the ONNX model, without the `.onnx` extension.
+            num_samples (int): Number of validation images used to check the ONNX model.
+            tolerance (float): The maximum difference between the logits of the ONNX and
+                PyTorch models, relative to the largest logit.
+        """
+        self.filename = filename
+        self.num_samples = num_samples
+        self.tolerance = tolerance
+        self.sample = None
+
+    def on_save_checkpoint(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule, checkpoint: dict
+    ) -> None:
+        """Called when saving a checkpoint."""
+        if not trainer.is_global_zero:
+            return
+        if self.sample is None:
+            # the same validation images are used for every export
+            datamodule = trainer.datamodule
+            x, _ = next(iter(datamodule.val_dataloader()))
+            if x.dim() != 4:
+                # the validation split holds cached features instead of images
+                print("Skipping the ONNX export of a model trained on cached features")
+                return
+            x = x[: self.num_samples]
+            if datamodule.batch_transform is not None:
+                x = datamodule.batch_transform(x)
+            self.sample = x
+
+        dir_path = f"{trainer.logger.log_dir}/checkpoints"
+        os.makedirs(dir_path, exist_ok=True)
+        file_path = f"{dir_path}/{self.filename}.onnx"
+
+        # export a copy on CPU, which doesn't interrupt the training on the GPUs
+        model = copy.deepcopy(pl_module.model).cpu().eval()
+        export_onnx(model, self.sample, file_path)
+        results = check_onnx_parity(model, file_path, self.sample, self.tolerance)
+
+        print(f"ONNX model saved to: {file_path} ({results})")
+
+
+class SaveConfigWithSplitCallback(SaveConfigCallback):
+    """Saves the LightningCLI config together with the data split of the run.
+
+    If the data split of the datamodule wasn't loaded from a `split_file`, it is saved to a
+    `split` directory next to `config.yaml`, and `data.split_file` in the saved config points
+    to it. Validating or testing with the saved config then uses the exact same split.
+    """
+
+    def setup(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule, stage: str
+    ) -> None:
+        datamodule = trainer.datamodule
+        if (
+            not self.already_saved
+            and getattr(datamodule, "split", None) is not None
+            and datamodule.split_file is None
+        ):
+            split_dir = os.path.join(trainer.log_dir, "split")
+            if trainer.is_global_zero:
+                save_split(datamodule.split, split_dir, datamodule.split_meta())
+            datamodule.split_file = split_dir
+            self.config.data.split_file = split_dir
+        super().setup(trainer, pl_module, stage)
+
+
+class EmbeddingCacheCallback(Callback):
+    """Callback to train and evaluate only the classification head on cached features.
+
+    When the trainer is set up, the frozen backbone of the model computes the pooled features
+    of every image once, with the deterministic test transforms, and stores them in an
+    `EmbeddingCache` inside the data directory. The datamodule then loads these features
+    instead of the images, and only the classification head of the model is trained. The
+    cache is shared by all tasks, and rebuilt when the images, the transforms or the weights
+    of the backbone change.
+    """
+
+    def __init__(self, filename: str = "embeddings.npy") -> None:
+        """
+        Args:
+            filename (str): Filename of the embedding cache inside `data.data_dir`.
+        """
+        self.filename = filename
+
+    def setup(
+        self, trainer: pl.Trainer, pl_module: pl.LightningModule, stage: str
+    ) -> None:
+        """Called when the trainer is set up, after the datamodule."""
+        datamodule = trainer.datamodule
+        model = pl_module.model
+        if trainer.ckpt_path is not None:
+            # the weights of the checkpoint are only restored after the setup, but the
+            # features have to be computed by its backbone
+            checkpoint = trainer.strategy.load_checkpoint(trainer.ckpt_path)
+            pl_module.load_state_dict(checkpoint["state_dict"])
+        path = os.path.join(datamodule.data_dir, self.filename)
+        # the cache holds the features of every image, whatever the stage evaluates on
+        data = datamodule.load_dataset(cache=datamodule.data.cache)
+        images = data.data_df["image"].tolist()
+        transform = datamodule.test_transform
+        backbone = backbone_fingerprint(model, model.head)
+
+        if trainer.is_global_zero:
+            device = trainer.strategy.root_device
+            batch_transform = datamodule.batch_transform
+            if batch_transform is not None:
+                batch_transform = batch_transform.to(device)
+            was_training = model.training
+            model.to(device).eval()
+
+            def encoder(x: torch.Tensor) -> torch.Tensor:
+                x = x.to(device)
+                if batch_transform is not None:
+                    x = batch_transform(x)
+                return model.forward_features(x)
+
+            try:
+                EmbeddingCache.load_or_build(
+                    path=path,
+                    dataset=TransformWrapperDataset(data, transform),
+                    images=images,
+                    transform=transform,
+                    encoder=encoder,
+                    backbone=backbone,
+                    batch_size=datamodule.batch_size,
+                    num_workers=datamodule.num_workers,
+                )
+            finally:
+                model.train(was_training)
+        # the other processes wait for the cache to be built
+        trainer.strategy.barrier()
+
+        cache = EmbeddingCache(path)
+        if not cache.matches(images, transform, backbone):
+            raise ValueError(f"The embedding cache at {path} doesn't match the model")
+        datamodule.use_embeddings(cache)
+        pl_module.freeze_backbone()
@@ -1,8 +1,17 @@
+import copy
+
 import lightning.pytorch as pl
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torchmetrics.functional import accuracy, fbeta_score
+from torchmetrics import Accuracy, F1Score, MeanMetric, Metric, MetricCollection
+
+from crop_health_model.models.performance import (
+    autocast,
+    check_parity,
+    optimize_model,
+    to_channels_last,
+)
 
 
 class LitModel(pl.LightningModule):
@@ -11,18 +20,171 @@ class LitModel(pl.LightningModule):
     def __init__(
         self,
         model: nn.Module,
+        channels_last: bool = False,
+        bf16_autocast: bool = False,
+        compile_model: bool = False,
+        parity_check: bool = True,
     ) -> None:
+        """
+        Args:
+            model (nn.Module): The model to train.
+            channels_last (bool): Use the channels_last memory format for the weights and
+                inputs, which is faster for convolutions on CPUs and recent GPUs.
+            bf16_autocast (bool): Run the model with bfloat16 autocast on CPUs with native
+                bfloat16 support. The loss is still computed in float32.
+            compile_model (bool): Compile the model with `torch.compile`.
+            parity_check (bool): Check that the model with the above options gives the same
+                logits as the eager float32 model before using it.
+        """
         super(LitModel, self).__init__()
         self.model = model
         self.class_weights = None
-        hyperparameters = self.model.get_hyperparameters()
-        self.save_hyperparameters(hyperparameters)
+        self.batch_transform = None
+        self.channels_last = channels_last
+        self.bf16_autocast = bf16_autocast
+        self.compile_model = compile_model
+        self.parity_check = parity_check
+        self.optimized = False
+        self.head_only = False
+
+        # A multi-head model has the number of classes of every task
+        num_classes = self.model.num_classes
+        self.tasks = list(num_classes) if isinstance(num_classes, dict) else None
+
+        # Stateful metrics of every stage. They accumulate their statistics on every device,
+        # and only synchronize them across devices when they are computed at the end of the
+        # epoch. Accuracy and F1 score share the same per-class statistics.
+        for stage in ("train", "val", "test"):
+            if self.tasks is None:
+                metrics = self._metrics(num_classes).clone(prefix=f"{stage}_")
+            else:
+                metrics = nn.ModuleDict(
+                    {
+                        task: self._metrics(num_classes[task]).clone(
+                            prefix=f"{stage}_", postfix=f"_{task}"
+                        )
+                        for task in self.tasks
+                    }
+                )
+                # the loss of every head, their sum is the loss of the stage
+                setattr(
+                    self,
+                    f"{stage}_head_losses",
+                    nn.ModuleDict({task: MeanMetric() for task in self.tasks}),
+                )
+            setattr(self, f"{stage}_metrics", metrics)
+            setattr(self, f"{stage}_loss", MeanMetric())
+
+        # Save the hyperparameters of the model like its `model` argument in the config, so
+        # that LightningCLI can merge them into the config when evaluating a checkpoint
+        model_class = type(self.model)
+        self.save_hyperparameters(
+            {
+                "model": {
+                    "class_path": f"{model_class.__module__}.{model_class.__qualname__}",
+                    "init_args": self.model.get_hyperparameters(),
+                }
+            }
+        )
+
+    @staticmethod
+    def _metrics(num_classes: int) -> MetricCollection:
+        """Create the metrics of a classification head with the given number of classes."""
+        task = "binary" if num_classes == 2 else "multiclass"
+        return MetricCollection(
+            {
+                "acc": Accuracy(task=task, num_classes=num_classes),
+                "f1": F1Score(task=task, num_classes=num_classes, average="macro"),
+            }
+        )
+
+    def forward(self, x) -> torch.Tensor | dict[str, torch.Tensor]:
+        if self.head_only:
+            # the inputs are the cached features of the frozen backbone
+            return self.model.forward_head(x.float())
+        if self.channels_last:
+            x = to_channels_last(x)
+        with autocast(x.device, self.bf16_autocast):
+            return self.model(x)
+
+    def setup(self, stage: str) -> None:
+        # With `uint8_batches`, the DataModule provides the transform that turns batches of
+        # uint8 images into the normalized float input of the model
+        datamodule = getattr(self.trainer, "datamodule", None)
+        self.batch_transform = getattr(datamodule, "batch_transform", None)
+
+    # The performance options are applied once the strategy has moved the model to its
+    # device, so that the parity check and the compilation run there, unlike in `setup`
+    def on_fit_start(self) -> None:
+        self.optimize()
+
+    def on_validation_start(self) -> None:
+        self.optimize()
+
+    def on_test_start(self) -> None:
+        self.optimize()
+
+    def on_predict_start(self) -> None:
+        self.optimize()
+
+    def optimize(self, input_size: int = 224) -> dict | None:
+        """Apply the performance options to the model, once.
+
+        With `parity_check`, the logits of the optimized model on a random batch are compared
+        with those of a copy of the eager float32 model, see `check_parity`.
+
+        Args:
+            input_size (int): Height and width of the random batch of the parity check.
+
+        Returns:
+            dict | None: The results of the parity check, if any.
+        """
+        if self.optimized or not (
+            self.channels_last or self.bf16_autocast or self.compile_model
+        ):
+            return None
+        reference = copy.deepcopy(self.model) if self.parity_check else None
+        optimize_model(self.model, self.channels_last, self.compile_model)
+        self.optimized = True
+        if reference is None:
+            return None
 
-    def forward(self, x) -> torch.Tensor:
-        return self.model(x)
+        generator = torch.Generator().manual_seed(0)
+        x = torch.randn(4, 3, input_size, input_size, generator=generator)
+        x = x.to(self.device)
+        results = check_parity(
+            reference, self.model, x, self.channels_last, self.bf16_autocast
+        )
+        print(f"Parity check of the optimized model passed: {results}")
+        return results
+
+    def preprocess(self, x: torch.Tensor) -> torch.Tensor:
+        """Convert a batch of uint8 images to the input of the model, applying the random
+        flips when training. Batches of floats are returned unchanged."""
+        if x.dtype != torch.uint8 or self.batch_transform is None:
+            return x
+        return self.batch_transform(x, train=self.training)
+
+    def on_after_batch_transfer(self, batch: tuple, dataloader_idx: int) -> tuple:
+        x, y = batch
+        return self.preprocess(x), y
+
+    def freeze_backbone(self) -> None:
+        """Train only the classification head, on the pooled features of the backbone.
 
-    def set_class_weights(self, class_weights: torch.Tensor) -> None:
-        """Set the class weights for the loss function."""
+        The parameters of the backbone no longer receive gradients, and the model expects the
+        features computed by `forward_features` as input instead of images.
+        """
+        head_parameters = {id(p) for p in self.model.head.parameters()}
+        for parameter in self.model.parameters():
+            if id(parameter) not in head_parameters:
+                parameter.requires_grad_(False)
+        self.head_only = True
+
+    def set_class_weights(
+        self, class_weights: torch.Tensor | dict[str, torch.Tensor]
+    ) -> None:
+        """Set the class weights for the loss function, by task for a multi-head model."""
         self.class_weights = class_weights
 
     def _compute_loss(
@@ -36,29 +198,75 @@ class LitModel(pl.LightningModule):
     ) -> torch.Tensor:
         """Wrapper for the training/validation/test step."""
         x, y = batch
-        logits = self.model(x)
-        if use_weights:
-            loss = self._compute_loss(logits, y, self.class_weights)
+        output = self(x)
+        on_step = prefix == "train"
+        metrics = getattr(self, f"{prefix}_metrics")
+        if self.tasks is None:
+            weights = self.class_weights if use_weights else None
+            loss = self._compute_loss(output.float(), y, weights)
+            self._update_metrics(output, y, metrics, on_step, prog_bar=True)
         else:
-            loss = self._compute_loss(logits, y)
+            # The labels have one column per task, and the loss of a multi-head model is
+            # the sum of the losses of its heads
+            head_losses = getattr(self, f"{prefix}_head_losses")
+            losses = []
+            for i, task in enumerate(self.tasks):
+                weights = None
+                if use_weights and self.class_weights is not None:
+                    weights = self.class_weights[task]
+                task_loss = self._compute_loss(output[task].float(), y[:, i], weights)
+                self._accumulate(
+                    head_losses[task], on_step, task_loss.detach(), weight=len(y)
+                )
+                self.log(
+                    f"{prefix}_loss_{task}",
+                    head_losses[task],
+                    on_step=on_step,
+                    on_epoch=True,
+                )
+                self._update_metrics(output[task], y[:, i], metrics[task], on_step)
+                losses.append(task_loss)
+            loss = torch.stack(losses).sum()
 
-        # logging of metrics
-        preds = torch.argmax(logits, dim=-1)
-        task = "binary" if self.model.num_classes == 2 else "multiclass"
-        acc = accuracy(preds, y, task=task, num_classes=self.model.num_classes)
-        f1 = fbeta_score(
-            preds=preds,
-            target=y,
-            task=task,
-            beta=1.0,
-            num_classes=self.model.num_classes,
-            average="macro",
+        mean_loss = getattr(self, f"{prefix}_loss")
+        self._accumulate(mean_loss, on_step, loss.detach(), weight=len(y))
+        self.log(
+            f"{prefix}_loss", mean_loss, prog_bar=True, on_step=on_step, on_epoch=True
         )
-        self.log(f"{prefix}_loss", loss, prog_bar=True, on_epoch=True, sync_dist=True)
-        self.log(f"{prefix}_acc", acc, prog_bar=True, on_epoch=True, sync_dist=True)
-        self.log(f"{prefix}_f1", f1, prog_bar=True, on_epoch=True, sync_dist=True)
         return loss
 
+    @staticmethod
+    def _accumulate(
+        metric: Metric | MetricCollection, on_step: bool, *args, **kwargs
+    ) -> None:
+        """Update the statistics of a metric with a batch.
+
+        The value of the metric on the batch is only computed when it is logged on every
+        step, the validation and test metrics are only computed at the end of the epoch.
+        """
+        if on_step:
+            metric(*args, **kwargs)
+        else:
+            metric.update(*args, **kwargs)
+
+    def _update_metrics(
+        self,
+        logits: torch.Tensor,
+        y: torch.Tensor,
+        metrics: MetricCollection,
+        on_step: bool,
+        prog_bar: bool = False,
+    ) -> None:
+        """Update and log the metrics of a classification head.
+
+        On the training steps, calling the metrics returns their value on the batch of this
+        device, which is logged without any synchronization, while the epoch values are
+        computed from the statistics of all devices.
+        """
+        preds = torch.argmax(logits, dim=-1)
+        self._accumulate(metrics, on_step, preds, y)
+        self.log_dict(metrics, prog_bar=prog_bar, on_step=on_step, on_epoch=True)
+
     def training_step(self, batch: tuple, batch_idx: int) -> torch.Tensor:
         loss = self.step_wrapper(batch, batch_idx, prefix="train", use_weights=True)
 
@@ -68,7 +276,6 @@ class LitModel(pl.LightningModule):
             self.trainer.optimizers[0].param_groups[0]["lr"],
             on_step=False,
             on_epoch=True,
-            sync_dist=True,
         )
 
         return loss
@@ -0,0 +1,128 @@
+import torch
+import torch.nn as nn
+from torchvision import models
+
+# The backbones that can be used, by architecture name: the torchvision constructor and the
+# name of its final linear layer, which is replaced by the classification head. The number
+# of parameters and the CPU latency (median over one 224x224 image on a single thread of an
+# Intel Xeon CPU) are measured with 2 classes by `crop_health_model/benchmarks/backbones.py`.
+BACKBONES = {
+    "resnet18": {
+        "constructor": models.resnet18,
+        "classifier": "fc",
+        "num_params": 11177538,
+        "cpu_latency_ms": 82.7,
+    },
+    "resnet34": {
+        "constructor": models.resnet34,
+        "classifier": "fc",
+        "num_params": 21285698,
+        "cpu_latency_ms": 144.9,
+    },
+    "resnet50": {
+        "constructor": models.resnet50,
+        "classifier": "fc",
+        "num_params": 23512130,
+        "cpu_latency_ms": 173.3,
+    },
+    "resnet101": {
+        "constructor": models.resnet101,
+        "classifier": "fc",
+        "num_params": 42504258,
+        "cpu_latency_ms": 303.9,
+    },
+    "resnet152": {
+        "constructor": models.resnet152,
+        "classifier": "fc",
+        "num_params": 58147906,
+        "cpu_latency_ms": 446.3,
+    },
+    "mobilenet_v3_small": {
+        "constructor": models.mobilenet_v3_small,
+        "classifier": "classifier.3",
+        "num_params": 1519906,
+        "cpu_latency_ms": 13.3,
+    },
+    "mobilenet_v3_large": {
+        "constructor": models.mobilenet_v3_large,
+        "classifier": "classifier.3",
+        "num_params": 4204594,
+        "cpu_latency_ms": 29.7,
+    },
+    "efficientnet_b0": {
+        "constructor": models.efficientnet_b0,
+        "classifier": "classifier.1",
+        "num_params": 4010110,
+        "cpu_latency_ms": 48.4,
+    },
+    "regnet_y_400mf": {
+        "constructor": models.regnet_y_400mf,
+        "classifier": "fc",
+        "num_params": 3904026,
+        "cpu_latency_ms": 35.9,
+    },
+    "regnet_y_800mf": {
+        "constructor": models.regnet_y_800mf,
+        "classifier": "fc",
+        "num_params": 5649082,
+        "cpu_latency_ms": 50.6,
+    },
+}
+
+
+class BackboneClassifier(nn.Module):
+    """Image classification model with any of the backbones of `BACKBONES`."""
+
+    def __init__(
+        self,
+        architecture: str,
+        num_classes: int,
+        weights: str | None = None,
+    ) -> None:
+        """
+        Args:
+            architecture (str): The name of the backbone in `BACKBONES`, such as
+                `mobilenet_v3_large` or `efficientnet_b0`.
+            num_classes (int): The number of classes in the dataset,
+                               which is also the number of output units.
+            weights (str, optional): The weights to initialize the backbone with. Defaults to None.
+        """
+        super(BackboneClassifier, self).__init__()
+        if architecture not in BACKBONES:
+            raise ValueError(f"Invalid architecture: {architecture}")
+
+        self.backbone = BACKBONES[architecture]["constructor"](weights=weights)
+
+        # Replace the last linear layer of the backbone by the classification head, so that
+        # the backbone returns the features that are the input of that layer
+        parent_name, _, name = BACKBONES[architecture]["classifier"].rpartition(".")
+        parent = self.backbone.get_submodule(parent_name)
+        in_features = getattr(parent, name).in_features
+        setattr(parent, name, nn.Identity())
+        self.classifier = nn.Linear(in_features, num_classes)
+        self.architecture = architecture
+        self.num_classes = num_classes
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """Forward pass of the model."""
+        return self.forward_head(self.forward_features(x))
+
+    @property
+    def head(self) -> nn.Module:
+        """The classification head of the model."""
+        return self.classifier
+
+    def forward_features(self, x: torch.Tensor) -> torch.Tensor:
+        """Return the features of the backbone, which are the input of the head."""
+        return self.backbone(x)
+
+    def forward_head(self, features: torch.Tensor) -> torch.Tensor:
+        """Return the logits for the features of the backbone."""
+        return self.classifier(features)
+
+    def get_hyperparameters(self) -> dict:
+        """Return the hyperparameters of the model."""
+        return {
+            "architecture": self.architecture,
+            "num_classes": self.num_classes,
+        }
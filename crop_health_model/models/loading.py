@@ -0,0 +1,141 @@
+import os
+import time
+
+import torch
+import torch.nn as nn
+import yaml
+from jsonargparse import ArgumentParser
+from lightning.pytorch.cli import LightningArgumentParser
+
+from crop_health_model.datasets.datamodule import CropHealthDataModule
+
+
+def build_model(model_config: dict, device: torch.device | str = "meta") -> nn.Module:
+    """Instantiate a model from its `class_path` and `init_args` without any weights.
+
+    Pretrained weights are never downloaded, since they are replaced by those of a
+    checkpoint. On the meta device, the parameters aren't even allocated nor initialized,
+    so the model has to be loaded with `load_state_dict(state_dict, assign=True)`.
+
+    Args:
+        model_config (dict): The `model.model` section of a config, such as the one of the
+            `config.yaml` of a run.
+        device (torch.device | str): The device to create the parameters on.
+
+    Returns:
+        nn.Module: The model, with uninitialized parameters on the meta device.
+    """
+    model_config = {
+        "class_path": model_config["class_path"],
+        "init_args": dict(model_config.get("init_args") or {}),
+    }
+    if "weights" in model_config["init_args"]:
+        model_config["init_args"]["weights"] = None
+
+    parser = ArgumentParser()
+    parser.add_subclass_arguments(nn.Module, "model")
+    config = parser.parse_object({"model": model_config})
+    with torch.device(device):
+        return parser.instantiate_classes(config).model
+
+
+def load_model(
+    run_dir: str,
+    checkpoint: str = "checkpoints/best_model.pt",
+    device: torch.device | str = "cpu",
+) -> tuple[nn.Module, dict]:
+    """Load the model of a training run for inference, as fast as possible.
+
+    The model is built from the `config.yaml` of the run on the meta device, see
+    `build_model`. The simplified checkpoint is then memory-mapped, and its tensors become
+    the parameters of the model directly, so nothing is initialized or copied twice. On a
+    CPU, the weights are only read from the disk when the model first uses them.
+
+    Args:
+        run_dir (str): The log directory of the run, such as `tb_logs/binary/version_0`.
+        checkpoint (str): Path of the simplified checkpoint, relative to `run_dir`.
+        device (torch.device | str): The device to load the model on.
+
+    Returns:
+        tuple: The model in eval mode, and the time in seconds spent to parse the config
+            (`config`), build the model (`build`), open the checkpoint (`load`), assign its
+            tensors to the model (`assign`), move it to the device (`to_device`) and in
+            total (`total`).
+    """
+    timings = {}
+    start = time.perf_counter()
+
+    def record(step: str) -> None:
+        nonlocal start
+        now = time.perf_counter()
+        timings[step] = now - start
+        start = now
+
+    with open(os.path.join(run_dir, "config.yaml"), "r") as f:
+        config = yaml.safe_load(f)
+    record("config")
+
+    model = build_model(config["model"]["model"], device="meta")
+    record("build")
+
+    state_dict = torch.load(
+        os.path.join(run_dir, checkpoint),
+        map_location="cpu",
+        mmap=True,
+        weights_only=True,
+    )
+    record("load")
+
+    model.load_state_dict(state_dict, assign=True)
+    # the buffers that aren't saved in the checkpoint would still be on the meta device
+    missing = [name for name, tensor in model.state_dict().items() if tensor.is_meta]
+    if missing:
+        raise ValueError(f"The checkpoint doesn't contain {missing}")
+    record("assign")
+
+    model.to(device).eval()
+    record("to_device")
+
+    timings["total"] = sum(timings.values())
+    print(
+        "Model loaded in "
+        + ", ".join(
+            f"{step} {seconds * 1000:.1f} ms" for step, seconds in timings.items()
+        )
+    )
+    return model, timings
+
+
+def build_datamodule(data_config: dict) -> CropHealthDataModule:
+    """Instantiate the datamodule from the `data` section of a config.
+
+    The config is parsed like LightningCLI does, which instantiates the transforms.
+    """
+    parser = LightningArgumentParser()
+    parser.add_lightning_class_args(CropHealthDataModule, "data")
+    return parser.instantiate_classes(parser.parse_object({"data": data_config})).data
+
+
+def load_datamodule(config: str) -> CropHealthDataModule:
+    """Instantiate the datamodule from the `fit.data` section of a training config."""
+    with open(config, "r") as f:
+        return build_datamodule(yaml.safe_load(f)["fit"]["data"])
+
+
+def load_run(
+    run_dir: str, checkpoint: str = "checkpoints/best_model.pt"
+) -> tuple[nn.Module, CropHealthDataModule]:
+    """Instantiate the model and the datamodule of a training run from its `config.yaml`.
+
+    Args:
+        run_dir (str): The log directory of the run, such as `tb_logs/binary/version_0`.
+        checkpoint (str): Path of the simplified checkpoint with the weights of the model,
+            relative to `run_dir`.
+
+    Returns:
+        tuple: The float model with the weights of the checkpoint, in eval mode, see
+            `load_model`, and the datamodule with the data split of the run.
+    """
+    model, _ = load_model(run_dir, checkpoint)
+    with open(os.path.join(run_dir, "config.yaml"), "r") as f:
+        return model, build_datamodule(yaml.safe_load(f)["data"])
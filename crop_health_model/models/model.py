@@ -44,6 +44,28 @@ class ResNet(nn.Module):
         """Forward pass of the model."""
         return self.resnet(x)
 
+    @property
+    def head(self) -> nn.Module:
+        """The classification head of the model."""
+        return self.resnet.fc
+
+    def forward_features(self, x: torch.Tensor) -> torch.Tensor:
+        """Return the pooled features of the backbone, which are the input of the head."""
+        x = self.resnet.conv1(x)
+        x = self.resnet.bn1(x)
+        x = self.resnet.relu(x)
+        x = self.resnet.maxpool(x)
+        x = self.resnet.layer1(x)
+        x = self.resnet.layer2(x)
+        x = self.resnet.layer3(x)
+        x = self.resnet.layer4(x)
+        x = self.resnet.avgpool(x)
+        return torch.flatten(x, 1)
+
+    def forward_head(self, features: torch.Tensor) -> torch.Tensor:
+        """Return the logits for the pooled features of the backbone."""
+        return self.resnet.fc(features)
+
     def get_hyperparameters(self) -> dict:
         """Return the hyperparameters of the model."""
         return {
@@ -0,0 +1,85 @@
+import torch
+import torch.nn as nn
+from torchvision import models
+
+
+class MultiHeadResNet(nn.Module):
+    """ResNet model with a shared backbone and one classification head per task.
+
+    The model predicts the `binary`, `single-HLT` and `multi-HLT` classes of an image with a
+    single forward pass of the backbone, and returns the logits of every task in a dict.
+    """
+
+    def __init__(
+        self,
+        num_binary_classes: int,
+        num_single_hlt_classes: int,
+        num_multi_hlt_classes: int,
+        num_layers: int,
+        weights: str | None = None,
+    ) -> None:
+        """
+        Args:
+            num_binary_classes (int): The number of classes of the binary task.
+            num_single_hlt_classes (int): The number of classes of the single-HLT task.
+            num_multi_hlt_classes (int): The number of classes of the multi-HLT task.
+            num_layers (int): The number of layers in the ResNet model.
+            weights (str, optional): The weights to initialize the backbone with. Defaults to None.
+        """
+        super(MultiHeadResNet, self).__init__()
+
+        match num_layers:
+            case 18:
+                self.resnet = models.resnet18(weights=weights)
+            case 34:
+                self.resnet = models.resnet34(weights=weights)
+            case 50:
+                self.resnet = models.resnet50(weights=weights)
+            case 101:
+                self.resnet = models.resnet101(weights=weights)
+            case 152:
+                self.resnet = models.resnet152(weights=weights)
+            case _:
+                raise ValueError(f"Invalid number of layers: {num_layers}")
+
+        # Replace the last fully connected layer of the model by one head per task
+        num_features = self.resnet.fc.in_features
+        self.resnet.fc = nn.Identity()
+        self.num_classes = {
+            "binary": num_binary_classes,
+            "single-HLT": num_single_hlt_classes,
+            "multi-HLT": num_multi_hlt_classes,
+        }
+        self.heads = nn.ModuleDict(
+            {
+                task: nn.Linear(num_features, num_classes)
+                for task, num_classes in self.num_classes.items()
+            }
+        )
+        self.num_layers = num_layers
+
+    def forward(self, x: torch.Tensor) -> dict[str, torch.Tensor]:
+        """Forward pass of the model, returning the logits of every task."""
+        return self.forward_head(self.forward_features(x))
+
+    @property
+    def head(self) -> nn.Module:
+        """The classification heads of the model."""
+        return self.heads
+
+    def forward_features(self, x: torch.Tensor) -> torch.Tensor:
+        """Return the pooled features of the backbone, which are the input of the heads."""
+        return self.resnet(x)
+
+    def forward_head(self, features: torch.Tensor) -> dict[str, torch.Tensor]:
+        """Return the logits of every task for the pooled features of the backbone."""
+        return {task: head(features) for task, head in self.heads.items()}
+
+    def get_hyperparameters(self) -> dict:
+        """Return the hyperparameters of the model."""
+        return {
+            "num_binary_classes": self.num_classes["binary"],
+            "num_single_hlt_classes": self.num_classes["single-HLT"],
+            "num_multi_hlt_classes": self.num_classes["multi-HLT"],
+            "num_layers": self.num_layers,
+        }
@@ -0,0 +1,120 @@
+import copy
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+
+def output_names(model: nn.Module) -> list[str]:
+    """Return the names of the ONNX outputs of a model, one per task of a multi-head model."""
+    if isinstance(model.num_classes, dict):
+        return list(model.num_classes)
+    return ["logits"]
+
+
+def export_onnx(
+    model: nn.Module, x: torch.Tensor, path: str, opset_version: int = 17
+) -> None:
+    """Export a model to ONNX with a dynamic batch axis.
+
+    The model is exported in eval mode, so the batch normalizations are folded into the
+    preceding convolutions, and the constant parts of the graph are folded as well.
+
+    Args:
+        model (nn.Module): The float model, such as a `ResNet`. It isn't modified.
+        x (torch.Tensor): An example batch of inputs, only its shape is used.
+        path (str): Path to save the `.onnx` file to.
+        opset_version (int): The ONNX opset of the exported graph.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    names = output_names(model)
+    torch.onnx.export(
+        model,
+        (x.cpu(),),
+        path,
+        input_names=["input"],
+        output_names=names,
+        dynamic_axes={name: {0: "batch"} for name in ["input", *names]},
+        opset_version=opset_version,
+        do_constant_folding=True,
+        dynamo=False,
+    )
+
+
+def onnx_session(path: str, num_threads: int | None = None) -> "ort.InferenceSession":
+    """Create an ONNX Runtime session on CPU with all the graph optimizations enabled.
+
+    Args:
+        path (str): Path of the `.onnx` file.
+        num_threads (int, optional): Number of threads of the operators, defaults to the
+            number of physical cores.
+    """
+    if ort is None:
+        raise ImportError(
+            "Running ONNX models requires onnxruntime, install the `onnx` extra with "
+            "`pip install crop-health-model[onnx]`"
+        )
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads is not None:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(
+        path, sess_options=options, providers=["CPUExecutionProvider"]
+    )
+
+
+@torch.no_grad()
+def check_onnx_parity(
+    model: nn.Module, path: str, x: torch.Tensor, tolerance: float = 1e-3
+) -> dict:
+    """Compare the logits of an exported ONNX model with those of the PyTorch model.
+
+    Like `check_parity`, the difference is measured relative to the largest absolute logit
+    of the PyTorch model, over the outputs of every task.
+
+    Args:
+        model (nn.Module): The PyTorch model that was exported.
+        path (str): Path of the `.onnx` file.
+        x (torch.Tensor): A batch of inputs, such as a sample of the validation split.
+        tolerance (float): The maximum relative difference.
+
+    Returns:
+        dict: The `max_abs_diff`, `max_rel_diff` and the fraction of the samples with the same
+            predicted class (`top1_agreement`).
+    """
+    training = model.training
+    model.eval()
+    try:
+        expected = model(x)
+    finally:
+        model.train(training)
+    if not isinstance(expected, dict):
+        expected = {"logits": expected}
+    session = onnx_session(path)
+    actual = session.run(None, {"input": x.cpu().numpy().astype(np.float32)})
+    actual = {
+        output.name: torch.from_numpy(logits)
+        for output, logits in zip(session.get_outputs(), actual)
+    }
+
+    max_abs_diff = max(
+        (actual[name] - logits.cpu().float()).abs().max().item()
+        for name, logits in expected.items()
+    )
+    max_logit = max(logits.abs().max().item() for logits in expected.values())
+    results = {
+        "max_abs_diff": max_abs_diff,
+        "max_rel_diff": max_abs_diff / max(max_logit, 1e-12),
+        "top1_agreement": min(
+            (actual[name].argmax(-1) == logits.cpu().argmax(-1)).float().mean().item()
+            for name, logits in expected.items()
+        ),
+    }
+    if results["max_rel_diff"] > tolerance:
+        raise ValueError(f"The ONNX model differs from the PyTorch model: {results}")
+    return results
@@ -0,0 +1,120 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+
+
+def cpu_bf16_supported() -> bool:
+    """Return whether the CPU computes bfloat16 convolutions and matmuls natively.
+
+    Without native support (AVX512-BF16 or AMX), bfloat16 autocast is slower than float32.
+    """
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def autocast(device: torch.device | str, enabled: bool = True):
+    """Return a bfloat16 autocast context for a CPU device, or a no-op context otherwise.
+
+    Autocast is only enabled on CPUs with native bfloat16 support, see `cpu_bf16_supported`.
+    On GPUs, mixed precision is configured through the `precision` of the Trainer instead.
+    """
+    device = torch.device(device)
+    if enabled and device.type == "cpu" and cpu_bf16_supported():
+        return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def optimize_model(
+    model: nn.Module, channels_last: bool = False, compile_model: bool = False
+) -> nn.Module:
+    """Apply the performance options to a model in place.
+
+    Args:
+        model (nn.Module): The model, such as a `ResNet`.
+        channels_last (bool): Store the weights in channels_last memory format, the inputs
+            should then be converted as well, see `to_channels_last`.
+        compile_model (bool): Compile the forward pass of the model with `torch.compile`. This
+            doesn't change the parameter names of the model, so its state_dict and
+            checkpoints remain the same.
+
+    Returns:
+        nn.Module: The same model.
+    """
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    if compile_model:
+        model.compile()
+    return model
+
+
+def to_channels_last(x: torch.Tensor) -> torch.Tensor:
+    """Convert a batch of images of shape (N, C, H, W) to channels_last memory format."""
+    if x.dim() != 4:
+        return x
+    return x.contiguous(memory_format=torch.channels_last)
+
+
+@torch.no_grad()
+def check_parity(
+    reference: nn.Module,
+    model: nn.Module,
+    x: torch.Tensor,
+    channels_last: bool = False,
+    bf16_autocast: bool = False,
+    tolerance: float | None = None,
+) -> dict:
+    """Compare the logits of an optimized model with those of the eager float32 model.
+
+    Both models are evaluated in eval mode. The difference is measured relative to the
+    largest absolute logit of the reference model, over the outputs of every task of a
+    multi-head model.
+
+    Args:
+        reference (nn.Module): The model without any performance options.
+        model (nn.Module): The model with the performance options, see `optimize_model`.
+        x (torch.Tensor): A batch of inputs.
+        channels_last (bool): Convert the inputs of `model` to channels_last.
+        bf16_autocast (bool): Evaluate `model` with bfloat16 autocast, see `autocast`.
+        tolerance (float, optional): The maximum relative difference, defaults to 1e-3 in
+            float32 and 5e-2 with bfloat16 autocast.
+
+    Returns:
+        dict: The `max_abs_diff`, `max_rel_diff` and the fraction of the samples with the same
+            predicted class (`top1_agreement`), the lowest one over the tasks.
+    """
+    if tolerance is None:
+        tolerance = 5e-2 if bf16_autocast else 1e-3
+    reference_training, model_training = reference.training, model.training
+    reference.eval()
+    model.eval()
+    try:
+        expected = reference(x)
+        with autocast(x.device, bf16_autocast):
+            actual = model(to_channels_last(x) if channels_last else x)
+    finally:
+        reference.train(reference_training)
+        model.train(model_training)
+    if not isinstance(expected, dict):
+        expected, actual = {"logits": expected}, {"logits": actual}
+
+    max_abs_diff = max(
+        (actual[name].float() - logits.float()).abs().max().item()
+        for name, logits in expected.items()
+    )
+    max_logit = max(logits.float().abs().max().item() for logits in expected.values())
+    results = {
+        "max_abs_diff": max_abs_diff,
+        "max_rel_diff": max_abs_diff / max(max_logit, 1e-12),
+        "top1_agreement": min(
+            (actual[name].argmax(-1) == logits.argmax(-1)).float().mean().item()
+            for name, logits in expected.items()
+        ),
+    }
+    if results["max_rel_diff"] > tolerance:
+        raise ValueError(
+            f"The optimized model differs from the eager float32 model: {results}"
+        )
+    return results
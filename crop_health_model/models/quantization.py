@@ -0,0 +1,48 @@
+import copy
+from typing import Iterable
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+
+def quantize_model(
+    model: nn.Module, calibration_data: Iterable[torch.Tensor], backend: str = "x86"
+) -> nn.Module:
+    """Quantize the weights and activations of a float model to int8 after training.
+
+    The model is traced with FX graph mode quantization, which fuses the conv-bn-relu
+    sequences, then observers record the range of the activations on the calibration
+    batches, and the model is converted to int8 kernels of the quantized backend.
+
+    Args:
+        model (nn.Module): The float model, such as a `ResNet`. It isn't modified.
+        calibration_data (Iterable[torch.Tensor]): Batches of inputs representative of the
+            data the model is used on, such as a sample of the validation split.
+        backend (str): The quantized engine, `x86` (or `fbgemm`) on x86 CPUs and `qnnpack`
+            on ARM CPUs.
+
+    Returns:
+        nn.Module: The int8 model, which only runs on CPU.
+    """
+    if backend not in torch.backends.quantized.supported_engines:
+        raise ValueError(
+            f"Unsupported quantized engine {backend}, "
+            f"use one of {torch.backends.quantized.supported_engines}"
+        )
+    torch.backends.quantized.engine = backend
+
+    model = copy.deepcopy(model).cpu().eval()
+    prepared = None
+    with torch.no_grad():
+        for x in calibration_data:
+            if prepared is None:
+                # the first batch is the example input used to trace the model
+                prepared = prepare_fx(
+                    model, get_default_qconfig_mapping(backend), (x.cpu(),)
+                )
+            prepared(x.cpu())
+    if prepared is None:
+        raise ValueError("At least one calibration batch is required")
+    return convert_fx(prepared)
@@ -0,0 +1,48 @@
+import os
+
+from jsonargparse import CLI
+
+from crop_health_model.models.loading import load_run
+from crop_health_model.models.onnx_export import check_onnx_parity, export_onnx
+
+
+def export_run(
+    run_dir: str,
+    checkpoint: str = "checkpoints/best_model.pt",
+    output: str = "checkpoints/best_model.onnx",
+    num_samples: int = 8,
+    tolerance: float = 1e-3,
+) -> dict:
+    """Export the model of a training run to ONNX and check it on validation images.
+
+    This does the same as the `SaveOnnxModelCallback`, for runs trained without it.
+
+    Args:
+        run_dir (str): The log directory of the run, such as `tb_logs/binary/version_0`.
+        checkpoint (str): Path of the simplified checkpoint, relative to `run_dir`.
+        output (str): Path to save the ONNX model to, relative to `run_dir`.
+        num_samples (int): Number of validation images used to check the ONNX model.
+        tolerance (float): The maximum difference between the logits of the ONNX and
+            PyTorch models, relative to the largest logit.
+
+    Returns:
+        dict: The differences between the ONNX and PyTorch models, see `check_onnx_parity`.
+    """
+    model, datamodule = load_run(run_dir, checkpoint)
+    datamodule.prepare_data()
+    datamodule.setup("validate")
+    x, _ = next(iter(datamodule.val_dataloader()))
+    x = x[:num_samples]
+    if datamodule.batch_transform is not None:
+        x = datamodule.batch_transform(x)
+
+    output_path = os.path.join(run_dir, output)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    export_onnx(model, x, output_path)
+    results = check_onnx_parity(model, output_path, x, tolerance)
+    print(f"ONNX model saved to {output_path} ({results})")
+    return results
+
+
+if __name__ == "__main__":
+    CLI(export_run)
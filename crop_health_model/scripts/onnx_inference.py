@@ -0,0 +1,148 @@
+import json
+import os
+from typing import Callable
+
+import numpy as np
+import yaml
+from jsonargparse import CLI
+from PIL import Image
+
+from crop_health_model.engines.callbacks import handler_image_processing
+from crop_health_model.models.onnx_export import onnx_session
+
+
+class OnnxRunner:
+    """Classify images with an ONNX model on ONNX Runtime, without PyTorch or TorchServe.
+
+    The images are preprocessed like in the handler script generated by
+    `SaveModelHandlerCallback`, and the predictions have the same format as the responses
+    of the handler: the probability of every class by class name, sorted by probability,
+    or such a dict for every task of a multi-head model.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        image_processing: Callable,
+        mapping: dict | None = None,
+        num_threads: int | None = None,
+    ) -> None:
+        """
+        Args:
+            model_path (str): Path of the `.onnx` file.
+            image_processing (Callable): Transforms a PIL image into the input tensor of the
+                model, see `handler_image_processing`.
+            mapping (dict, optional): The `index_to_name.json` of the run, or the
+                `task_index_to_name.json` of a multi-head model. Without it, the classes are
+                named by their index.
+            num_threads (int, optional): Number of threads of ONNX Runtime.
+        """
+        self.session = onnx_session(model_path, num_threads)
+        self.output_names = [output.name for output in self.session.get_outputs()]
+        self.image_processing = image_processing
+        self.mapping = mapping
+
+    @classmethod
+    def from_run(
+        cls,
+        run_dir: str,
+        model: str = "checkpoints/best_model.onnx",
+        num_threads: int | None = None,
+    ) -> "OnnxRunner":
+        """Create the runner of a training run from its `config.yaml` and class names.
+
+        Args:
+            run_dir (str): The log directory of the run, such as `tb_logs/binary/version_0`.
+            model (str): Path of the ONNX model, relative to `run_dir`.
+            num_threads (int, optional): Number of threads of ONNX Runtime.
+        """
+        with open(os.path.join(run_dir, "config.yaml"), "r") as f:
+            data_config = yaml.safe_load(f)["data"]
+        mapping = None
+        # the class names of every task of a multi-head model, or of the single task
+        for filename in ("task_index_to_name.json", "index_to_name.json"):
+            mapping_path = os.path.join(run_dir, filename)
+            if os.path.exists(mapping_path):
+                with open(mapping_path, "r") as f:
+                    mapping = json.load(f)
+                break
+        return cls(
+            os.path.join(run_dir, model),
+            handler_image_processing(data_config),
+            mapping,
+            num_threads,
+        )
+
+    def preprocess(self, images: list[Image.Image]) -> np.ndarray:
+        """Transform the images into a batch of inputs of the model."""
+        return np.stack(
+            [self.image_processing(image.convert("RGB")).numpy() for image in images]
+        ).astype(np.float32)
+
+    def postprocess(self, outputs: list[np.ndarray]) -> list[dict]:
+        """Turn the logits of every output into the class probabilities of every image."""
+        predictions = [{} for _ in range(len(outputs[0]))]
+        for name, logits in zip(self.output_names, outputs):
+            # a single-task model has a single `logits` output
+            mapping = self.mapping
+            if mapping is not None and name in mapping:
+                mapping = mapping[name]
+            logits = logits - logits.max(axis=1, keepdims=True)
+            probabilities = np.exp(logits)
+            probabilities /= probabilities.sum(axis=1, keepdims=True)
+            for prediction, probs in zip(predictions, probabilities):
+                classes = {
+                    (mapping[str(idx)] if mapping is not None else str(idx)): float(p)
+                    for idx, p in enumerate(probs)
+                }
+                prediction[name] = dict(
+                    sorted(classes.items(), key=lambda item: item[1], reverse=True)
+                )
+        if self.output_names == ["logits"]:
+            return [prediction["logits"] for prediction in predictions]
+        return predictions
+
+    def predict(self, images: list[Image.Image], batch_size: int = 32) -> list[dict]:
+        """Return the class probabilities of every image, see `postprocess`."""
+        predictions = []
+        for start in range(0, len(images), batch_size):
+            x = self.preprocess(images[start : start + batch_size])
+            predictions += self.postprocess(self.session.run(None, {"input": x}))
+        return predictions
+
+
+def predict(
+    run_dir: str,
+    images: list[str],
+    model: str = "checkpoints/best_model.onnx",
+    batch_size: int = 32,
+    num_threads: int | None = None,
+) -> dict:
+    """Classify image files with the ONNX model of a training run and print the results.
+
+    Args:
+        run_dir (str): The log directory of the run, such as `tb_logs/binary/version_0`.
+        images (list[str]): Paths of the images.
+        model (str): Path of the ONNX model, relative to `run_dir`.
+        batch_size (int): Number of images per forward pass.
+        num_threads (int, optional): Number of threads of ONNX Runtime.
+
+    Returns:
+        dict: The class probabilities of every image, by path.
+    """
+    runner = OnnxRunner.from_run(run_dir, model, num_threads)
+    predictions = {}
+    for start in range(0, len(images), batch_size):
+        paths = images[start : start + batch_size]
+        batch = []
+        for path in paths:
+            with Image.open(path) as image:
+                image.load()
+                batch.append(image)
+        predictions.update(zip(paths, runner.predict(batch, batch_size)))
+    print(json.dumps(predictions, indent=2))
+    return predictions
+
+
+if __name__ == "__main__":
+    CLI(predict)
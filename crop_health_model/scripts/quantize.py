@@ -0,0 +1,234 @@
+import copy
+import itertools
+import json
+import os
+from typing import Iterable
+
+import torch
+import torch.nn as nn
+from jsonargparse import CLI
+from torch.utils.data import DataLoader, Subset
+
+from crop_health_model.benchmarks.backbones import measure_latency
+from crop_health_model.datasets.datamodule import CropHealthDataModule
+from crop_health_model.datasets.shards import ShardedCropHealthDataset
+from crop_health_model.engines.system import LitModel
+from crop_health_model.models.loading import load_run
+from crop_health_model.models.quantization import quantize_model
+
+
+def calibration_batches(
+    datamodule: CropHealthDataModule, num_batches: int, seed: int = 0
+) -> Iterable:
+    """Return a random sample of batches of the validation split to calibrate a model on.
+
+    The first batches of the split aren't representative, since its samples are sorted by
+    dataset and class. The sample is drawn with a seed, so it is the same on every run.
+
+    Args:
+        datamodule (CropHealthDataModule): The datamodule, set up for validation.
+        num_batches (int): Number of batches of the sample.
+        seed (int): The seed of the sample.
+
+    Returns:
+        Iterable: The batches of images and labels.
+    """
+    dataset = datamodule.val_data
+    if isinstance(dataset, ShardedCropHealthDataset):
+        # the shards are streamed, so their samples are shuffled instead
+        dataset = copy.copy(dataset)
+        dataset.shuffle = True
+        dataset.seed = seed
+        return itertools.islice(datamodule._dataloader(dataset), num_batches)
+
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randperm(len(dataset), generator=generator)
+    return datamodule._dataloader(
+        Subset(dataset, indices[: num_batches * datamodule.batch_size].tolist())
+    )
+
+
+@torch.no_grad()
+def evaluate(
+    models: dict[str, nn.Module],
+    dataloader: DataLoader,
+    num_classes: dict[str, int],
+    batch_transform: nn.Module | None = None,
+) -> dict:
+    """Compute the accuracy and macro-F1 score of several models on the same batches.
+
+    Args:
+        models (dict[str, nn.Module]): The models to evaluate, by name.
+        dataloader (DataLoader): The batches of images and labels.
+        num_classes (dict[str, int]): The number of classes of every task of the models. A
+            multi-head model returns the logits of every task in a dict, and has one column
+            of labels per task.
+        batch_transform (nn.Module, optional): The transform of the uint8 batches of the
+            datamodule, see `CropHealthDataModule.batch_transform`.
+
+    Returns:
+        dict: The `acc` and `f1` of every task of every model.
+    """
+    tasks = list(num_classes)
+    metrics = {
+        name: {task: LitModel._metrics(num_classes[task]) for task in tasks}
+        for name in models
+    }
+
+    for x, y in dataloader:
+        if batch_transform is not None:
+            x = batch_transform(x)
+        for name, model in models.items():
+            output = model(x)
+            if not isinstance(output, dict):
+                output = {tasks[0]: output}
+                y_tasks = {tasks[0]: y}
+            else:
+                y_tasks = {task: y[:, i] for i, task in enumerate(tasks)}
+            for task in tasks:
+                metrics[name][task].update(
+                    torch.argmax(output[task], dim=-1), y_tasks[task]
+                )
+
+    return {
+        name: {
+            task: {key: value.item() for key, value in task_metrics.compute().items()}
+            for task, task_metrics in model_metrics.items()
+        }
+        for name, model_metrics in metrics.items()
+    }
+
+
+def quantize(
+    run_dir: str,
+    checkpoint: str = "checkpoints/best_model.pt",
+    output: str = "checkpoints/best_model_int8.pt",
+    report: str = "quantization.json",
+    backend: str = "x86",
+    num_calibration_batches: int = 10,
+    calibration_seed: int = 0,
+    max_f1_drop: float = 0.01,
+    num_threads: int = 1,
+    latency_iterations: int = 20,
+) -> dict:
+    """Quantize the model of a training run to int8 and check that its accuracy holds.
+
+    The weights and activations of the model are quantized to int8 after training, using a
+    random sample of the validation split of the run to calibrate the activation ranges. The
+    accuracy and macro-F1 score of the float and int8 models are then compared on the whole
+    validation split, and their latency on a single image is measured.
+
+    The int8 model is saved as TorchScript, which TorchServe loads without a model script,
+    only if the macro-F1 score of no task drops by more than `max_f1_drop`.
+
+    Args:
+        run_dir (str): The log directory of the run, such as `tb_logs/binary/version_0`.
+        checkpoint (str): Path of the simplified checkpoint, relative to `run_dir`.
+        output (str): Path to save the int8 TorchScript model to, relative to `run_dir`.
+        report (str): Path to save the comparison to as JSON, relative to `run_dir`. The
+            report is saved even if the int8 model is rejected.
+        backend (str): The quantized engine, `x86` on x86 CPUs and `qnnpack` on ARM CPUs.
+        num_calibration_batches (int): Number of validation batches used for calibration.
+        calibration_seed (int): The seed of the calibration sample, see
+            `calibration_batches`.
+        max_f1_drop (float): The largest accepted drop of the macro-F1 score, in absolute
+            value (0.01 is one point).
+        num_threads (int): Number of CPU threads used to measure the latencies.
+        latency_iterations (int): Number of measured forward passes.
+
+    Returns:
+        dict: The metrics, deltas and latencies of the float and int8 models.
+    """
+    model, datamodule = load_run(run_dir, checkpoint)
+    datamodule.prepare_data()
+    datamodule.setup("validate")
+    dataloader = datamodule.val_dataloader()
+    batch_transform = datamodule.batch_transform
+    num_classes = model.num_classes
+    if not isinstance(num_classes, dict):
+        num_classes = {datamodule.task: num_classes}
+    tasks = list(num_classes)
+
+    def inputs(batches):
+        for x, _ in batches:
+            yield batch_transform(x) if batch_transform is not None else x
+
+    calibration_data = inputs(
+        calibration_batches(datamodule, num_calibration_batches, calibration_seed)
+    )
+    quantized = quantize_model(model, calibration_data, backend)
+
+    metrics = evaluate(
+        {"float": model, "int8": quantized}, dataloader, num_classes, batch_transform
+    )
+    delta = {
+        task: {
+            key: metrics["int8"][task][key] - metrics["float"][task][key]
+            for key in metrics["float"][task]
+        }
+        for task in tasks
+    }
+
+    example = next(inputs(dataloader))[:1]
+    default_num_threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        latency = {
+            name: measure_latency(
+                m,
+                input_size=example.shape[-1],
+                iterations=latency_iterations,
+            )
+            for name, m in (("float", model), ("int8", quantized))
+        }
+    finally:
+        torch.set_num_threads(default_num_threads)
+
+    f1_drop = max(-delta[task]["f1"] for task in tasks)
+    results = {
+        "backend": backend,
+        "num_calibration_batches": num_calibration_batches,
+        "calibration_seed": calibration_seed,
+        "num_threads": num_threads,
+        "metrics": metrics,
+        "delta": delta,
+        "latency_ms": latency,
+        "speedup": latency["float"] / latency["int8"],
+        "max_f1_drop": max_f1_drop,
+        "accepted": f1_drop <= max_f1_drop,
+    }
+    for task in tasks:
+        print(
+            f"{task}: accuracy {metrics['float'][task]['acc']:.4f} -> "
+            f"{metrics['int8'][task]['acc']:.4f}, "
+            f"macro-F1 {metrics['float'][task]['f1']:.4f} -> "
+            f"{metrics['int8'][task]['f1']:.4f}"
+        )
+    print(
+        f"Latency: {latency['float']:.1f} ms -> {latency['int8']:.1f} ms "
+        f"({results['speedup']:.2f}x) on {num_threads} thread(s)"
+    )
+
+    report_path = os.path.join(run_dir, report)
+    with open(report_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Quantization report saved to {report_path}")
+
+    if not results["accepted"]:
+        raise ValueError(
+            f"The macro-F1 score of the int8 model drops by {f1_drop:.4f}, more than "
+            f"{max_f1_drop}, so it isn't saved"
+        )
+
+    # trace the int8 model into TorchScript, which TorchServe runs without the model script
+    output_path = os.path.join(run_dir, output)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with torch.no_grad():
+        scripted = torch.jit.trace(quantized, example, strict=False)
+    torch.jit.save(scripted, output_path)
+    print(f"Int8 model saved to {output_path}")
+    return results
+
+
+if __name__ == "__main__":
+    CLI(quantize)
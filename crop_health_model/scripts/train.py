@@ -3,6 +3,7 @@ from lightning.pytorch import seed_everything
 from lightning.pytorch.cli import LightningCLI
 
 from crop_health_model.datasets.datamodule import CropHealthDataModule
+from crop_health_model.engines.callbacks import SaveConfigWithSplitCallback
 from crop_health_model.engines.system import LitModel
 
 torch.set_float32_matmul_precision("medium")
@@ -13,12 +14,31 @@ torch.set_float32_matmul_precision("medium")
 seed_everything(42, workers=True)
 
 
-def main():
-    cli = LightningCLI(
+class CropHealthCLI(LightningCLI):
+    """LightningCLI that doesn't load pretrained weights when evaluating a checkpoint."""
+
+    def before_instantiate_classes(self) -> None:
+        # only the evaluations, a resumed fit builds the model like the run it resumes
+        if self.subcommand not in ("validate", "test", "predict"):
+            return
+        config = self.config[self.subcommand]
+        if config.get("ckpt_path") is None:
+            return
+        # the weights of the checkpoint replace the pretrained ones, which would otherwise
+        # be downloaded and loaded for nothing
+        if config.get("model.model.init_args.weights") is not None:
+            config["model.model.init_args.weights"] = None
+
+
+def main(args: list[str] | None = None) -> CropHealthCLI:
+    cli = CropHealthCLI(
         model_class=LitModel,
         datamodule_class=CropHealthDataModule,
         seed_everything_default=False,
+        save_config_callback=SaveConfigWithSplitCallback,
+        args=args,
     )
+    return cli
 
 
 if __name__ == "__main__":
@@ -0,0 +1,123 @@
+import itertools
+import os
+import time
+
+import torch
+import yaml
+from jsonargparse import CLI
+
+from crop_health_model.datasets.datamodule import CropHealthDataModule
+from crop_health_model.models.loading import load_datamodule
+
+
+def benchmark_dataloader(
+    datamodule: CropHealthDataModule, num_batches: int = 50, epochs: int = 2
+) -> float:
+    """Measure how many training images per second the datamodule loads.
+
+    Every epoch creates a new iterator over the train dataloader, like the Trainer, so the
+    cost of starting the workers is included. Only the first `num_batches` batches of every
+    epoch are loaded.
+
+    Returns:
+        float: The number of images per second.
+    """
+    dataloader = datamodule.train_dataloader()
+    num_images = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for batch_idx, (images, _) in enumerate(dataloader):
+            if datamodule.pin_memory and torch.cuda.is_available():
+                images = images.to("cuda", non_blocking=True)
+            num_images += len(images)
+            if batch_idx + 1 >= num_batches:
+                break
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return num_images / (time.perf_counter() - start)
+
+
+def tune_dataloader(
+    config_path: str,
+    output: str = "dataloader.yaml",
+    num_workers: list[int] | None = None,
+    prefetch_factors: list[int] = [2, 4, 8],
+    persistent_workers: list[bool] = [False, True],
+    batch_sizes: list[int] | None = None,
+    num_batches: int = 50,
+    epochs: int = 2,
+) -> dict:
+    """Find the fastest DataLoader settings for the training data on this machine.
+
+    The training images per second are measured for every combination of the settings, and
+    the best settings are saved as a config fragment, which can be passed to train.py as a
+    second config: `train.py --config <config_path> --config <output> fit`.
+
+    Args:
+        config_path (str): Path to the training config, such as `configs/config_binary.yaml`.
+        output (str): Path to save the config fragment with the best settings to.
+        num_workers (list[int], optional): The numbers of workers to try, defaults to a
+            quarter, half and all of the CPUs.
+        prefetch_factors (list[int]): The numbers of batches prefetched by each worker to try.
+        persistent_workers (list[bool]): Whether to keep the workers between epochs.
+        batch_sizes (list[int], optional): The batch sizes to try, defaults to the one of the
+            config. Note that the batch size also changes the training itself.
+        num_batches (int): Number of batches loaded per epoch for every combination.
+        epochs (int): Number of epochs loaded for every combination.
+
+    Returns:
+        dict: The best settings.
+    """
+    datamodule = load_datamodule(config_path)
+    datamodule.prepare_data()
+    datamodule.setup("fit")
+
+    if num_workers is None:
+        num_cpus = os.cpu_count() or 1
+        num_workers = sorted({max(1, num_cpus // 4), max(1, num_cpus // 2), num_cpus})
+    if batch_sizes is None:
+        batch_sizes = [datamodule.batch_size]
+    if datamodule.shards_dir is not None:
+        # the shards don't support persistent workers
+        persistent_workers = [False]
+    # pinned memory only makes the copy to the GPU faster
+    pin_memory = torch.cuda.is_available()
+
+    combinations = set()
+    for workers, prefetch_factor, persistent, batch_size in itertools.product(
+        num_workers, prefetch_factors, persistent_workers, batch_sizes
+    ):
+        if workers == 0:
+            # the other settings only apply to worker processes
+            prefetch_factor, persistent = None, False
+        combinations.add((workers, prefetch_factor, persistent, batch_size))
+
+    results = []
+    for workers, prefetch_factor, persistent, batch_size in sorted(
+        combinations, key=lambda combination: (combination[0], combination[1] or 0)
+    ):
+        settings = {
+            "batch_size": batch_size,
+            "num_workers": workers,
+            "prefetch_factor": prefetch_factor,
+            "persistent_workers": persistent,
+            "pin_memory": pin_memory,
+        }
+        for key, value in settings.items():
+            setattr(datamodule, key, value)
+        images_per_second = benchmark_dataloader(datamodule, num_batches, epochs)
+        results.append((images_per_second, settings))
+        print(f"{images_per_second:8.1f} images/s with {settings}")
+
+    images_per_second, best = max(results, key=lambda result: result[0])
+    print(f"Best: {images_per_second:.1f} images/s with {best}")
+
+    with open(output, "w") as f:
+        f.write(f"# {images_per_second:.1f} images/s, found by tune_dataloader.py\n")
+        yaml.safe_dump({"fit": {"data": best}}, f, sort_keys=False)
+    print(f"DataLoader settings saved to {output}")
+    return best
+
+
+if __name__ == "__main__":
+    CLI(tune_dataloader)
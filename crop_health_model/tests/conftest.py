@@ -0,0 +1,113 @@
+import os
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+import yaml
+from PIL import Image
+from torchvision import transforms
+
+from crop_health_model.datasets.datamodule import CropHealthDataModule
+from crop_health_model.models.model import ResNet
+
+
+@pytest.fixture
+def image_dataset(tmp_path) -> Callable[..., pd.DataFrame]:
+    """Factory writing images and their `annotations.csv` file to `tmp_path`.
+
+    The sizes, labels and crop types are cycled over the images. The images are
+    random JPEGs, or PNGs filled with their index with `index_pixels` so that a
+    sample can be identified after it's loaded.
+    """
+
+    def create(
+        num_images: int = 12,
+        sizes: tuple[tuple[int, int], ...] = ((40, 40),),
+        labels: tuple[str, ...] = ("HLT", "MSV", "MLN"),
+        crop_types: tuple[str, ...] = ("maize", "maize", "maize", "beans"),
+        index_pixels: bool = False,
+    ) -> pd.DataFrame:
+        rng = np.random.default_rng(0)
+        extension = "png" if index_pixels else "jpg"
+        images = [f"img{i}.{extension}" for i in range(num_images)]
+        sizes = [sizes[i % len(sizes)] for i in range(num_images)]
+        for i, (image, (width, height)) in enumerate(zip(images, sizes)):
+            if index_pixels:
+                array = np.full((height, width, 3), i, dtype=np.uint8)
+            else:
+                array = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+            Image.fromarray(array).save(tmp_path / image)
+        df = pd.DataFrame(
+            {
+                "image": images,
+                "width": [width for width, _ in sizes],
+                "height": [height for _, height in sizes],
+                "label": [labels[i % len(labels)] for i in range(num_images)],
+                "crop_type": [
+                    crop_types[i % len(crop_types)] for i in range(num_images)
+                ],
+            }
+        )
+        df.to_csv(tmp_path / "annotations.csv", index=False)
+        return df
+
+    return create
+
+
+@pytest.fixture
+def crop_datamodule(tmp_path) -> Callable[..., CropHealthDataModule]:
+    """Factory of a datamodule over the images of `image_dataset`, center cropped to
+    32x32 and split in halves."""
+
+    def create(task: str, train_transforms: list | None = None) -> CropHealthDataModule:
+        crop = transforms.CenterCrop(32)
+        return CropHealthDataModule(
+            batch_size=4,
+            task=task,
+            data_dir=str(tmp_path),
+            num_workers=0,
+            data_split=(0.5, 0.5),
+            train_transforms=train_transforms or [crop],
+            test_transforms=[crop],
+        )
+
+    return create
+
+
+@pytest.fixture
+def run_dir(tmp_path, image_dataset) -> str:
+    """A training run of a binary ResNet-18, with its config and best checkpoint."""
+    image_dataset(num_images=16, labels=("HLT", "MSV"), crop_types=("maize",))
+
+    run_dir = tmp_path / "version_0"
+    os.makedirs(run_dir / "checkpoints")
+    crop = {
+        "class_path": "torchvision.transforms.CenterCrop",
+        "init_args": {"size": 32},
+    }
+    config = {
+        "model": {
+            "model": {
+                "class_path": "crop_health_model.models.model.ResNet",
+                "init_args": {"num_classes": 2, "num_layers": 18, "weights": "DEFAULT"},
+            }
+        },
+        "data": {
+            "batch_size": 4,
+            "task": "binary",
+            "data_dir": str(tmp_path),
+            "num_workers": 0,
+            "data_split": [0.5, 0.5],
+            "train_transforms": [crop],
+            "test_transforms": [crop],
+        },
+    }
+    (run_dir / "config.yaml").write_text(yaml.safe_dump(config))
+    torch.manual_seed(0)
+    torch.save(
+        ResNet(num_classes=2, num_layers=18).state_dict(),
+        run_dir / "checkpoints" / "best_model.pt",
+    )
+    return str(run_dir)
@@ -0,0 +1,50 @@
+import importlib.util
+
+import pytest
+import torch
+
+from crop_health_model.engines.callbacks import SaveModelScriptCallback
+from crop_health_model.models.backbones import BACKBONES, BackboneClassifier
+
+
+@pytest.mark.parametrize(
+    "architecture", ["mobilenet_v3_small", "efficientnet_b0", "regnet_y_400mf"]
+)
+def test_backbone_classifier(architecture):
+    model = BackboneClassifier(architecture, num_classes=2).eval()
+    # the recorded parameter count is measured with 2 classes
+    assert (
+        sum(p.numel() for p in model.parameters())
+        == BACKBONES[architecture]["num_params"]
+    )
+    x = torch.randn(2, 3, 64, 64)
+    with torch.no_grad():
+        logits = model(x)
+        features = model.forward_features(x)
+    assert logits.shape == (2, 2)
+    assert features.shape == (2, model.head.in_features)
+    assert torch.allclose(model.forward_head(features), logits)
+
+
+def test_invalid_architecture():
+    with pytest.raises(ValueError, match="Invalid architecture"):
+        BackboneClassifier("vgg16", num_classes=2)
+
+
+def test_model_script(tmp_path):
+    filepath = tmp_path / "model_script.py"
+    callback = SaveModelScriptCallback(
+        "model_script.py", "crop_health_model/models/backbones.py"
+    )
+    callback.save_model_script(
+        {"architecture": "mobilenet_v3_small", "num_classes": 13}, str(filepath)
+    )
+    assert "architecture: str = 'mobilenet_v3_small'" in filepath.read_text()
+    spec = importlib.util.spec_from_file_location("model_script", filepath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    model = module.BackboneClassifier()
+    assert model.get_hyperparameters() == {
+        "architecture": "mobilenet_v3_small",
+        "num_classes": 13,
+    }
@@ -0,0 +1,113 @@
+import torch
+import yaml
+from PIL import Image
+from torchvision import transforms
+
+from crop_health_model.datasets.datamodule import CropHealthDataModule
+from crop_health_model.datasets.transforms import (
+    BatchTransform,
+    split_batch_transforms,
+)
+from crop_health_model.engines.callbacks import SaveModelHandlerCallback
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+def create_datamodule(uint8_batches: bool) -> CropHealthDataModule:
+    return CropHealthDataModule(
+        batch_size=2,
+        task="binary",
+        train_transforms=[
+            transforms.CenterCrop(6),
+            transforms.RandomHorizontalFlip(p=1.0),
+            transforms.RandomVerticalFlip(p=1.0),
+        ],
+        test_transforms=[transforms.CenterCrop(6)],
+        normalization=transforms.Normalize(mean=MEAN, std=STD),
+        uint8_batches=uint8_batches,
+    )
+
+
+def random_images(num_images: int = 4) -> list[Image.Image]:
+    generator = torch.Generator().manual_seed(0)
+    return [
+        transforms.ToPILImage()(
+            torch.randint(0, 256, (3, 8, 8), dtype=torch.uint8, generator=generator)
+        )
+        for _ in range(num_images)
+    ]
+
+
+def test_split_batch_transforms():
+    per_sample, flips = split_batch_transforms(
+        [
+            transforms.RandomHorizontalFlip(p=0.3),
+            transforms.CenterCrop(6),
+            transforms.RandomVerticalFlip(p=0.2),
+            transforms.RandomHorizontalFlip(p=0.5),
+        ]
+    )
+    assert len(per_sample) == 2
+    assert flips == {"horizontal_flip_p": 0.5, "vertical_flip_p": 0.2}
+
+
+def test_uint8_batches_match_float_pipeline():
+    images = random_images()
+    float_datamodule = create_datamodule(uint8_batches=False)
+    uint8_datamodule = create_datamodule(uint8_batches=True)
+
+    for transform_name, train in (("test_transform", False), ("train_transform", True)):
+        expected = torch.stack(
+            [getattr(float_datamodule, transform_name)(image) for image in images]
+        )
+        batch = torch.stack(
+            [getattr(uint8_datamodule, transform_name)(image) for image in images]
+        )
+        assert batch.dtype == torch.uint8
+        actual = uint8_datamodule.batch_transform(batch, train=train)
+        assert torch.allclose(actual, expected, atol=1e-6)
+
+
+def test_batch_transform_flips_per_sample():
+    torch.manual_seed(0)
+    batch = torch.randint(0, 256, (64, 3, 4, 4), dtype=torch.uint8)
+    transform = BatchTransform(horizontal_flip_p=0.5)
+    output = transform(batch, train=True)
+    flipped = torch.isclose(output, batch.float().div(255).flip(-1)).flatten(1).all(1)
+    unchanged = torch.isclose(output, batch.float().div(255)).flatten(1).all(1)
+    assert (flipped | unchanged).all()
+    assert 0 < flipped.sum() < 64
+    assert torch.equal(transform(batch, train=False), batch.float().div(255))
+    assert len(transform.state_dict()) == 0
+
+
+def test_handler_normalizes_with_uint8_batches(tmp_path):
+    config = {
+        "fit": {
+            "model": {"model": {"init_args": {"num_classes": 2}}},
+            "data": {
+                "uint8_batches": True,
+                "test_transforms": [
+                    {
+                        "class_path": "torchvision.transforms.CenterCrop",
+                        "init_args": {"size": 224},
+                    }
+                ],
+                "normalization": {
+                    "class_path": "torchvision.transforms.Normalize",
+                    "init_args": {"mean": MEAN, "std": STD},
+                },
+            },
+        }
+    }
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(yaml.safe_dump(config))
+    handler_path = tmp_path / "model_handler.py"
+
+    callback = SaveModelHandlerCallback("model_handler.py", str(config_path))
+    callback.generate_handler_script(str(handler_path))
+
+    handler = handler_path.read_text()
+    assert "transforms.ToTensor()" in handler
+    assert f"transforms.Normalize(mean={MEAN}, std={STD})" in handler
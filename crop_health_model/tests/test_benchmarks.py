@@ -0,0 +1,111 @@
+import json
+
+import pandas as pd
+import yaml
+from PIL import Image
+
+from crop_health_model.benchmarks.data_loading import benchmark_data_loading
+from crop_health_model.benchmarks.synthetic_corpus import (
+    class_counts,
+    make_synthetic_corpus,
+)
+from crop_health_model.data.metadata import (
+    maize_dataset_tanzania,
+    spectrometry_cassava_dataset,
+)
+from crop_health_model.datasets.dataset import CropHealthDataset
+
+image_sizes = [((40, 30), 0.5), ((24, 32), 0.5)]
+
+
+def test_class_counts():
+    assert class_counts(maize_dataset_tanzania) == {
+        "MLN": 5068,
+        "MSV": 6667,
+        "HEATHLY": 5542,
+    }
+    # the classes without a count share the total image count
+    assert class_counts(spectrometry_cassava_dataset) == {
+        "CBSD": 2620,
+        "CMD": 2620,
+        "HLT": 2620,
+    }
+
+
+def test_make_synthetic_corpus(tmp_path):
+    datasets = [spectrometry_cassava_dataset, maize_dataset_tanzania]
+    annotations_file = make_synthetic_corpus(
+        str(tmp_path), 0.001, datasets, image_sizes, max_workers=2
+    )
+    df = pd.read_csv(annotations_file)
+    assert len(df) == 3 * 3 + 5 + 7 + 6
+    assert set(df["label"]) == {"CBSD", "CMD", "HLT", "MLN", "MSV"}
+    for row in df.itertuples():
+        with Image.open(tmp_path / row.image) as image:
+            assert image.size == (row.width, row.height)
+
+    dataset = CropHealthDataset(annotations_file, str(tmp_path), "multi-HLT")
+    assert len(dataset.class_map) == 6
+
+    # the same corpus is reused
+    mtime = (tmp_path / df["image"][0]).stat().st_mtime_ns
+    make_synthetic_corpus(str(tmp_path), 0.001, datasets, image_sizes, max_workers=2)
+    assert (tmp_path / df["image"][0]).stat().st_mtime_ns == mtime
+
+
+def test_benchmark_data_loading(tmp_path):
+    resize = {"class_path": "torchvision.transforms.Resize", "init_args": {"size": 16}}
+    crop = {
+        "class_path": "torchvision.transforms.CenterCrop",
+        "init_args": {"size": 16},
+    }
+    flip = {
+        "class_path": "torchvision.transforms.RandomHorizontalFlip",
+        "init_args": {"p": 0.5},
+    }
+    config = {
+        "fit": {
+            "data": {
+                "batch_size": 2,
+                "task": "binary",
+                "train_transforms": [resize, crop, flip],
+                "test_transforms": [resize, crop],
+            }
+        }
+    }
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(yaml.safe_dump(config))
+
+    output = tmp_path / "results.json"
+    benchmark_data_loading(
+        configs=[str(config_path)],
+        tasks=["binary", "multi-HLT"],
+        data_dir=str(tmp_path / "data"),
+        scale=0.0001,
+        image_sizes=image_sizes,
+        num_samples=8,
+        batch_size=4,
+        output=str(output),
+    )
+    report = json.loads(output.read_text())
+    assert report["settings"]["num_samples"] == 8
+    results = report["results"]
+    assert [(r["task"], r["pipeline"]) for r in results] == [
+        ("binary", "train"),
+        ("binary", "test"),
+        ("multi-HLT", "train"),
+        ("multi-HLT", "test"),
+    ]
+    assert results[0]["num_classes"] == 2
+    assert list(results[0]["stages"]) == [
+        "read",
+        "decode",
+        "Resize",
+        "CenterCrop",
+        "RandomHorizontalFlip",
+        "ToTensor",
+        "collate",
+    ]
+    assert results[0]["stages"]["read"]["count"] == 8
+    assert results[0]["stages"]["collate"]["count"] == 2
+    assert all(r["samples_per_second"] > 0 for r in results)
@@ -2,8 +2,22 @@ import os
 
 import pandas as pd
 import pytest
-
-from crop_health_model.datasets.dataset import CropHealthDataset
+import torch
+from PIL import Image
+from torch.utils.data import Subset
+from torchvision.transforms import ToTensor
+
+from crop_health_model.datasets.annotations import (
+    arrow_path,
+    read_annotations,
+    write_annotations_arrow,
+)
+from crop_health_model.datasets.dataset import (
+    TASKS,
+    CropHealthDataset,
+    TransformWrapperDataset,
+    draft_scale,
+)
 
 TMP_DATA_PATH = "tmp_data.csv"
 
@@ -30,6 +44,12 @@ def create_dummy_dataset() -> None:
     df.to_csv(TMP_DATA_PATH, index=False)
 
 
+def label_names(dataset: CropHealthDataset) -> list[str]:
+    # the class names of the labels of the samples
+    names = {idx: name for name, idx in dataset.class_map.items()}
+    return [names[label] for label in dataset.labels.tolist()]
+
+
 def cleanup_dummy_dataset() -> None:
     os.remove(TMP_DATA_PATH)
 
@@ -46,7 +66,7 @@ def test_dataset_multi_HLT():
     )
 
     assert len(dataset) == 6
-    assert dataset.data_df["label"].tolist() == [
+    assert label_names(dataset) == [
         "HLT_apple",
         "SICKa_apple",
         "SICKb_banana",
@@ -87,7 +107,7 @@ def test_dataset_single_HLT():
     )
 
     assert len(dataset) == 6
-    assert dataset.data_df["label"].tolist() == [
+    assert label_names(dataset) == [
         "HLT",
         "SICKa",
         "SICKb",
@@ -121,7 +141,7 @@ def test_dataset_binary():
     )
 
     assert len(dataset) == 6
-    assert dataset.data_df["label"].tolist() == [
+    assert label_names(dataset) == [
         "HLT",
         "NOT_HLT",
         "NOT_HLT",
@@ -155,3 +175,115 @@ def test_inavlid_task():
 
     # cleanup
     cleanup_dummy_dataset()
+
+
+def test_draft_scale():
+    assert draft_scale(300, 200, 256) == 1
+    assert draft_scale(640, 512, 256) == 2
+    assert draft_scale(3000, 4000, 256) == 8
+    assert draft_scale(1200, 1100, 256) == 4
+
+
+def test_dataset_decode_size(tmp_path):
+    Image.new("RGB", (1200, 1100)).save(tmp_path / "img.jpg")
+    pd.DataFrame(
+        {
+            "image": ["img.jpg"],
+            "width": [1200],
+            "height": [1100],
+            "label": ["HLT"],
+            "crop_type": ["maize"],
+        }
+    ).to_csv(tmp_path / "annotations.csv", index=False)
+
+    dataset = CropHealthDataset(
+        annotations_file=str(tmp_path / "annotations.csv"),
+        img_dir=str(tmp_path),
+        task="binary",
+        decode_size=256,
+    )
+    image, _ = dataset[0]
+    assert image.size == (300, 275)
+
+
+def test_sample_index():
+    create_dummy_dataset()
+
+    dataset = CropHealthDataset(
+        annotations_file=TMP_DATA_PATH,
+        img_dir=".",
+        task="single-HLT",
+        transform=None,
+        limit=None,
+    )
+
+    assert [dataset.index.path(i) for i in range(len(dataset))] == [
+        f"img{i}.jpg" for i in range(1, 7)
+    ]
+    assert dataset.index.labels["binary"].tolist() == [0, 1, 1, 1, 0, 1]
+    assert dataset.index.labels["multi-HLT"].tolist() == [0, 1, 2, 2, 3, 4]
+    assert dataset.get_class_counts([1, 2, 3]) == {1: 1, 2: 2}
+
+    # class counts of a subset of a subset are resolved to the original dataset
+    subset = Subset(Subset(dataset, [5, 4, 3, 2]), [0, 2, 3])
+    wrapped = TransformWrapperDataset(subset)
+    assert wrapped.get_class_counts() == {2: 2, 3: 1}
+
+    # cleanup
+    cleanup_dummy_dataset()
+
+
+def test_dataset_getitems_threads(tmp_path):
+    for i in range(6):
+        Image.new("RGB", (20 + i, 20), color=(10 * i, 0, 0)).save(
+            tmp_path / f"img{i + 1}.jpg"
+        )
+    create_dummy_dataset()
+    dataset = CropHealthDataset(
+        annotations_file=TMP_DATA_PATH,
+        img_dir=str(tmp_path),
+        task="single-HLT",
+        num_threads=3,
+    )
+    wrapped = TransformWrapperDataset(
+        Subset(dataset, [5, 3, 1, 0]), transform=ToTensor(), num_threads=3
+    )
+
+    batch = wrapped.__getitems__([0, 1, 2, 3])
+    for (image, label), idx in zip(batch, [5, 3, 1, 0]):
+        expected_image, expected_label = dataset[idx]
+        assert torch.equal(image, ToTensor()(expected_image))
+        assert label == expected_label
+    assert [image.size for image, _ in dataset.__getitems__([0, 2])] == [
+        (20, 20),
+        (22, 20),
+    ]
+
+    # cleanup
+    cleanup_dummy_dataset()
+
+
+def test_dataset_arrow_annotations(tmp_path):
+    pytest.importorskip("pyarrow")
+    create_dummy_dataset()
+    df = pd.read_csv(TMP_DATA_PATH)
+    cleanup_dummy_dataset()
+    annotations_file = str(tmp_path / "annotations.csv")
+    df.to_csv(annotations_file, index=False)
+    csv_datasets = {
+        task: CropHealthDataset(annotations_file, img_dir=".", task=task)
+        for task in TASKS
+    }
+
+    write_annotations_arrow(df.assign(dataset="dummy"), arrow_path(annotations_file))
+    assert read_annotations(annotations_file)["label"].dtype == "category"
+
+    for task in TASKS:
+        dataset = CropHealthDataset(annotations_file, img_dir=".", task=task, limit=5)
+        assert dataset.class_map == {
+            name: idx
+            for name, idx in csv_datasets[task].class_map.items()
+            if idx in csv_datasets[task].labels[:5]
+        }
+        assert dataset.labels.tolist() == csv_datasets[task].labels[:5].tolist()
+        assert label_names(dataset) == label_names(csv_datasets[task])[:5]
@@ -0,0 +1,69 @@
+import os
+
+import lightning.pytorch as pl
+import numpy as np
+import torch
+from torchvision import transforms
+
+from crop_health_model.datasets.datamodule import CropHealthDataModule
+from crop_health_model.datasets.embeddings import EmbeddingCache
+from crop_health_model.engines.callbacks import EmbeddingCacheCallback
+from crop_health_model.engines.system import LitModel
+from crop_health_model.models.model import ResNet
+
+
+def test_forward_features():
+    torch.manual_seed(0)
+    model = ResNet(num_classes=3, num_layers=18).eval()
+    x = torch.randn(2, 3, 32, 32)
+    with torch.no_grad():
+        features = model.forward_features(x)
+        assert features.shape == (2, 512)
+        assert torch.allclose(model.forward_head(features), model(x), atol=1e-5)
+
+
+def fit_head(datamodule: CropHealthDataModule, num_classes: int) -> LitModel:
+    torch.manual_seed(0)
+    lit_model = LitModel(ResNet(num_classes=num_classes, num_layers=18))
+    lit_model.configure_optimizers = lambda: torch.optim.SGD(
+        lit_model.parameters(), lr=0.1
+    )
+    trainer = pl.Trainer(
+        accelerator="cpu",
+        devices=1,
+        max_epochs=2,
+        logger=False,
+        enable_checkpointing=False,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+        callbacks=[EmbeddingCacheCallback()],
+    )
+    trainer.fit(lit_model, datamodule=datamodule)
+    assert lit_model.head_only
+    return lit_model
+
+
+def test_head_only_training(tmp_path, image_dataset, crop_datamodule):
+    image_dataset()
+    train_transforms = [transforms.CenterCrop(32), transforms.RandomHorizontalFlip()]
+    torch.manual_seed(0)
+    initial = ResNet(num_classes=2, num_layers=18).state_dict()
+    lit_model = fit_head(crop_datamodule("binary", train_transforms), 2)
+
+    # only the head was trained
+    for name, tensor in lit_model.model.state_dict().items():
+        if name.startswith("resnet.fc."):
+            assert not torch.equal(tensor, initial[name])
+        elif "num_batches_tracked" not in name:
+            assert torch.equal(tensor, initial[name]), name
+
+    path = tmp_path / "embeddings.npy"
+    cache = EmbeddingCache(str(path))
+    assert cache.array.dtype == np.float16
+    assert cache.array.shape == (12, 512)
+    assert cache.images == [f"img{i}.jpg" for i in range(12)]
+
+    # the cache is shared by the other tasks
+    mtime = os.path.getmtime(path)
+    fit_head(crop_datamodule("multi-HLT", train_transforms), 5)
+    assert os.path.getmtime(path) == mtime
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from crop_health_model.data.find_duplicates import (
+    deduplicate,
+    duplicate_groups,
+    find_duplicates,
+    hamming_distance,
+    leakage_report,
+)
+
+
+def test_find_duplicates_matches_brute_force():
+    rng = np.random.default_rng(0)
+    hashes = rng.integers(0, 2**63, size=300, dtype=np.uint64)
+    # plant near duplicates by flipping a few bits
+    for i in range(0, 60, 3):
+        bits = rng.choice(64, size=rng.integers(0, 6), replace=False)
+        hashes[i + 100] = hashes[i] ^ np.uint64(sum(1 << int(bit) for bit in bits))
+
+    pairs = find_duplicates(hashes, max_distance=4)
+
+    i, j = np.triu_indices(len(hashes), k=1)
+    distances = hamming_distance(hashes[i], hashes[j])
+    expected = np.column_stack([i, j, distances])[distances <= 4]
+    assert np.array_equal(pairs, expected)
+    assert len(pairs) > 0
+
+
+def test_duplicate_groups_and_leakage():
+    pairs = np.array([[0, 3, 1], [3, 5, 2], [1, 4, 0]])
+    groups = duplicate_groups(6, pairs)
+    assert groups.tolist() == [0, 1, 2, 0, 1, 0]
+
+    splits = {
+        "train": np.array([0, 1]),
+        "val": np.array([2, 3]),
+        "test": np.array([4, 5]),
+    }
+    assert leakage_report(groups, splits) == {
+        "val": {"train": 1},
+        "test": {"train": 2, "val": 1},
+    }
+
+
+def test_deduplicate(tmp_path):
+    rng = np.random.default_rng(0)
+    # smooth random images, like photos
+    images = [
+        np.asarray(
+            Image.fromarray(rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)).resize(
+                (64, 64), Image.BILINEAR
+            )
+        )
+        for _ in range(3)
+    ]
+    Image.fromarray(images[0]).save(tmp_path / "a.jpg")
+    Image.fromarray(images[1]).save(tmp_path / "b.jpg")
+    # an exact copy and a resized, re-encoded copy
+    Image.fromarray(images[0]).save(tmp_path / "a_copy.jpg")
+    Image.fromarray(images[1]).resize((48, 48)).save(
+        tmp_path / "b_small.jpg", quality=80
+    )
+    Image.fromarray(images[2]).save(tmp_path / "c.jpg")
+    df = pd.DataFrame(
+        {
+            "image": ["a.jpg", "b.jpg", "a_copy.jpg", "b_small.jpg", "c.jpg"],
+            "label": ["HLT", "MSV", "HLT", "HLT", "MSV"],
+        }
+    )
+
+    deduplicated, duplicates = deduplicate(df, str(tmp_path))
+
+    assert deduplicated["image"].tolist() == ["a.jpg", "b.jpg", "c.jpg"]
+    assert duplicates.to_dict("list") == {
+        "image": ["a_copy.jpg", "b_small.jpg"],
+        "label": ["HLT", "HLT"],
+        "duplicate_of": ["a.jpg", "b.jpg"],
+        "duplicate_label": ["HLT", "MSV"],
+    }
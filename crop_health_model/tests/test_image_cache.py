@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from torchvision import transforms
+
+from crop_health_model.datasets.cache import ImageCache
+from crop_health_model.datasets.datamodule import CropHealthDataModule
+from crop_health_model.datasets.dataset import CropHealthDataset
+
+CACHE_TRANSFORM = transforms.Compose([transforms.Resize(16), transforms.CenterCrop(12)])
+
+
+@pytest.fixture
+def annotations_file(tmp_path, image_dataset) -> str:
+    # a few random images of different sizes
+    image_dataset(
+        num_images=4,
+        sizes=((40, 30), (30, 40), (64, 64), (50, 20)),
+        labels=("HLT", "SICKa", "HLT", "SICKb"),
+        crop_types=("apple", "apple", "maize", "maize"),
+    )
+    return str(tmp_path / "annotations.csv")
+
+
+def test_image_cache_build(tmp_path, annotations_file):
+    dataset = CropHealthDataset(
+        annotations_file=annotations_file, img_dir=str(tmp_path), task="single-HLT"
+    )
+    images = dataset.data_df["image"].tolist()
+    cache_path = str(tmp_path / "cache.npy")
+
+    cache = ImageCache.load_or_build(cache_path, dataset, images, CACHE_TRANSFORM)
+    assert len(cache) == 4
+    assert cache.array.shape == (4, 12, 12, 3)
+    assert cache.matches(images, CACHE_TRANSFORM)
+
+    cached_dataset = CropHealthDataset(
+        annotations_file=annotations_file,
+        img_dir=str(tmp_path),
+        task="single-HLT",
+        cache=cache,
+    )
+    for idx in range(len(dataset)):
+        image, label = dataset[idx]
+        cached_image, cached_label = cached_dataset[idx]
+        expected = np.asarray(CACHE_TRANSFORM(image.convert("RGB")))
+        assert np.array_equal(np.asarray(cached_image), expected)
+        assert cached_label == label
+
+
+def test_image_cache_stale(tmp_path, annotations_file):
+    dataset = CropHealthDataset(
+        annotations_file=annotations_file, img_dir=str(tmp_path), task="binary"
+    )
+    images = dataset.data_df["image"].tolist()
+    cache_path = str(tmp_path / "cache.npy")
+    ImageCache.build(cache_path, dataset, images, CACHE_TRANSFORM)
+
+    other_transform = transforms.Compose(
+        [transforms.Resize(10), transforms.CenterCrop(8)]
+    )
+    assert not ImageCache(cache_path).matches(images, other_transform)
+    cache = ImageCache.load_or_build(cache_path, dataset, images, other_transform)
+    assert cache.array.shape == (4, 8, 8, 3)
+
+
+def test_image_cache_requires_fixed_shape(tmp_path, annotations_file):
+    dataset = CropHealthDataset(
+        annotations_file=annotations_file, img_dir=str(tmp_path), task="binary"
+    )
+    images = dataset.data_df["image"].tolist()
+    with pytest.raises(ValueError):
+        ImageCache.build(
+            str(tmp_path / "cache.npy"), dataset, images, transforms.Resize(16)
+        )
+
+
+def test_datamodule_cache_transforms():
+    datamodule = CropHealthDataModule(
+        batch_size=2,
+        task="binary",
+        train_transforms=[
+            transforms.Resize(16),
+            transforms.CenterCrop(12),
+            transforms.RandomHorizontalFlip(),
+        ],
+        test_transforms=[transforms.Resize(16), transforms.CenterCrop(12)],
+        cache_file="cache.npy",
+    )
+    assert repr(datamodule.cache_transform) == repr(CACHE_TRANSFORM)
+    assert len(datamodule.train_transform.transforms) == 2
+    assert len(datamodule.test_transform.transforms) == 1
@@ -0,0 +1,90 @@
+import glob
+import os
+
+import pytest
+import torch
+from torchvision.models._api import WeightsEnum
+
+from crop_health_model.models.loading import build_model, load_model
+from crop_health_model.scripts.train import main
+
+
+@pytest.fixture
+def no_download(monkeypatch):
+    def get_state_dict(*args, **kwargs):
+        raise AssertionError("The pretrained weights were loaded")
+
+    monkeypatch.setattr(WeightsEnum, "get_state_dict", get_state_dict)
+
+
+def test_build_model(no_download):
+    model = build_model(
+        {
+            "class_path": "crop_health_model.models.backbones.BackboneClassifier",
+            "init_args": {
+                "architecture": "mobilenet_v3_small",
+                "num_classes": 3,
+                "weights": "DEFAULT",
+            },
+        }
+    )
+    assert model.num_classes == 3
+    assert all(p.is_meta for p in model.parameters())
+
+
+def test_load_model(run_dir, no_download):
+    model, timings = load_model(run_dir)
+
+    state_dict = torch.load(os.path.join(run_dir, "checkpoints", "best_model.pt"))
+    assert not model.training
+    for name, tensor in model.state_dict().items():
+        assert tensor.device.type == "cpu"
+        assert torch.equal(tensor, state_dict[name]), name
+    assert set(timings) == {
+        "config",
+        "build",
+        "load",
+        "assign",
+        "to_device",
+        "total",
+    }
+    assert timings["total"] == pytest.approx(
+        sum(seconds for step, seconds in timings.items() if step != "total")
+    )
+
+
+def test_validate_without_pretrained_weights(tmp_path, run_dir, no_download):
+    config = os.path.join(run_dir, "config.yaml")
+    trainer_args = [
+        "--trainer.accelerator=cpu",
+        "--trainer.devices=1",
+        "--trainer.logger=false",
+        "--trainer.enable_progress_bar=false",
+    ]
+    main(
+        ["fit", "--config", config, "--model.model.init_args.weights=null"]
+        + trainer_args
+        + [
+            f"--trainer.default_root_dir={tmp_path / 'fit'}",
+            "--trainer.max_epochs=1",
+            "--optimizer=torch.optim.SGD",
+            "--optimizer.lr=0.01",
+        ]
+    )
+    (ckpt_path,) = glob.glob(str(tmp_path / "fit" / "checkpoints" / "*.ckpt"))
+
+    # the config still asks for the pretrained weights, which are skipped
+    cli = main(
+        ["validate", "--config", config, "--ckpt_path", ckpt_path]
+        + trainer_args
+        + [f"--trainer.default_root_dir={tmp_path / 'validate'}"]
+    )
+    assert cli.config.validate.model.model.init_args.weights is None
+
+    # a resumed fit builds the model like the config asks
+    with pytest.raises(ValueError, match="pretrained weights were loaded"):
+        main(
+            ["fit", "--config", config, "--ckpt_path", ckpt_path]
+            + trainer_args
+            + [f"--trainer.default_root_dir={tmp_path / 'resume'}"]
+        )
@@ -0,0 +1,166 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from crop_health_model.data import make_annotations_file
+from crop_health_model.data.make_annotations_file import (
+    VALIDATION_LEVELS,
+    generate_all_annotations,
+    generate_annotations,
+    validate_image,
+)
+
+CLASSES = [
+    {"raw": "MSV", "clean": "MSV", "count": 3},
+    {"raw": "HEALTHY", "clean": "HLT", "count": -1},
+]
+
+
+def create_images(img_dir) -> None:
+    for class_dir, num_images in (("MSV", 3), ("HEALTHY", 4), ("__MACOSX/MSV", 2)):
+        os.makedirs(img_dir / class_dir)
+        for i in range(num_images):
+            array = np.full((300, 400, 3), i, dtype=np.uint8)
+            Image.fromarray(array).save(img_dir / class_dir / f"img{i}.jpg")
+    (img_dir / "HEALTHY" / "broken.jpg").write_bytes(b"not an image")
+
+
+def test_generate_annotations(tmp_path):
+    img_dir = tmp_path / "maize-dataset"
+    create_images(img_dir)
+    annotations_file = tmp_path / "annotations.csv"
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        df = generate_annotations(
+            img_dir=str(img_dir),
+            keywords_to_avoid=["MACOSX"],
+            annotations_file_path=str(annotations_file),
+            classes=CLASSES,
+            total_image_count=7,
+            crop_type="maize",
+            data_dir=str(tmp_path),
+            executor=executor,
+            chunksize=2,
+        )
+
+    # deterministic order, without the broken image and the macOS metadata
+    assert df["image"].tolist() == [
+        os.path.join("maize-dataset", "HEALTHY", f"img{i}.jpg") for i in range(4)
+    ] + [os.path.join("maize-dataset", "MSV", f"img{i}.jpg") for i in range(3)]
+    assert df["label"].tolist() == ["HLT"] * 4 + ["MSV"] * 3
+    assert (df["width"] == 400).all() and (df["height"] == 300).all()
+    assert pd.read_csv(annotations_file).equals(df)
+
+
+def test_validate_image_levels(tmp_path):
+    Image.fromarray(np.zeros((300, 400, 3), dtype=np.uint8)).save(tmp_path / "ok.jpg")
+    data = (tmp_path / "ok.jpg").read_bytes()
+    (tmp_path / "truncated.jpg").write_bytes(data[: len(data) // 2])
+    (tmp_path / "padded.jpg").write_bytes(data + b"\x00" * 16)
+    # phones append data such as a motion photo after the end of image marker
+    (tmp_path / "trailer.jpg").write_bytes(
+        data + b"MotionPhoto_Data" + os.urandom(4096)
+    )
+    (tmp_path / "text.jpg").write_bytes(b"not an image")
+
+    for validation in VALIDATION_LEVELS:
+        results = {
+            name: validate_image(str(tmp_path / name), validation, sample_rate=1.0)
+            for name in (
+                "ok.jpg",
+                "truncated.jpg",
+                "padded.jpg",
+                "trailer.jpg",
+                "text.jpg",
+            )
+        }
+        assert results == {
+            "ok.jpg": (400, 300),
+            "truncated.jpg": None,
+            "padded.jpg": (400, 300),
+            "trailer.jpg": (400, 300),
+            "text.jpg": None,
+        }
+
+
+def test_generate_annotations_incremental(tmp_path, capsys):
+    img_dir = tmp_path / "maize-dataset"
+    create_images(img_dir)
+    kwargs = dict(
+        img_dir=str(img_dir),
+        keywords_to_avoid=["MACOSX"],
+        annotations_file_path=str(tmp_path / "annotations.csv"),
+        classes=CLASSES,
+        total_image_count=7,
+        crop_type="maize",
+        data_dir=str(tmp_path),
+        cache_path=str(tmp_path / "cache.json"),
+    )
+    df = generate_annotations(**kwargs)
+    assert "Validating 8 new or changed images" in capsys.readouterr().out
+
+    # nothing changed: no image is opened, the broken image is still skipped
+    assert generate_annotations(**kwargs).equals(df)
+    assert "Validating 0 new or changed images" in capsys.readouterr().out
+
+    # one new, one deleted and one changed image
+    os.remove(img_dir / "MSV" / "img0.jpg")
+    Image.fromarray(np.zeros((30, 40, 3), dtype=np.uint8)).save(
+        img_dir / "MSV" / "img3.jpg"
+    )
+    Image.fromarray(np.zeros((50, 60, 3), dtype=np.uint8)).save(
+        img_dir / "HEALTHY" / "img1.jpg"
+    )
+    df = generate_annotations(**kwargs)
+    assert "Validating 2 new or changed images" in capsys.readouterr().out
+    assert df["image"].tolist() == [
+        os.path.join("maize-dataset", "HEALTHY", f"img{i}.jpg") for i in range(4)
+    ] + [os.path.join("maize-dataset", "MSV", f"img{i}.jpg") for i in range(1, 4)]
+    assert df["width"].tolist() == [400, 60, 400, 400, 400, 400, 40]
+
+    # the images are validated again when more of them have to be decoded
+    generate_annotations(**kwargs, validation="sample", sample_rate=0.5)
+    assert "Validating 8 new or changed images" in capsys.readouterr().out
+    generate_annotations(**kwargs, validation="sample", sample_rate=0.5)
+    assert "Validating 0 new or changed images" in capsys.readouterr().out
+    generate_annotations(**kwargs, validation="sample", sample_rate=1.0)
+    assert "Validating 8 new or changed images" in capsys.readouterr().out
+
+
+def test_generate_all_annotations(tmp_path, monkeypatch):
+    datasets = []
+    for crop_type in ("maize", "beans"):
+        create_images(tmp_path / f"{crop_type}-dataset")
+        datasets.append(
+            {
+                "folder": f"{crop_type}-dataset",
+                "classes": CLASSES,
+                "total_image_count": 7,
+                "crop_type": crop_type,
+            }
+        )
+    monkeypatch.setattr(make_annotations_file, "all_datasets", datasets)
+
+    events = []
+
+    class RecordingExecutor(ProcessPoolExecutor):
+        def map(self, *args, **kwargs):
+            events.append("submit")
+            return super().map(*args, **kwargs)
+
+    def save_manifest(manifest, path):
+        events.append("collect")
+
+    monkeypatch.setattr(make_annotations_file, "ProcessPoolExecutor", RecordingExecutor)
+    monkeypatch.setattr(make_annotations_file, "save_manifest", save_manifest)
+    generate_all_annotations(str(tmp_path), max_workers=2)
+
+    # the images of all datasets are submitted before any is collected
+    assert events == ["submit", "submit", "collect", "collect"]
+    # the annotations are still in the order of the datasets
+    df = pd.read_csv(tmp_path / "annotations.csv")
+    assert df["dataset"].tolist() == ["maize-dataset"] * 7 + ["beans-dataset"] * 7
+    assert df["crop_type"].tolist() == ["maize"] * 7 + ["beans"] * 7
@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from crop_health_model.data.make_dataset import (
+    archive_volumes,
+    download_all,
+    extract,
+    extract_all,
+    extraction_record_filename,
+    list_archives,
+    manifest_filename,
+)
+
+FILES = {
+    "1": os.urandom(300_000),
+    "2": os.urandom(50_000),
+}
+
+DATASETS = [
+    {"folder": "dataset-a", "ids": [("1", "a.zip")]},
+    {"folder": "dataset-b", "ids": [("2", "b.rar")]},
+]
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serves `FILES` by id, with support for HTTP Range requests."""
+
+    def do_GET(self) -> None:
+        data = FILES[self.path.strip("/")]
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        start = 0
+        if self.headers.get("Range"):
+            start, end = self.headers["Range"].removeprefix("bytes=").split("-")
+            start = int(start)
+            end = int(end) if end else len(data) - 1
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            data = data[start : end + 1]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def run_download(server, data_dir) -> dict:
+    base_url = f"http://127.0.0.1:{server.server_port}/"
+    asyncio.run(download_all(DATASETS, str(data_dir), base_url, max_concurrency=2))
+    with open(os.path.join(data_dir, manifest_filename), "r") as f:
+        return json.load(f)
+
+
+def test_download_all(server, tmp_path):
+    manifest = run_download(server, tmp_path)
+
+    assert (tmp_path / "dataset-a" / "a.zip").read_bytes() == FILES["1"]
+    assert (tmp_path / "dataset-b" / "b.rar").read_bytes() == FILES["2"]
+    assert manifest["dataset-a/a.zip"] == {
+        "size": len(FILES["1"]),
+        "sha256": hashlib.sha256(FILES["1"]).hexdigest(),
+    }
+
+    # a second run verifies the files against the manifest without downloading them
+    server.requests.clear()
+    run_download(server, tmp_path)
+    assert server.requests == []
+
+
+def test_download_resumes_partial_files(server, tmp_path):
+    os.makedirs(tmp_path / "dataset-a")
+    os.makedirs(tmp_path / "dataset-b")
+    # an interrupted download and a partial file left by an older downloader
+    (tmp_path / "dataset-a" / "a.zip.part").write_bytes(FILES["1"][:100_000])
+    (tmp_path / "dataset-b" / "b.rar").write_bytes(FILES["2"][:20_000])
+
+    manifest = run_download(server, tmp_path)
+
+    assert (tmp_path / "dataset-a" / "a.zip").read_bytes() == FILES["1"]
+    assert (tmp_path / "dataset-b" / "b.rar").read_bytes() == FILES["2"]
+    assert not (tmp_path / "dataset-a" / "a.zip.part").exists()
+    assert ("/1", "bytes=100000-") in server.requests
+    assert ("/2", "bytes=20000-") in server.requests
+    assert manifest["dataset-b/b.rar"]["size"] == len(FILES["2"])
+
+
+def test_download_checksum_mismatch(server, tmp_path):
+    manifest = {"dataset-b/b.rar": {"size": len(FILES["2"]), "sha256": "0" * 64}}
+    with open(tmp_path / manifest_filename, "w") as f:
+        json.dump(manifest, f)
+
+    manifest = run_download(server, tmp_path)
+
+    assert not (tmp_path / "dataset-b" / "b.rar").exists()
+    assert not (tmp_path / "dataset-b" / "b.rar.part").exists()
+    assert manifest["dataset-b/b.rar"]["sha256"] == "0" * 64
+    assert (tmp_path / "dataset-a" / "a.zip").read_bytes() == FILES["1"]
+
+
+def test_download_restarts_stale_partial_files(server, tmp_path):
+    os.makedirs(tmp_path / "dataset-b")
+    # a leftover larger than the remote file, which the server answers with a 416
+    (tmp_path / "dataset-b" / "b.rar.part").write_bytes(os.urandom(60_000))
+
+    manifest = run_download(server, tmp_path)
+
+    assert (tmp_path / "dataset-b" / "b.rar").read_bytes() == FILES["2"]
+    assert ("/2", "bytes=60000-") in server.requests
+    assert ("/2", None) in server.requests
+    assert manifest["dataset-b/b.rar"]["size"] == len(FILES["2"])
+
+
+def test_download_verifies_existing_files(server, tmp_path):
+    run_download(server, tmp_path)
+    # a corrupt file of the right size is downloaded again
+    path = tmp_path / "dataset-a" / "a.zip"
+    path.write_bytes(os.urandom(len(FILES["1"])))
+    server.requests.clear()
+
+    run_download(server, tmp_path)
+
+    assert path.read_bytes() == FILES["1"]
+    assert server.requests == [("/1", None)]
+
+
+def create_zip(path, members: dict) -> None:
+    with zipfile.ZipFile(path, "w") as zip_ref:
+        for name, data in members.items():
+            zip_ref.writestr(name, data)
+
+
+def test_list_archives(tmp_path):
+    for name in [
+        "Field Experiment.part1.rar",
+        "Field Experiment.part2.rar",
+        "Field Experiment.part3.rar",
+        "HEALTHY_1.zip",
+        "HEALTHY_2.zip.part",
+        "notes.txt",
+    ]:
+        (tmp_path / name).write_bytes(b"")
+
+    archives = [os.path.basename(path) for path in list_archives(str(tmp_path))]
+    assert archives == ["Field Experiment.part1.rar", "HEALTHY_1.zip"]
+    assert len(archive_volumes(str(tmp_path / "Field Experiment.part1.rar"))) == 3
+
+
+def test_extract_all(tmp_path):
+    folder = tmp_path / "dataset-a"
+    os.makedirs(folder)
+    create_zip(folder / "MLN.zip", {"MLN/img1.jpg": b"a" * 10, "MLN/readme.txt": b""})
+    create_zip(folder / "MSV.zip", {"MSV/img2.jpg": b"b" * 20, "MSV/img3.JPG": b"c"})
+
+    extract_all(DATASETS[:1], str(tmp_path), max_workers=2)
+
+    assert (folder / "MLN" / "img1.jpg").read_bytes() == b"a" * 10
+    assert (folder / "MSV" / "img3.JPG").read_bytes() == b"c"
+    assert not (folder / "MLN" / "readme.txt").exists()
+    with open(folder / extraction_record_filename, "r") as f:
+        record = json.load(f)
+    assert record["MSV.zip"]["extracted"] == 2
+
+    # only images that are missing or have the wrong size are extracted again
+    (folder / "MSV" / "img2.jpg").write_bytes(b"b")
+    assert extract(str(folder / "MSV.zip")) == {"extracted": 1, "skipped": 1}
+    assert (folder / "MSV" / "img2.jpg").read_bytes() == b"b" * 20
@@ -0,0 +1,93 @@
+import io
+import json
+import zipfile
+
+import numpy as np
+from PIL import Image
+
+from crop_health_model.data.make_shards_from_archives import make_shards_from_archives
+from crop_health_model.datasets.shards import SHARD_INDEX_FILE, ShardedCropHealthDataset
+
+DATASETS = [
+    {
+        "folder": "maize-dataset",
+        "crop_type": "maize",
+        "classes": [
+            {"raw": "MSV", "clean": "MSV"},
+            {"raw": "HEALTHY", "clean": "HLT"},
+        ],
+    },
+    {
+        "folder": "beans-dataset",
+        "crop_type": "beans",
+        "classes": [{"raw": "healthy", "clean": "HLT"}],
+    },
+]
+
+
+def jpeg(width: int, height: int, value: int) -> bytes:
+    output = io.BytesIO()
+    array = np.full((height, width, 3), value, dtype=np.uint8)
+    Image.fromarray(array).save(output, format="JPEG")
+    return output.getvalue()
+
+
+def create_archives(tmp_path) -> None:
+    for dataset in DATASETS:
+        (tmp_path / dataset["folder"]).mkdir()
+    with zipfile.ZipFile(tmp_path / "maize-dataset" / "MSV.zip", "w") as zip_ref:
+        for i in range(6):
+            zip_ref.writestr(f"MSV/img{i}.jpg", jpeg(64, 48, 10 * i))
+        zip_ref.writestr("__MACOSX/MSV/._img0.jpg", b"resource fork")
+        zip_ref.writestr("MSV/broken.jpg", jpeg(64, 48, 0)[:100])
+    with zipfile.ZipFile(tmp_path / "maize-dataset" / "HEALTHY.zip", "w") as zip_ref:
+        for i in range(4):
+            zip_ref.writestr(f"HEALTHY/img{i}.jpg", jpeg(32, 96, 100 + 10 * i))
+    with zipfile.ZipFile(tmp_path / "beans-dataset" / "healthy_1.zip", "w") as zip_ref:
+        for i in range(5):
+            zip_ref.writestr(f"healthy/img{i}.JPG", jpeg(10, 10, 200))
+
+
+def test_make_shards_from_archives(tmp_path):
+    create_archives(tmp_path)
+    shards_dir = tmp_path / "shards"
+
+    make_shards_from_archives(
+        datasets=DATASETS,
+        data_dir=str(tmp_path),
+        output_dir=str(shards_dir),
+        size=16,
+        samples_per_shard=3,
+        seed=0,
+        max_workers=2,
+    )
+
+    with open(shards_dir / SHARD_INDEX_FILE, "r") as f:
+        index = json.load(f)
+    assert index["class_maps"]["multi-HLT"].keys() == {
+        "MSV_maize",
+        "HLT_maize",
+        "HLT_beans",
+    }
+
+    samples = []
+    for split in ("train", "val", "test"):
+        dataset = ShardedCropHealthDataset(str(shards_dir), split, "multi-HLT")
+        for shard in dataset.shards:
+            for image, annotations in dataset._read_shard(shard):
+                assert Image.open(io.BytesIO(image)).size == (
+                    annotations["width"],
+                    annotations["height"],
+                )
+                samples.append(annotations)
+    # 15 valid images, the broken image and the macOS metadata are skipped
+    assert len(samples) == 15
+    sizes = {
+        (sample["label"], sample["crop_type"]): (sample["width"], sample["height"])
+        for sample in samples
+    }
+    assert sizes == {
+        ("MSV", "maize"): (21, 16),
+        ("HLT", "maize"): (16, 48),
+        ("HLT", "beans"): (10, 10),
+    }
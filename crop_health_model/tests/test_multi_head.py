@@ -0,0 +1,133 @@
+import importlib.util
+import json
+from types import SimpleNamespace
+
+import lightning.pytorch as pl
+import numpy as np
+import torch
+
+from crop_health_model.datasets.dataset import CropHealthDataset
+from crop_health_model.engines.callbacks import (
+    SaveDataDictionaryCallback,
+    SaveModelHandlerCallback,
+    SaveModelScriptCallback,
+)
+from crop_health_model.engines.system import LitModel
+from crop_health_model.models.multi_head import MultiHeadResNet
+
+
+def test_multi_task_labels(tmp_path, image_dataset):
+    image_dataset()
+    dataset = CropHealthDataset(
+        str(tmp_path / "annotations.csv"), str(tmp_path), "multi-task"
+    )
+    assert dataset.class_map == {
+        "binary": {"HLT": 0, "NOT_HLT": 1},
+        "single-HLT": {"HLT": 0, "MSV": 1, "MLN": 2},
+        "multi-HLT": {
+            "HLT_maize": 0,
+            "MSV_maize": 1,
+            "MLN_maize": 2,
+            "HLT_beans": 3,
+            "MSV_beans": 4,
+            "MLN_beans": 5,
+        },
+    }
+    _, label = dataset[3]
+    assert label.tolist() == [0, 0, 3]
+    assert dataset.get_class_counts([0, 1, 3])["single-HLT"] == {0: 2, 1: 1}
+
+
+def test_multi_head_model(tmp_path):
+    model = MultiHeadResNet(2, 13, 17, num_layers=18).eval()
+    with torch.no_grad():
+        logits = model(torch.randn(2, 3, 32, 32))
+    assert {task: tuple(l.shape) for task, l in logits.items()} == {
+        "binary": (2, 2),
+        "single-HLT": (2, 13),
+        "multi-HLT": (2, 17),
+    }
+
+    # the model script has the hyperparameters as defaults
+    filepath = tmp_path / "model_script.py"
+    callback = SaveModelScriptCallback(
+        "model_script.py", "crop_health_model/models/multi_head.py"
+    )
+    callback.save_model_script(model.get_hyperparameters(), str(filepath))
+    spec = importlib.util.spec_from_file_location("model_script", filepath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    assert module.MultiHeadResNet().num_classes == model.num_classes
+
+    # the handler returns the predictions of every task
+    handler = tmp_path / "model_handler.py"
+    SaveModelHandlerCallback(
+        "model_handler.py", "crop_health_model/configs/config_multi_task.yaml"
+    ).generate_handler_script(str(handler))
+    script = handler.read_text()
+    compile(script, str(handler), "exec")
+    assert "def postprocess(self, data):" in script
+    assert "task_index_to_name.json" in script
+
+
+def check_label_mapping(path) -> None:
+    # the check of `ts.utils.util.load_label_mapping`, which TorchServe runs on the
+    # index_to_name.json of a model archive
+    with open(path) as f:
+        mapping = json.load(f)
+    for key, value in mapping.items():
+        assert key.isdigit()
+        assert isinstance(value, str) or (
+            isinstance(value, list) and all(isinstance(v, str) for v in value)
+        )
+
+
+def test_class_names(tmp_path, image_dataset):
+    image_dataset()
+    callback = SaveDataDictionaryCallback("class_map", "index_to_name")
+    for task in ("single-HLT", "multi-task"):
+        log_dir = tmp_path / task
+        log_dir.mkdir()
+        dataset = CropHealthDataset(
+            str(tmp_path / "annotations.csv"), str(tmp_path), task
+        )
+        trainer = SimpleNamespace(
+            datamodule=SimpleNamespace(data=dataset), log_dir=str(log_dir)
+        )
+        callback.on_train_start(trainer, None)
+
+    check_label_mapping(tmp_path / "single-HLT" / "index_to_name.json")
+    # TorchServe would reject the class names of every task in index_to_name.json
+    assert not (tmp_path / "multi-task" / "index_to_name.json").exists()
+    with open(tmp_path / "multi-task" / "task_index_to_name.json") as f:
+        mapping = json.load(f)
+    assert mapping["single-HLT"] == {"0": "HLT", "1": "MSV", "2": "MLN"}
+    assert set(mapping) == {"binary", "single-HLT", "multi-HLT"}
+
+
+def test_multi_head_training(image_dataset, crop_datamodule):
+    image_dataset()
+    datamodule = crop_datamodule("multi-task")
+    lit_model = LitModel(MultiHeadResNet(2, 3, 6, num_layers=18))
+    lit_model.configure_optimizers = lambda: torch.optim.SGD(
+        lit_model.parameters(), lr=0.01
+    )
+    trainer = pl.Trainer(
+        accelerator="cpu",
+        devices=1,
+        max_epochs=1,
+        logger=False,
+        enable_checkpointing=False,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+    )
+    trainer.fit(lit_model, datamodule=datamodule)
+    (metrics,) = trainer.validate(lit_model, datamodule=datamodule, verbose=False)
+    assert set(metrics) == {"val_loss"} | {
+        f"val_{metric}_{task}"
+        for metric in ("loss", "acc", "f1")
+        for task in ("binary", "single-HLT", "multi-HLT")
+    }
+    head_losses = sum(metrics[f"val_loss_{task}"] for task in lit_model.tasks)
+    assert np.isclose(metrics["val_loss"], head_losses, rtol=1e-4)
+    assert isinstance(datamodule.compute_class_weights(), dict)
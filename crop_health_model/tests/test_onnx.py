@@ -0,0 +1,125 @@
+import json
+import os
+
+import lightning.pytorch as pl
+import numpy as np
+import pytest
+import torch
+from lightning.pytorch.callbacks import ModelCheckpoint
+from lightning.pytorch.loggers import CSVLogger
+from PIL import Image
+
+from crop_health_model.engines.callbacks import (
+    SaveOnnxModelCallback,
+    handler_image_processing,
+)
+from crop_health_model.engines.system import LitModel
+from crop_health_model.models.loading import load_run
+from crop_health_model.models.model import ResNet
+from crop_health_model.models.multi_head import MultiHeadResNet
+from crop_health_model.models.onnx_export import (
+    check_onnx_parity,
+    export_onnx,
+    onnx_session,
+)
+from crop_health_model.scripts.export_onnx import export_run
+from crop_health_model.scripts.onnx_inference import OnnxRunner, predict
+
+pytest.importorskip("onnxruntime")
+
+
+@pytest.mark.parametrize(
+    "model, num_classes",
+    [
+        (ResNet(num_classes=3, num_layers=18), {"logits": 3}),
+        (
+            MultiHeadResNet(2, 3, 4, num_layers=18),
+            {"binary": 2, "single-HLT": 3, "multi-HLT": 4},
+        ),
+    ],
+)
+def test_export_onnx(tmp_path, model, num_classes):
+    path = str(tmp_path / "model.onnx")
+    x = torch.randn(2, 3, 32, 32)
+    export_onnx(model.eval(), x, path)
+
+    # the batch normalizations are folded into the convolutions
+    results = check_onnx_parity(model, path, torch.randn(5, 3, 32, 32))
+    assert results["top1_agreement"] == 1.0
+    session = onnx_session(path)
+    outputs = session.run(None, {"input": np.zeros((5, 3, 32, 32), np.float32)})
+    assert {output.name for output in session.get_outputs()} == set(num_classes)
+    assert [logits.shape for logits in outputs] == [
+        (5, n) for n in num_classes.values()
+    ]
+
+    with torch.no_grad():
+        model.resnet.conv1.weight.mul_(2)
+    with pytest.raises(ValueError, match="differs"):
+        check_onnx_parity(model, path, x)
+
+
+def test_onnx_runner(tmp_path, run_dir):
+    export_run(run_dir, num_samples=4)
+    with open(os.path.join(run_dir, "index_to_name.json"), "w") as f:
+        json.dump({"0": "healthy", "1": "sick"}, f)
+
+    image_paths = [str(tmp_path / f"img{i}.jpg") for i in range(3)]
+    predictions = predict(run_dir, image_paths, batch_size=2)
+    assert list(predictions) == image_paths
+
+    # the same preprocessing and probabilities as the PyTorch model
+    model, _ = load_run(run_dir)
+    runner = OnnxRunner.from_run(run_dir)
+    images = [Image.open(path) for path in image_paths]
+    x = torch.stack([runner.image_processing(image) for image in images])
+    with torch.no_grad():
+        probabilities = torch.softmax(model(x), dim=1)
+    for path, probs in zip(image_paths, probabilities):
+        prediction = predictions[path]
+        assert list(prediction) == sorted(prediction, key=prediction.get, reverse=True)
+        assert prediction["healthy"] == pytest.approx(probs[0].item(), abs=1e-4)
+        assert prediction["sick"] == pytest.approx(probs[1].item(), abs=1e-4)
+
+
+def test_handler_image_processing():
+    processing = handler_image_processing(
+        {
+            "test_transforms": [
+                {
+                    "class_path": "torchvision.transforms.CenterCrop",
+                    "init_args": {"size": 8},
+                }
+            ],
+            "normalization": {
+                "class_path": "torchvision.transforms.Normalize",
+                "init_args": {"mean": [0.5] * 3, "std": [0.5] * 3},
+            },
+        }
+    )
+    x = processing(Image.new("RGB", (12, 12), (255, 0, 255)))
+    assert x.shape == (3, 8, 8)
+    assert torch.equal(x[:, 0, 0], torch.tensor([1.0, -1.0, 1.0]))
+
+
+def test_save_onnx_model_callback(tmp_path, image_dataset, crop_datamodule):
+    image_dataset()
+    torch.manual_seed(0)
+    lit_model = LitModel(ResNet(num_classes=3, num_layers=18))
+    lit_model.configure_optimizers = lambda: torch.optim.SGD(
+        lit_model.parameters(), lr=0.01
+    )
+    logger = CSVLogger(tmp_path / "logs")
+    trainer = pl.Trainer(
+        accelerator="cpu",
+        devices=1,
+        max_epochs=1,
+        logger=logger,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+        callbacks=[ModelCheckpoint(), SaveOnnxModelCallback(num_samples=2)],
+    )
+    trainer.fit(lit_model, datamodule=crop_datamodule("single-HLT"))
+
+    path = os.path.join(logger.log_dir, "checkpoints", "best_model.onnx")
+    check_onnx_parity(lit_model.model, path, torch.randn(2, 3, 32, 32))
@@ -0,0 +1,96 @@
+import copy
+
+import lightning.pytorch as pl
+import pytest
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from crop_health_model.engines import system
+from crop_health_model.engines.system import LitModel
+from crop_health_model.models.model import ResNet
+from crop_health_model.models.multi_head import MultiHeadResNet
+from crop_health_model.models.performance import check_parity, optimize_model
+
+
+def test_channels_last_parity():
+    torch.manual_seed(0)
+    model = ResNet(num_classes=3, num_layers=18)
+    reference = copy.deepcopy(model)
+    optimize_model(model, channels_last=True)
+    assert model.resnet.conv1.weight.is_contiguous(memory_format=torch.channels_last)
+    x = torch.randn(2, 3, 64, 64)
+    results = check_parity(reference, model, x, channels_last=True)
+    assert results["max_rel_diff"] <= 1e-3
+    assert results["top1_agreement"] == 1.0
+    assert model.training
+
+
+def test_multi_head_parity():
+    torch.manual_seed(0)
+    lit_model = LitModel(MultiHeadResNet(2, 13, 17, num_layers=18), channels_last=True)
+    results = lit_model.optimize(input_size=64)
+    assert results["max_rel_diff"] <= 1e-3
+    assert results["top1_agreement"] == 1.0
+
+    reference = copy.deepcopy(lit_model.model)
+    with torch.no_grad():
+        lit_model.model.heads["multi-HLT"].bias.add_(10)
+    with pytest.raises(ValueError, match="differs from the eager float32 model"):
+        check_parity(reference, lit_model.model, torch.randn(2, 3, 64, 64))
+
+
+def test_parity_failure():
+    torch.manual_seed(0)
+    model = ResNet(num_classes=3, num_layers=18)
+    reference = copy.deepcopy(model)
+    with torch.no_grad():
+        model.resnet.fc.bias.add_(10)
+    with pytest.raises(ValueError, match="differs from the eager float32 model"):
+        check_parity(reference, model, torch.randn(2, 3, 64, 64))
+
+
+def test_lit_model_performance_mode():
+    torch.manual_seed(0)
+    lit_model = LitModel(
+        ResNet(num_classes=3, num_layers=18), channels_last=True, bf16_autocast=True
+    )
+    keys = set(lit_model.state_dict())
+    results = lit_model.optimize(input_size=64)
+    assert results["max_rel_diff"] <= 5e-2
+    # the options are only applied once, and don't change the checkpoints
+    assert lit_model.optimize(input_size=64) is None
+    assert set(lit_model.state_dict()) == keys
+
+    lit_model.eval()
+    with torch.no_grad():
+        logits = lit_model(torch.randn(2, 3, 64, 64))
+    assert logits.shape == (2, 3)
+
+
+def test_lit_model_optimized_on_device(monkeypatch):
+    devices = []
+
+    def record_parity(reference, model, x, *args):
+        devices.append(x.device)
+        return {}
+
+    monkeypatch.setattr(system, "check_parity", record_parity)
+
+    class CheckNotOptimized(pl.Callback):
+        def on_validation_start(self, trainer, pl_module):
+            # the callbacks run before the module, which is set up but not optimized yet
+            assert not pl_module.optimized
+
+    lit_model = LitModel(ResNet(num_classes=3, num_layers=18), channels_last=True)
+    trainer = pl.Trainer(
+        accelerator="cpu",
+        devices=1,
+        logger=False,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+        callbacks=[CheckNotOptimized()],
+    )
+    dataset = TensorDataset(torch.randn(4, 3, 32, 32), torch.tensor([0, 1, 2, 0]))
+    trainer.validate(lit_model, DataLoader(dataset, batch_size=2), verbose=False)
+    assert lit_model.optimized
+    assert devices == [lit_model.device]
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+import torch
+
+from crop_health_model.models.loading import load_run
+from crop_health_model.models.model import ResNet
+from crop_health_model.models.quantization import quantize_model
+from crop_health_model.scripts.quantize import calibration_batches, quantize
+
+
+def test_quantize_model():
+    torch.manual_seed(0)
+    model = ResNet(num_classes=3, num_layers=18).eval()
+    batches = [torch.randn(4, 3, 32, 32) for _ in range(2)]
+    quantized = quantize_model(model, batches)
+
+    # conv-bn-relu are fused into int8 convolutions
+    modules = [type(module).__name__ for module in quantized.modules()]
+    assert "ConvReLU2d" in modules
+    assert not any(name == "BatchNorm2d" for name in modules)
+    with torch.no_grad():
+        assert quantized(batches[0]).shape == (4, 3)
+    # the float model isn't modified
+    assert isinstance(model.resnet.bn1, torch.nn.BatchNorm2d)
+
+    with pytest.raises(ValueError, match="calibration batch"):
+        quantize_model(model, [])
+
+
+def test_quantize(run_dir):
+    model, datamodule = load_run(run_dir)
+    assert torch.equal(
+        model.resnet.fc.weight,
+        torch.load(os.path.join(run_dir, "checkpoints", "best_model.pt"))[
+            "resnet.fc.weight"
+        ],
+    )
+    assert datamodule.task == "binary"
+
+    results = quantize(
+        run_dir, num_calibration_batches=1, max_f1_drop=1.0, latency_iterations=1
+    )
+    assert results["accepted"]
+    assert set(results["metrics"]) == {"float", "int8"}
+    assert set(results["delta"]["binary"]) == {"acc", "f1"}
+    assert os.path.exists(os.path.join(run_dir, "quantization.json"))
+
+    scripted = torch.jit.load(
+        os.path.join(run_dir, "checkpoints", "best_model_int8.pt")
+    )
+    with torch.no_grad():
+        assert scripted(torch.randn(2, 3, 32, 32)).shape == (2, 2)
+
+
+def test_calibration_batches(run_dir):
+    _, datamodule = load_run(run_dir)
+    datamodule.setup("validate")
+
+    def sample(seed):
+        batches = list(calibration_batches(datamodule, 1, seed))
+        assert len(batches) == 1
+        return batches[0][0]
+
+    # the sample is seeded, and isn't the first batch of the split
+    assert torch.equal(sample(0), sample(0))
+    assert not torch.equal(sample(0), next(iter(datamodule.val_dataloader()))[0])
+
+
+def test_quantize_rejected(run_dir):
+    # no drop is small enough for a negative threshold
+    with pytest.raises(ValueError, match="isn't saved"):
+        quantize(
+            run_dir, num_calibration_batches=1, max_f1_drop=-1.0, latency_iterations=1
+        )
+    assert os.path.exists(os.path.join(run_dir, "quantization.json"))
+    assert not os.path.exists(
+        os.path.join(run_dir, "checkpoints", "best_model_int8.pt")
+    )
@@ -0,0 +1,154 @@
+from types import SimpleNamespace
+
+import pandas as pd
+import torch
+from torchvision import transforms
+
+from crop_health_model.data.make_shards import make_shards
+from crop_health_model.datasets import shards
+from crop_health_model.datasets.shards import ShardDataLoader, ShardedCropHealthDataset
+from crop_health_model.datasets.split import annotations_split
+
+LABELS = ("HLT", "SICKa", "SICKb", "HLT", "SICKm")
+CROP_TYPES = ("apple", "apple", "banana", "banana", "maize")
+
+
+def create_dummy_images(image_dataset, num_images: int = 40) -> None:
+    # small images whose pixel value encodes their index
+    image_dataset(
+        num_images=num_images,
+        sizes=((8, 8),),
+        labels=LABELS,
+        crop_types=CROP_TYPES,
+        index_pixels=True,
+    )
+
+
+def read_split(shards_dir, split, **kwargs) -> list[int]:
+    dataset = ShardedCropHealthDataset(
+        shards_dir=shards_dir,
+        split=split,
+        task="multi-HLT",
+        transform=transforms.PILToTensor(),
+        **kwargs,
+    )
+    return [int(image[0, 0, 0]) for image, _ in dataset]
+
+
+def expected_split(tmp_path) -> dict:
+    df = pd.read_csv(tmp_path / "annotations.csv")
+    return annotations_split(df["label"], df["crop_type"], (0.8, 0.2), seed=0)
+
+
+def test_make_shards(tmp_path, image_dataset):
+    create_dummy_images(image_dataset)
+    shards_dir = str(tmp_path / "shards")
+    make_shards(
+        data_dir=str(tmp_path), output_dir=shards_dir, samples_per_shard=4, seed=0
+    )
+
+    # the stratified split of the datamodule, in a random order mixing the classes
+    expected = expected_split(tmp_path)
+    for split in ("train", "val", "test"):
+        assert sorted(read_split(shards_dir, split)) == expected[split].tolist()
+    written = read_split(shards_dir, "train")
+    assert written != expected["train"].tolist()
+
+    # shuffling changes the order but not the samples
+    shuffled = read_split(shards_dir, "train", shuffle=True, shuffle_buffer=8)
+    assert shuffled != written
+    assert sorted(shuffled) == sorted(expected["train"].tolist())
+
+    dataset = ShardedCropHealthDataset(shards_dir, "train", task="multi-HLT")
+    assert dataset.class_map == {
+        "HLT_apple": 0,
+        "SICKa_apple": 1,
+        "SICKb_banana": 2,
+        "HLT_banana": 3,
+        "SICKm_maize": 4,
+    }
+    assert sum(dataset.get_class_counts().values()) == len(expected["train"])
+
+
+def test_shards_workers(tmp_path, image_dataset):
+    create_dummy_images(image_dataset)
+    shards_dir = str(tmp_path / "shards")
+    make_shards(
+        data_dir=str(tmp_path), output_dir=shards_dir, samples_per_shard=4, seed=0
+    )
+    dataset = ShardedCropHealthDataset(
+        shards_dir,
+        "train",
+        task="binary",
+        transform=transforms.PILToTensor(),
+        shuffle=True,
+    )
+    loader = ShardDataLoader(dataset, batch_size=4, num_workers=2)
+
+    expected = expected_split(tmp_path)["train"].tolist()
+    epochs = []
+    for _ in range(2):
+        epoch = [int(image[0, 0, 0]) for images, _ in loader for image in images]
+        assert sorted(epoch) == expected
+        epochs.append(epoch)
+    assert epochs[0] != epochs[1]
+
+
+def test_shards_ranks(tmp_path, image_dataset, monkeypatch):
+    create_dummy_images(image_dataset)
+    shards_dir = str(tmp_path / "shards")
+    make_shards(
+        data_dir=str(tmp_path), output_dir=shards_dir, samples_per_shard=3, seed=0
+    )
+
+    monkeypatch.setattr(shards.dist, "is_initialized", lambda: True)
+    monkeypatch.setattr(shards.dist, "get_world_size", lambda: 2)
+    rank_samples = []
+    for rank in range(2):
+        monkeypatch.setattr(shards.dist, "get_rank", lambda: rank)
+        rank_samples.append(read_split(shards_dir, "train", shuffle=True))
+
+    # both ranks yield the same number of samples and never the same sample
+    assert len(rank_samples[0]) == len(rank_samples[1]) > 0
+    assert not set(rank_samples[0]) & set(rank_samples[1])
+
+
+def test_shards_eval_coverage(tmp_path, image_dataset, monkeypatch):
+    create_dummy_images(image_dataset, num_images=60)
+    shards_dir = str(tmp_path / "shards")
+    make_shards(
+        data_dir=str(tmp_path), output_dir=shards_dir, samples_per_shard=1, seed=0
+    )
+    expected = expected_split(tmp_path)
+
+    # 2 ranks with 3 workers each, fewer slots than shards and an uneven remainder
+    world_size, num_workers = 2, 3
+    monkeypatch.setattr(shards.dist, "is_initialized", lambda: True)
+    monkeypatch.setattr(shards.dist, "get_world_size", lambda: world_size)
+    for split in ("val", "test"):
+        assert len(expected[split]) > world_size * num_workers
+        assert len(expected[split]) % (world_size * num_workers) != 0
+        samples = []
+        for rank in range(world_size):
+            monkeypatch.setattr(shards.dist, "get_rank", lambda: rank)
+            for worker_id in range(num_workers):
+                worker_info = SimpleNamespace(id=worker_id, num_workers=num_workers)
+                monkeypatch.setattr(shards, "get_worker_info", lambda: worker_info)
+                samples += read_split(shards_dir, split)
+        # every sample of the evaluation splits is yielded exactly once
+        assert sorted(samples) == expected[split].tolist()
+
+
+def test_shards_multi_task(tmp_path, image_dataset):
+    create_dummy_images(image_dataset)
+    shards_dir = str(tmp_path / "shards")
+    make_shards(
+        data_dir=str(tmp_path), output_dir=shards_dir, samples_per_shard=4, seed=0
+    )
+    dataset = ShardedCropHealthDataset(shards_dir, "val", task="multi-task")
+    assert set(dataset.class_map) == {"binary", "single-HLT", "multi-HLT"}
+    _, label = next(iter(dataset))
+    assert label.dtype == torch.int64 and label.shape == (3,)
+    class_counts = dataset.get_class_counts()
+    assert set(class_counts) == set(dataset.class_map)
+    assert sum(class_counts["binary"].values()) == len(expected_split(tmp_path)["val"])
@@ -0,0 +1,94 @@
+import numpy as np
+import torch
+from torchvision import transforms
+
+from crop_health_model.datasets.datamodule import CropHealthDataModule
+from crop_health_model.datasets.split import (
+    annotations_split,
+    load_split,
+    stratified_split_indices,
+)
+
+
+def test_stratified_split_indices():
+    strata = np.repeat([0, 1, 2], [100, 50, 10])
+    split = stratified_split_indices(strata, (0.8, 0.2), seed=0)
+
+    all_indices = np.concatenate(list(split.values()))
+    assert sorted(all_indices.tolist()) == list(range(len(strata)))
+    # every stratum is split with the same proportions
+    for stratum, (num_train, num_val, num_test) in zip(
+        range(3), [(64, 16, 20), (32, 8, 10), (6, 2, 2)]
+    ):
+        counts = [np.sum(strata[split[name]] == stratum) for name in split]
+        assert counts == [num_train, num_val, num_test]
+
+    assert all(
+        np.array_equal(split[name], indices)
+        for name, indices in stratified_split_indices(strata, (0.8, 0.2), 0).items()
+    )
+
+
+def create_datamodule(data_dir, split_file) -> CropHealthDataModule:
+    return CropHealthDataModule(
+        batch_size=4,
+        task="single-HLT",
+        data_dir=str(data_dir),
+        test_transforms=[transforms.Resize(8)],
+        split_file=str(split_file),
+    )
+
+
+def split_images(data) -> list[str]:
+    subset = data.dataset
+    return subset.dataset.data_df["image"].iloc[subset.indices].tolist()
+
+
+def test_datamodule_split_file(tmp_path, image_dataset):
+    labels = ("HLT", "SICKa", "SICKb") * 20
+    image_dataset(
+        num_images=len(labels), sizes=((8, 8),), labels=labels, crop_types=("maize",)
+    )
+    split_file = tmp_path / "run" / "split"
+
+    # the first run saves its split, later runs load it
+    torch.manual_seed(0)
+    datamodule = create_datamodule(tmp_path, split_file)
+    datamodule.setup("fit")
+    saved = load_split(str(split_file), num_samples=len(labels))
+    assert split_images(datamodule.train_data) == [
+        f"img{i}.jpg" for i in saved["train"]
+    ]
+    assert split_images(datamodule.val_data) == [f"img{i}.jpg" for i in saved["val"]]
+    class_map = datamodule.data.class_map
+
+    torch.manual_seed(1)
+    datamodule = create_datamodule(tmp_path, split_file)
+    datamodule.setup("test")
+    assert split_images(datamodule.test_data) == [f"img{i}.jpg" for i in saved["test"]]
+    assert datamodule.test_data.get_class_counts() == {0: 4, 1: 4, 2: 4}
+    # only the rows of the test split are indexed, with the class map of all the rows
+    assert len(datamodule.data) == len(saved["test"])
+    assert datamodule.data.class_map == class_map
+
+
+def test_annotations_split(tmp_path, image_dataset):
+    labels = ("HLT",) * 30 + ("SICKa",) * 20 + ("HLT",) * 10
+    crop_types = ("maize",) * 50 + ("beans",) * 10
+    df = image_dataset(
+        num_images=len(labels), sizes=((8, 8),), labels=labels, crop_types=crop_types
+    )
+
+    # the shards and the leakage report use the same split as the datamodule
+    datamodule = create_datamodule(tmp_path, tmp_path / "split")
+    datamodule.setup("fit")
+    split = annotations_split(df["label"], df["crop_type"], (0.8, 0.2), seed=42)
+    assert np.array_equal(datamodule.split["train"], split["train"])
+    assert np.array_equal(datamodule.split["val"], split["val"])
+
+    # the sorted training samples, grouped by class, are shuffled by the loader
+    loader = datamodule.train_dataloader()
+    assert isinstance(loader.sampler, torch.utils.data.RandomSampler)
+    assert not isinstance(
+        datamodule.val_dataloader().sampler, torch.utils.data.RandomSampler
+    )
@@ -0,0 +1,76 @@
+import lightning.pytorch as pl
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+from torchmetrics import MeanMetric, MetricCollection
+from torchmetrics.functional import accuracy, fbeta_score
+
+from crop_health_model.engines.system import LitModel
+from crop_health_model.models.model import ResNet
+
+
+def create_dataloader(num_samples: int = 24, num_classes: int = 3) -> DataLoader:
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(num_samples, 3, 32, 32, generator=generator)
+    y = torch.arange(num_samples) % num_classes
+    return DataLoader(TensorDataset(x, y), batch_size=5)
+
+
+def create_trainer() -> pl.Trainer:
+    return pl.Trainer(
+        accelerator="cpu",
+        devices=1,
+        max_epochs=1,
+        logger=False,
+        enable_checkpointing=False,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+    )
+
+
+def test_epoch_metrics(monkeypatch):
+    # the validation metrics are only updated, their batch values are never computed
+    def forward(*args, **kwargs):
+        raise AssertionError("The batch value of a validation metric was computed")
+
+    monkeypatch.setattr(MetricCollection, "forward", forward)
+    monkeypatch.setattr(MeanMetric, "forward", forward)
+    torch.manual_seed(0)
+    lit_model = LitModel(ResNet(num_classes=3, num_layers=18)).eval()
+    dataloader = create_dataloader()
+    (metrics,) = create_trainer().validate(lit_model, dataloader, verbose=False)
+    assert set(metrics) == {"val_loss", "val_acc", "val_f1"}
+
+    # the epoch metrics are computed over all samples, not averaged over the batches
+    with torch.no_grad():
+        logits = torch.cat([lit_model(x) for x, _ in dataloader])
+    y = torch.cat([y for _, y in dataloader])
+    preds = logits.argmax(dim=-1)
+    expected_f1 = fbeta_score(
+        preds, y, task="multiclass", beta=1.0, num_classes=3, average="macro"
+    )
+    expected_acc = accuracy(preds, y, task="multiclass", num_classes=3)
+    expected_loss = torch.nn.functional.cross_entropy(logits, y)
+    assert torch.isclose(torch.tensor(metrics["val_f1"]), expected_f1)
+    assert torch.isclose(torch.tensor(metrics["val_acc"]), expected_acc)
+    assert torch.isclose(torch.tensor(metrics["val_loss"]), expected_loss, atol=1e-5)
+
+
+def test_training_metric_names():
+    lit_model = LitModel(ResNet(num_classes=2, num_layers=18))
+    lit_model.configure_optimizers = lambda: torch.optim.SGD(
+        lit_model.parameters(), lr=0.01
+    )
+    trainer = create_trainer()
+    trainer.fit(lit_model, create_dataloader(num_classes=2), create_dataloader(10, 2))
+    assert {
+        "train_loss_step",
+        "train_loss_epoch",
+        "train_acc_step",
+        "train_acc_epoch",
+        "train_f1_step",
+        "train_f1_epoch",
+        "val_loss",
+        "val_acc",
+        "val_f1",
+        "learning_rate",
+    } <= set(trainer.callback_metrics)
@@ -0,0 +1,54 @@
+import yaml
+
+from crop_health_model.models.loading import load_datamodule
+from crop_health_model.scripts.tune_dataloader import tune_dataloader
+
+
+def create_config(tmp_path, image_dataset) -> str:
+    image_dataset(
+        num_images=16, sizes=((12, 12),), labels=("HLT", "MSV"), crop_types=("maize",)
+    )
+    resize = {"class_path": "torchvision.transforms.Resize", "init_args": {"size": 8}}
+    config = {
+        "fit": {
+            "data": {
+                "batch_size": 2,
+                "task": "binary",
+                "data_dir": str(tmp_path),
+                "num_workers": 16,
+                "train_transforms": [resize],
+                "test_transforms": [resize],
+            }
+        }
+    }
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(yaml.safe_dump(config))
+    return str(config_path)
+
+
+def test_tune_dataloader(tmp_path, image_dataset):
+    config = create_config(tmp_path, image_dataset)
+    output = tmp_path / "dataloader.yaml"
+
+    best = tune_dataloader(
+        config,
+        output=str(output),
+        num_workers=[0, 1],
+        prefetch_factors=[2],
+        persistent_workers=[False, True],
+        num_batches=2,
+        epochs=2,
+    )
+
+    assert best["num_workers"] in (0, 1)
+    assert yaml.safe_load(output.read_text()) == {"fit": {"data": best}}
+
+    # the fragment overrides the settings of the config
+    datamodule = load_datamodule(config)
+    assert datamodule.num_workers == 16
+    for key, value in best.items():
+        setattr(datamodule, key, value)
+    datamodule.setup("fit")
+    loader = datamodule.train_dataloader()
+    assert loader.num_workers == best["num_workers"]
+    assert loader.persistent_workers == best["persistent_workers"]